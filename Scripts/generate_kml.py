@@ -23,18 +23,22 @@
 #  DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
-from cgi import parse_qs, escape
 import os, sys
-import subprocess
-from random import randint
-import re
-import urllib
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from urllib import quote
+elif major == 3:
+    from urllib.parse import quote
 from osgeo import gdal
 from gdalconst import *
 import kml_for_tiles
-import generate_tiles
-from xml.etree import ElementTree
-import zipfile
+import kml_writer
+import layer_registry
+import tile_math
+import raster_catalog
+import response_cache
+import mapsource_catalog
+import metrics
 
 # sys.stderr = open(os.path.abspath(__file__).replace(os.path.basename(__file__),'') + 'logs/generate_kml.txt', 'w')
 
@@ -46,11 +50,74 @@ with open(addr_file) as f:
         tilescriptloc = vals[0] + ':' + vals[2].strip()    
         transparentpng = tilescriptloc
 
+# Recently generated documents, shared by all requests
+kml_cache = response_cache.ResponseCache(name='kml')
+
+def send_response(start_response, response, encoding, extra_headers=[]):
+    """Send a (cached) document, compressed if the client accepts it"""
+
+    encoding, body = response.encoded(encoding)
+    response_headers = [('Content-Type', response.content_type),
+                  ('Content-Length', str(len(body))),
+                  ('Vary', 'Accept-Encoding')] + extra_headers
+    if encoding != 'identity':
+        response_headers.append(('Content-Encoding', encoding))
+    start_response('200 OK', response_headers)
+    return [body]
+
+def catalog_kml():
+    """KML with a Region-bound link to the root kml of each scanned dataset (and .pyr file)"""
+
+    kml = kml_writer.KMLWriter()
+    kml.document_start('Raster catalog')
+    for directory in raster_catalog.catalog.directories:
+        kml.folder_start(os.path.basename(os.path.normpath(directory)))
+        for entry in raster_catalog.catalog.datasets(directory):
+            if not os.path.exists(entry['path']):
+                continue
+            ulx, uly, lrx, lry = raster_catalog.clamp_extent(entry['extent'])
+            href = kmlscriptloc + '/?url=' + quote(entry['path'], safe='') + ';'
+            kml.network_link(os.path.basename(entry['path']), kml.box(uly, lry, lrx, ulx), -1, -1,
+                             href.encode('utf-8'))
+        kml.folder_end()
+    kml.document_end()
+    return kml
+
+def mapsource_kml(environ, start_response, name, encoding):
+    """A catalog of map sources, answering 304 if the client already has the current version"""
+
+    response, etag = mapsource_catalog.catalogs.get(name, kmlscriptloc)
+    if response is None:
+        response_body = 'Unknown catalog'
+        start_response('404 Not Found', [('Content-Type', 'text/html'),
+                                         ('Content-Length', str(len(response_body)))])
+        return [response_body.encode('utf-8')]
+
+    tags = [tag.strip() for tag in environ.get('HTTP_IF_NONE_MATCH', '').split(',')]
+    if etag in tags or '*' in tags:
+        start_response('304 Not Modified', [('ETag', etag)])
+        return [b'']
+    return send_response(start_response, response, encoding, [('ETag', etag)])
+
 def generate_kml(environ, start_response):
+    with metrics.request_seconds.time('kml'):
+        return kml_response(environ, start_response)
+
+def kml_response(environ, start_response):
 
     querystring = environ['QUERY_STRING']
+    path = environ.get('PATH_INFO', '')
+    encoding = response_cache.accepted_encoding(environ)
+
+    if path == '/catalog.kml':
+        raster_catalog.catalog.refresh()
+        kml = catalog_kml()
+        return send_response(start_response, response_cache.CachedResponse(kml.getvalue(), 'text/xml'), encoding)
     
-    if querystring == '':
+    if path.startswith('/mapsources/') and path.endswith('.kml'):
+        return mapsource_kml(environ, start_response, path[len('/mapsources/'):-len('.kml')], encoding)
+
+    if querystring == '' and not path.startswith('/l/'):
         response_body = ''
         status = '200 OK'
         response_headers = [('Content-Type', 'text/html'),
@@ -58,200 +125,73 @@ def generate_kml(environ, start_response):
         start_response(status, response_headers)
         return response_body
     
-    fs = parse_qs(environ['QUERY_STRING'])
-    url = escape(fs.get('url', [''])[0])
-    zoom = escape(fs.get('zoom', [''])[0])
-    if zoom == '':
-        zoom = '0-31'
-    ullr = escape(fs.get('ullr', [''])[0]).replace(' ','_') 
-    if ullr == '':
-        ullr = '-180_90_180_-89.9'
-    zxy = escape(fs.get('zxy', [''])[0])
-    
-    if 'bgurl=' in querystring:
-        bgurl = escape(fs.get('bgurl', [''])[0]) 
-    else:
-        bgurl = '';
-            
-    
-    # If already a web tile format ({$z},{$x},{$y} are defined), generate kml for the top level tiles for the region defined by ullr in the querystring (if applicable)
-    if 'profile' in querystring:
-        profile = escape(fs.get('profile', [''])[0])
-    else:
-        if ('$z' in url) or ('$z' in bgurl):
-            profile = 'mercator'
-            querystring = querystring + '&profile=mercator;'
-        else:
-            profile = 'geodetic'
-            querystring = querystring + '&profile=geodetic;'
+    # Documents are reused for a short time, together with their compressed encodings
+    key = path + '?' + querystring
+    response = kml_cache.get(key)
+    if response is not None:
+        return send_response(start_response, response, encoding)
+
+    # Settings of the layer are compiled once, and reused by every request for it
+    layer, zxy = layer_registry.parse_request(querystring, path)
+    if layer is None:
+        response_body = 'Unknown layer'
+        start_response('404 Not Found', [('Content-Type', 'text/html'),
+                                         ('Content-Length', str(len(response_body)))])
+        return [response_body.encode('utf-8')]
+    profile = layer.profile
+    start = metrics.clock()
+
+    # The documents below link to the layer (and its tiles) by id
+    layer_registry.register_layer(layer)
         
-    if ('$z' in url) or ('WMS:BBOX' in url):
-        webTiles = 1
+    if layer.webTiles:
 
         # Bypass and enter the kml generation script if being called recursively
         if zxy != '':
-            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,zxy,webTiles,profile)
+            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,layer,zxy)
             kml = tile_kml.generate_tiles()
         else:
         # Else if called for the first time, append all children to root kml, and return the result
-            tminz, tmaxz = zoom.split('-')
-            ulx, uly, lrx, lry = ullr.split('_')
-            tminz = int(tminz)
-                
-            if profile == 'mercator':
-                tile_math = kml_for_tiles.GlobalMercator()
-                ominx, omaxy = tile_math.LatLonToMeters(float(uly),float(ulx))
-                omaxx, ominy = tile_math.LatLonToMeters(float(lry),float(lrx))
-                
-                # Generate table with min max tile coordinates for all zoomlevels
-                tminmax = list(range(0,32))
-                for tz in range(0, 32):
-                    tminx, tminy = tile_math.MetersToTile( ominx, ominy, tz )
-                    tmaxx, tmaxy = tile_math.MetersToTile( omaxx, omaxy, tz )
-                    # crop tiles extending world limits (+-180,+-90)
-                    tminx, tminy = max(0, tminx), max(0, tminy)
-                    tmaxx, tmaxy = min(2**tz-1, tmaxx), min(2**tz-1, tmaxy)
-                    tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
-                    
-            if profile == 'geodetic':
-                tile_math = kml_for_tiles.GlobalGeodetic() # from globalmaptiles.py
-                ominx, omaxy = float(ulx), float(uly)
-                omaxx, ominy = float(lrx), float(lry)
-
-                # Generate table with min max tile coordinates for all zoomlevels
-                tminmax = list(range(0,32))
-                for tz in range(0, 32):
-                    tminx, tminy = tile_math.LatLonToTile( ominx, ominy, tz )
-                    tmaxx, tmaxy = tile_math.LatLonToTile( omaxx, omaxy, tz )
-                    # crop tiles extending world limits (+-180,+-90)
-                    tminx, tminy = max(0, tminx), max(0, tminy)
-                    tmaxx, tmaxy = min(2**(tz+1)-1, tmaxx), min(2**tz-1, tmaxy)
-                    tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
+            tminz = layer.minzoom
                 
             #tminz = min(tminz,13)
-            children = []
-            xmin, ymin, xmax, ymax = tminmax[tminz]
-            for x in range(xmin, xmax+1):
-                for y in range(ymin, ymax+1):
-                    children.append( [ x, y, tminz ] ) 
-                    
-            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,'0/0/0',webTiles,profile)
+            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,layer,'0/0/0')
             # Generate Root KML
-            kml = tile_kml.generate_kml( None, None, None, children)
+            kml = tile_kml.generate_root(layer.tminmax, tminz)
 
     else:
     # Else, open the raster data source, and figure out its extents and appropriate top level zoom
 
-        webTiles = 0
-        checkStatus = False
-
         # Bypass and enter the kml generation script if being called recursively
         if zxy != '':
-            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,zxy,webTiles,profile)
+            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,layer,zxy)
             kml = tile_kml.generate_tiles()
         else:
-            # Else if called for the first time, get the raster extents (warping if necessary), and then generate root kml structure as above
+            # Else if called for the first time, get the raster extents (from the catalog, if the file is unchanged), and then generate root kml structure as above
             gdal.AllRegister()
-            
-            import tempfile
-            tempfilename = tempfile.mktemp('-TileOverlay.vrt')
-            
-            # In some cases, a special file should be used to open different maps with different zoom levels.  Here, only open the file for the largest zoom levels
-            if url.find('.pyr') >= 0:
-                file = open(url,'r')
-                zoom, raster_url = file.readline().split(',')
-                raster_url = raster_url.strip()
-                file.close()
-            else:
-                raster_url = url
-            
-            # Warp to WGS84 to ensure that dataset bounds are read correctly
-            command = 'gdalwarp -t_srs "+proj=latlong +datum=wgs84 +nodefs" -of vrt "' + raster_url + '" ' + tempfilename
-            subprocess.call(command, shell=True, stdout=open(os.devnull, 'wb'))
-            
-            ds = gdal.Open(tempfilename, GA_ReadOnly)
-            if ds is None:
-                print('Content-Type: text/html\n')
-                print('Could not open raster')
-                sys.exit(1)
-                
-            tilesize = 256
-            rows = ds.RasterYSize
-            cols = ds.RasterXSize
-            transform = ds.GetGeoTransform()
-            ulx = transform[0]
-            uly = transform[3]
-            pixelWidth = transform[1]
-            pixelHeight = transform[5]
-            lrx = ulx + (cols * pixelWidth)
-            lry = uly + (rows * pixelHeight)
-            
-            del ds
-            os.unlink(tempfilename)
 
-            uly = min(uly,89.9)
-            lry = max(lry,-89.9)
-            ulx = max(ulx,-180)
-            lrx - min(lrx,180)
+            entry = raster_catalog.catalog.lookup(layer.source_url)
+            if entry is None:
+                response_body = 'Could not open raster'
+                start_response('404 Not Found', [('Content-Type', 'text/html'),
+                                                 ('Content-Length', str(len(response_body)))])
+                return [response_body.encode('utf-8')]
 
-            ullr = str(ulx) + '_' + str(uly) + '_' + str(lrx) + '_' + str(lry)
-                
-            if profile == 'mercator':
-                tile_math = kml_for_tiles.GlobalMercator()
-                ominx, omaxy = tile_math.LatLonToMeters(float(uly),float(ulx))
-                omaxx, ominy = tile_math.LatLonToMeters(float(lry),float(lrx))
-                pixelWidth = (omaxx - ominx) / cols
-                
-                # Generate table with min max tile coordinates for all zoomlevels
-                tminmax = list(range(0,32))
-                for tz in range(0, 32):
-                    tminx, tminy = tile_math.MetersToTile( ominx, ominy, tz )
-                    tmaxx, tmaxy = tile_math.MetersToTile( omaxx, omaxy, tz )
-                    # crop tiles extending world limits (+-180,+-90)
-                    tminx, tminy = max(0, tminx), max(0, tminy)
-                    tmaxx, tmaxy = min(2**tz-1, tmaxx), min(2**tz-1, tmaxy)
-                    tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
-                    
-            if profile == 'geodetic':
-                tile_math = kml_for_tiles.GlobalGeodetic() # from globalmaptiles.py
-                ominx, omaxy = float(ulx), float(uly)
-                omaxx, ominy = float(lrx), float(lry)
+            ulx, uly, lrx, lry = raster_catalog.clamp_extent(entry['extent'])
+            tminmax = tile_math.tile_ranges(profile, ulx, uly, lrx, lry)
+            tminz = raster_catalog.catalog.top_zoom(entry, profile, layer.tilesize)
 
-                # Generate table with min max tile coordinates for all zoomlevels
-                tminmax = list(range(0,32))
-                for tz in range(0, 32):
-                    tminx, tminy = tile_math.LatLonToTile( ominx, ominy, tz )
-                    tmaxx, tmaxy = tile_math.LatLonToTile( omaxx, omaxy, tz )
-                    # crop tiles extending world limits (+-180,+-90)
-                    tminx, tminy = max(0, tminx), max(0, tminy)
-                    tmaxx, tmaxy = min(2**(tz+1)-1, tmaxx), min(2**tz-1, tmaxy)
-                    tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
-                
-            tminz = tile_math.ZoomForPixelSize( pixelWidth * max( cols, rows) / float(tilesize) )
-            
-            children = []
-            xmin, ymin, xmax, ymax = tminmax[tminz]
-            for x in range(xmin, xmax+1):
-                for y in range(ymin, ymax+1):
-                    children.append( [ x, y, tminz ] ) 
-                    
-            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,querystring,fs,'0/0/0',webTiles,profile)
+            tile_kml = kml_for_tiles.KMLForTiles(kmlscriptloc,tilescriptloc,transparentpng,layer,'0/0/0')
             # Generate Root KML
-            kml = tile_kml.generate_kml( None, None, None, children)
+            kml = tile_kml.generate_root(tminmax, tminz)
            
-    response_body = str(kml)
-    status = '200 OK'
-    response_headers = [('Content-Type', 'text/xml'),
-                  ('Content-Length', str(len(response_body)))]
-    try: 
-        start_response(status, response_headers)
-    except:
-        dummy = ''
+    metrics.stage_seconds.observe(metrics.clock() - start, 'kml_build')
 
-    (major,minor,micro,releaselevel,serial) = sys.version_info
-    if major == 2:
-        return [response_body]
-    elif major == 3:
-        return [response_body.encode('utf-8')]
+    # KMZ documents are zip files already, and are not compressed again
+    if layer.kmz:
+        response = kml_cache.put(key, kml_writer.kmz(kml.getvalue()), kml_writer.KMZ_CONTENT_TYPE, False)
+    else:
+        response = kml_cache.put(key, kml.getvalue(), 'text/xml')
+    return send_response(start_response, response, encoding)
     
 
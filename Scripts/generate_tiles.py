@@ -26,516 +26,294 @@
 #from wsgiref.simple_server import make_server
 
 import sys
-from cgi import parse_qs, escape
-import gdal, ogr, osr
+import gdal, osr
 import math
-import subprocess
-from PIL import Image, ImageMath
-import numpy
+from PIL import Image
 (major,minor,micro,releaselevel,serial) = sys.version_info
 if major == 2:
     from cStringIO import StringIO
 elif major == 3:
     from io import BytesIO
-    from urllib.request import urlopen
+    from urllib.error import HTTPError
 import os, sys
 import time
-import re
-import urllib
-import tempfile
-import zipfile
+import tile_probe
+import layer_registry
+import raster_catalog
+import response_cache
+import source_fetch
+import scheduler
+import metrics
+from source_fetch import Abandoned
+from keepalive import CLIENT_GONE
+from tile_math import GlobalMercator, GlobalGeodetic
 
 # sys.stderr = open(os.path.abspath(__file__).replace(os.path.basename(__file__),'') + 'logs/generate_tiles.txt', 'w')
 
 ###############################################################################
 
-__doc__globalmaptiles = """
-globalmaptiles.py
+# Polar limit of the Spherical Mercator source tiles
+MAXMERCATORLAT = 85.0511287798066
 
-Global Map Tiles as defined in Tile Map Service (TMS) Profiles
-==============================================================
+# GDAL warp algorithm of each resampling method (layer_registry.RESAMPLE_METHODS)
+RESAMPLE_ALGS = {'near': gdal.GRA_NearestNeighbour, 'bilinear': gdal.GRA_Bilinear, 'cubic': gdal.GRA_Cubic,
+                 'cubicspline': gdal.GRA_CubicSpline, 'lanczos': gdal.GRA_Lanczos, 'average': gdal.GRA_Average,
+                 'mode': gdal.GRA_Mode}
 
-Functions necessary for generation of global tiles used on the web.
-It contains classes implementing coordinate conversions for:
+# Largest number of source tiles stitched together for one output tile
+MAXMOSAICTILES = 16
 
-  - GlobalMercator (based on EPSG:900913 = EPSG:3785)
-       for Google Maps, Yahoo Maps, Bing Maps compatible tiles
-  - GlobalGeodetic (based on EPSG:4326)
-       for OpenLayers Base Map and Google Earth compatible tiles
+# Seconds that fetched source tiles are kept, and the memory they may take.  Neighbouring
+# (and geodetic, and larger) output tiles share source tiles
+SOURCE_CACHE_TTL = 300.0
+SOURCE_CACHEBYTES = 128 * 1024 * 1024
 
-More info at:
+# Seconds that rendered output tiles are kept, and the memory they may take
+TILE_CACHE_TTL = 300.0
+TILE_CACHEBYTES = 64 * 1024 * 1024
 
-http://wiki.osgeo.org/wiki/Tile_Map_Service_Specification
-http://wiki.osgeo.org/wiki/WMS_Tiling_Client_Recommendation
-http://msdn.microsoft.com/en-us/library/bb259689.aspx
-http://code.google.com/apis/maps/documentation/overlays.html#Google_Maps_Coordinates
+# Coarser levels searched for a cached tile to stand in for a tile that the server is too busy to render
+FALLBACK_LEVELS = 4
 
-Created by Klokan Petr Pridal on 2008-07-03.
-Google Summer of Code 2008, project KMLForTiles for OSGEO.
+# Shared by every request handled by this process (the kml and tile sides in the combined server)
+source_cache = response_cache.ResponseCache(SOURCE_CACHE_TTL, response_cache.CACHESIZE, SOURCE_CACHEBYTES, 'source')
+tile_cache = response_cache.ResponseCache(TILE_CACHE_TTL, response_cache.CACHESIZE, TILE_CACHEBYTES, 'tile')
+source_fetches = source_fetch.SourceFetches(source_cache)
 
-In case you use this class in your product, translate it to another language
-or find it usefull for your project please let me know.
-My email: klokan at klokan dot cz.
-I would like to know where it was used.
 
-Class is available under the open-source GDAL license (www.gdal.org).
-"""
-
-MAXZOOMLEVEL = 32
-
-class GlobalMercator(object):
-    """
-    TMS Global Mercator Profile
-    ---------------------------
-
-  Functions necessary for generation of tiles in Spherical Mercator projection,
-  EPSG:900913 (EPSG:gOOglE, Google Maps Global Mercator), EPSG:3785, OSGEO:41001.
-
-  Such tiles are compatible with Google Maps, Bing Maps, Yahoo Maps,
-  UK Ordnance Survey OpenSpace API, ...
-  and you can overlay them on top of base maps of those web mapping applications.
-
-    Pixel and tile coordinates are in TMS notation (origin [0,0] in bottom-left).
-
-    What coordinate conversions do we need for TMS Global Mercator tiles::
-
-         LatLon      <->       Meters      <->     Pixels    <->       Tile
-
-     WGS84 coordinates   Spherical Mercator  Pixels in pyramid  Tiles in pyramid
-         lat/lon            XY in metres     XY pixels Z zoom      XYZ from TMS
-        EPSG:4326           EPSG:900913
-         .----.              ---------               --                TMS
-        /      \     <->     |       |     <->     /----/    <->      Google
-        \      /             |       |           /--------/          QuadTree
-         -----               ---------         /------------/
-       KML, public         WebMapService         Web Clients      TileMapService
-
-    What is the coordinate extent of Earth in EPSG:900913?
-
-      [-20037508.342789244, -20037508.342789244, 20037508.342789244, 20037508.342789244]
-      Constant 20037508.342789244 comes from the circumference of the Earth in meters,
-      which is 40 thousand kilometers, the coordinate origin is in the middle of extent.
-      In fact you can calculate the constant as: 2 * math.pi * 6378137 / 2.0
-      $ echo 180 85 | gdaltransform -s_srs EPSG:4326 -t_srs EPSG:900913
-      Polar areas with abs(latitude) bigger then 85.05112878 are clipped off.
-
-    What are zoom level constants (pixels/meter) for pyramid with EPSG:900913?
-
-      whole region is on top of pyramid (zoom=0) covered by 256x256 pixels tile,
-      every lower zoom level resolution is always divided by two
-      initialResolution = 20037508.342789244 * 2 / 256 = 156543.03392804062
-
-    What is the difference between TMS and Google Maps/QuadTree tile name convention?
-
-      The tile raster itself is the same (equal extent, projection, pixel size),
-      there is just different identification of the same raster tile.
-      Tiles in TMS are counted from [0,0] in the bottom-left corner, id is XYZ.
-      Google placed the origin [0,0] to the top-left corner, reference is XYZ.
-      Microsoft is referencing tiles by a QuadTree name, defined on the website:
-      http://msdn2.microsoft.com/en-us/library/bb259689.aspx
-
-    The lat/lon coordinates are using WGS84 datum, yeh?
-
-      Yes, all lat/lon we are mentioning should use WGS84 Geodetic Datum.
-      Well, the web clients like Google Maps are projecting those coordinates by
-      Spherical Mercator, so in fact lat/lon coordinates on sphere are treated as if
-      the were on the WGS84 ellipsoid.
-
-      From MSDN documentation:
-      To simplify the calculations, we use the spherical form of projection, not
-      the ellipsoidal form. Since the projection is used only for map display,
-      and not for displaying numeric coordinates, we don't need the extra precision
-      of an ellipsoidal projection. The spherical projection causes approximately
-      0.33 percent scale distortion in the Y direction, which is not visually noticable.
-
-    How do I create a raster in EPSG:900913 and convert coordinates with PROJ.4?
-
-      You can use standard GIS tools like gdalwarp, cs2cs or gdaltransform.
-      All of the tools supports -t_srs 'epsg:900913'.
-
-      For other GIS programs check the exact definition of the projection:
-      More info at http://spatialreference.org/ref/user/google-projection/
-      The same projection is degined as EPSG:3785. WKT definition is in the official
-      EPSG database.
-
-      Proj4 Text:
-        +proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0
-        +k=1.0 +units=m +nadgrids=@null +no_defs
-
-      Human readable WKT format of EPGS:900913:
-         PROJCS["Google Maps Global Mercator",
-             GEOGCS["WGS 84",
-                 DATUM["WGS_1984",
-                     SPHEROID["WGS 84",6378137,298.257223563,
-                         AUTHORITY["EPSG","7030"]],
-                     AUTHORITY["EPSG","6326"]],
-                 PRIMEM["Greenwich",0],
-                 UNIT["degree",0.0174532925199433],
-                 AUTHORITY["EPSG","4326"]],
-             PROJECTION["Mercator_1SP"],
-             PARAMETER["central_meridian",0],
-             PARAMETER["scale_factor",1],
-             PARAMETER["false_easting",0],
-             PARAMETER["false_northing",0],
-             UNIT["metre",1,
-                 AUTHORITY["EPSG","9001"]]]
-    """
-
-    def __init__(self, tileSize=256):
-        "Initialize the TMS Global Mercator pyramid"
-        self.tileSize = tileSize
-        self.initialResolution = 2 * math.pi * 6378137 / self.tileSize
-        # 156543.03392804062 for tileSize 256 pixels
-        self.originShift = 2 * math.pi * 6378137 / 2.0
-        # 20037508.342789244
-
-    def LatLonToMeters(self, lat, lon ):
-        "Converts given lat/lon in WGS84 Datum to XY in Spherical Mercator EPSG:900913"
-
-        mx = lon * self.originShift / 180.0
-        my = math.log( math.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
-
-        my = my * self.originShift / 180.0
-        return mx, my
-
-    def MetersToLatLon(self, mx, my ):
-        "Converts XY point from Spherical Mercator EPSG:900913 to lat/lon in WGS84 Datum"
-
-        lon = (mx / self.originShift) * 180.0
-        lat = (my / self.originShift) * 180.0
-
-        lat = 180 / math.pi * (2 * math.atan( math.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
-        return lat, lon
-
-    def PixelsToMeters(self, px, py, zoom):
-        "Converts pixel coordinates in given zoom level of pyramid to EPSG:900913"
-
-        res = self.Resolution( zoom )
-        mx = px * res - self.originShift
-        my = py * res - self.originShift
-        return mx, my
-
-    def MetersToPixels(self, mx, my, zoom):
-        "Converts EPSG:900913 to pyramid pixel coordinates in given zoom level"
-
-        res = self.Resolution( zoom )
-        px = (mx + self.originShift) / res
-        py = (my + self.originShift) / res
-        return px, py
-
-    def PixelsToTile(self, px, py):
-        "Returns a tile covering region in given pixel coordinates"
-
-        tx = int( math.ceil( px / float(self.tileSize) ) - 1 )
-        ty = int( math.ceil( py / float(self.tileSize) ) - 1 )
-        return tx, ty
-
-    def PixelsToRaster(self, px, py, zoom):
-        "Move the origin of pixel coordinates to top-left corner"
-
-        mapSize = self.tileSize << zoom
-        return px, mapSize - py
-
-    def MetersToTile(self, mx, my, zoom):
-        "Returns tile for given mercator coordinates"
-
-        px, py = self.MetersToPixels( mx, my, zoom)
-        return self.PixelsToTile( px, py)
-
-    def TileBounds(self, tx, ty, zoom):
-        "Returns bounds of the given tile in EPSG:900913 coordinates"
-
-        minx, miny = self.PixelsToMeters( tx*self.tileSize, ty*self.tileSize, zoom )
-        maxx, maxy = self.PixelsToMeters( (tx+1)*self.tileSize, (ty+1)*self.tileSize, zoom )
-        return ( minx, miny, maxx, maxy )
-
-    def TileLatLonBounds(self, tx, ty, zoom ):
-        "Returns bounds of the given tile in latutude/longitude using WGS84 datum"
-
-        bounds = self.TileBounds( tx, ty, zoom)
-        minLat, minLon = self.MetersToLatLon(bounds[0], bounds[1])
-        maxLat, maxLon = self.MetersToLatLon(bounds[2], bounds[3])
-
-        return ( minLat, minLon, maxLat, maxLon )
-
-    def Resolution(self, zoom ):
-        "Resolution (meters/pixel) for given zoom level (measured at Equator)"
-
-        # return (2 * math.pi * 6378137) / (self.tileSize * 2**zoom)
-        return self.initialResolution / (2**zoom)
-
-    def ZoomForPixelSize(self, pixelSize ):
-        "Maximal scaledown zoom of the pyramid closest to the pixelSize."
-
-        for i in range(MAXZOOMLEVEL):
-            if pixelSize > self.Resolution(i):
-                if i!=0:
-                    return i-1
-                else:
-                    return 0 # We don't want to scale up
-
-    def GoogleTile(self, tx, ty, zoom):
-        "Converts TMS tile coordinates to Google Tile coordinates"
-
-        # coordinate origin is moved from bottom-left to top-left corner of the extent
-        return tx, (2**zoom - 1) - ty
-
-    def QuadTree(self, tx, ty, zoom ):
-        "Converts TMS tile coordinates to Microsoft QuadTree"
-
-        quadKey = ""
-        ty = (2**zoom - 1) - ty
-        for i in range(zoom, 0, -1):
-            digit = 0
-            mask = 1 << (i-1)
-            if (tx & mask) != 0:
-                digit += 1
-            if (ty & mask) != 0:
-                digit += 2
-            quadKey += str(digit)
-
-        return quadKey
-
-###############################################################################
-
-class GlobalGeodetic(object):
-    """
-    TMS Global Geodetic Profile
-    ---------------------------
-
-    Functions necessary for generation of global tiles in Plate Carre projection,
-    EPSG:4326, "unprojected profile".
-
-    Such tiles are compatible with Google Earth (as any other EPSG:4326 rasters)
-    and you can overlay the tiles on top of OpenLayers base map.
-
-    Pixel and tile coordinates are in TMS notation (origin [0,0] in bottom-left).
-
-    What coordinate conversions do we need for TMS Global Geodetic tiles?
-
-      Global Geodetic tiles are using geodetic coordinates (latitude,longitude)
-      directly as planar coordinates XY (it is also called Unprojected or Plate
-      Carre). We need only scaling to pixel pyramid and cutting to tiles.
-      Pyramid has on top level two tiles, so it is not square but rectangle.
-      Area [-180,-90,180,90] is scaled to 512x256 pixels.
-      TMS has coordinate origin (for pixels and tiles) in bottom-left corner.
-      Rasters are in EPSG:4326 and therefore are compatible with Google Earth.
-
-         LatLon      <->      Pixels      <->     Tiles     
-
-     WGS84 coordinates   Pixels in pyramid  Tiles in pyramid
-         lat/lon         XY pixels Z zoom      XYZ from TMS 
-        EPSG:4326                                           
-         .----.                ----                         
-        /      \     <->    /--------/    <->      TMS      
-        \      /         /--------------/                   
-         -----        /--------------------/                
-       WMS, KML    Web Clients, Google Earth  TileMapService
-    """
-
-    def __init__(self, tileSize = 256):
-        self.tileSize = tileSize
-
-    def LatLonToPixels(self, lat, lon, zoom):
-        "Converts lat/lon to pixel coordinates in given zoom of the EPSG:4326 pyramid"
-
-        res = 180.0 / self.tileSize / 2**zoom
-        px = (180 + lat) / res
-        py = (90 + lon) / res
-        return px, py
-
-    def PixelsToTile(self, px, py):
-        "Returns coordinates of the tile covering region in pixel coordinates"
-
-        tx = int( math.ceil( px / float(self.tileSize) ) - 1 )
-        ty = int( math.ceil( py / float(self.tileSize) ) - 1 )
-        return tx, ty
+class GenerateDynamicTiles(object):
 
-    def LatLonToTile(self, lat, lon, zoom):
-        "Returns the tile for zoom which covers given lat/lon coordinates"
+    # -------------------------------------------------------------------------
+    def arrayToImage(self,a):
+        """
+        Converts a gdalnumeric array to a 
+        Python Imaging Library Image.
+        """
+        #i=Image.frombytes('L',(a.shape[1],a.shape[0]),
+        #    (a.astype('b')).tostring())
+        i = Image.fromarray(a)
+        return i
 
-        px, py = self.LatLonToPixels( lat, lon, zoom)
-        return self.PixelsToTile(px,py)
+    def __init__(self,layer,zxy,client_gone=None):
+        """Constructor function - initialization"""
 
-    def Resolution(self, zoom ):
-        "Resolution (arc/pixel) for given zoom level (measured at Equator)"
+        # Settings of the layer, compiled once from its query string (without zxy)
+        self.layer = layer
+        self.tilesize = layer.tilesize
+        self.levels = layer.levels
+        self.tileext = 'png'
+        
+        # Number of source tiles that upstream reported as missing, and that could not be
+        # fetched for other reasons (timeouts, server errors)
+        self.missing = 0
+        self.failed = 0
+
+        # False once generate_tiles() has returned a tile with holes (or a blank one) because
+        # of a failure that may not happen again, so that the tile is not cached
+        self.cacheable = True
+        
+        self.url = layer.tile_url
+        self.zxy = zxy or '0/0/0'
+        self.tz, self.tx, self.ty = self.zxy.strip('/').split('/')
+        self.cachedir = layer.cachedir
+        self.resample = layer.resample
+        self.maxzoom = layer.source_maxzoom
+            
+        # Output tile grid.  Source tiles are always Spherical Mercator; 'geodetic'
+        # tiles are mosaicked from the Mercator tiles that cover them
+        self.profile = layer.profile
+        self.proj = 'geo'
+        
+        # Probed layers record tiles without any source data in the availability index
+        self.index = layer.index
+        
+        # Tells whether the client has gone away (Google Earth drops tiles that are out of view)
+        self.client_gone = client_gone or (lambda: False)
+        
+    # -------------------------------------------------------------------------
+    def check(self, stage):
+        """Stop working on the tile if its client has gone away"""
 
-        return 180.0 / self.tileSize / 2**zoom
-        #return 180 / float( 1 << (8+zoom) )
+        if self.client_gone():
+            raise Abandoned(stage)
+        
+    # -------------------------------------------------------------------------
+    def fetch_image(self, url):
+        """Fetch a source tile and return it as an RGBA image (None on failure)"""
 
-    def ZoomForPixelSize(self, pixelSize ):
-        "Maximal scaledown zoom of the pyramid closest to the pixelSize."
+        try:
+            cached = source_cache.get(url)
+            if cached is not None:
+                data = cached.encoded('identity')[1]
+            else:
+                data = source_fetches.get(url, self.client_gone)
+            if major == 2:
+                f = StringIO(data)
+            elif major == 3:
+                f = BytesIO(data)
+            with metrics.stage_seconds.time('decode'):
+                return Image.open(f).convert('RGBA')
+        except Abandoned:
+            raise
+        except Exception as e:
+            if major == 3 and isinstance(e, HTTPError) and e.code in tile_probe.MISSING_STATUS:
+                self.missing += 1
+            else:
+                self.failed += 1
+                self.cacheable = False
+            return None
 
-        for i in range(MAXZOOMLEVEL):
-            if pixelSize > self.Resolution(i):
-                if i!=0:
-                    return i-1
-                else:
-                    return 0 # We don't want to scale up
+    # -------------------------------------------------------------------------
+    def dataset_to_image(self, ds):
+        """Read the bands of a (warped) dataset into a PIL image"""
 
-    def TileBounds(self, tx, ty, zoom):
-        "Returns bounds of the given tile"
-        res = 180.0 / self.tileSize / 2**zoom
-        return (
-            tx*self.tileSize*res - 180,
-            ty*self.tileSize*res - 90,
-            (tx+1)*self.tileSize*res - 180,
-            (ty+1)*self.tileSize*res - 90
-        )
+        nb = ds.RasterCount
+        if nb == 1:
+            im = self.arrayToImage(ds.GetRasterBand(1).ReadAsArray())
+        elif nb == 2:
+            l = self.arrayToImage(ds.GetRasterBand(1).ReadAsArray())
+            a = self.arrayToImage(ds.GetRasterBand(2).ReadAsArray())
+            im = Image.merge("LA", (l,a)).convert('RGBA')
+        elif nb == 3:
+            r = self.arrayToImage(ds.GetRasterBand(1).ReadAsArray())
+            g = self.arrayToImage(ds.GetRasterBand(2).ReadAsArray())
+            b = self.arrayToImage(ds.GetRasterBand(3).ReadAsArray())
+            im = Image.merge("RGB", (r,g,b))
+        elif nb == 4:
+            r = self.arrayToImage(ds.GetRasterBand(1).ReadAsArray())
+            g = self.arrayToImage(ds.GetRasterBand(2).ReadAsArray())
+            b = self.arrayToImage(ds.GetRasterBand(3).ReadAsArray())
+            a = self.arrayToImage(ds.GetRasterBand(4).ReadAsArray())
+            im = Image.merge("RGBA", (r,g,b,a))
+        else:
+            raise ValueError('Images must have 1, 2, 3, or 4 bands, not %d' % nb)
+        return im
 
-    def TileLatLonBounds(self, tx, ty, zoom):
-        "Returns bounds of the given tile in the SWNE form"
-        b = self.TileBounds(tx, ty, zoom)
-        return (b[1],b[0],b[3],b[2])
+    # -------------------------------------------------------------------------
+    def covering_tiles(self, south, west, north, east, mz):
+        """
+        Range of Mercator source tiles (zoom, minx, miny, maxx, maxy) covering a 
+        lat/lon box, dropping to a coarser zoom if too many tiles would be needed 
+        (None if the box lies outside of the Mercator limits)
+        """
 
-###############################################################################
+        north = min(north, MAXMERCATORLAT)
+        south = max(south, -MAXMERCATORLAT)
+        if north <= south:
+            return None
+
+        mercator = GlobalMercator()
+        tilesize = mercator.tileSize
+        maxtiles = MAXMOSAICTILES * (self.tilesize // tilesize)**2
+
+        mminx, mminy = mercator.LatLonToMeters(south, west)
+        mmaxx, mmaxy = mercator.LatLonToMeters(north, east)
+        while True:
+            pminx, pminy = mercator.MetersToPixels(mminx, mminy, mz)
+            pmaxx, pmaxy = mercator.MetersToPixels(mmaxx, mmaxy, mz)
+            txmin = max(0, int(math.floor(pminx / tilesize)))
+            tymin = max(0, int(math.floor(pminy / tilesize)))
+            txmax = min(2**mz - 1, int(math.ceil(pmaxx / tilesize)) - 1)
+            tymax = min(2**mz - 1, int(math.ceil(pmaxy / tilesize)) - 1)
+            ntiles = (txmax - txmin + 1) * (tymax - tymin + 1)
+            if ntiles <= maxtiles or mz == 0:
+                return mz, txmin, tymin, txmax, tymax
+            mz = mz - 1
 
+    # -------------------------------------------------------------------------
+    def mercator_mosaic(self, mz, txmin, tymin, txmax, tymax):
+        """
+        Fetch a range of Mercator source tiles and stitch them into one image.  
+        Returns the image and its bounds in EPSG:900913 (or None if no source 
+        tile could be fetched)
+        """
 
-class GenerateDynamicTiles(object):
+        mercator = GlobalMercator()
+        tilesize = mercator.tileSize
+
+        mosaic = Image.new('RGBA', ((txmax - txmin + 1) * tilesize, (tymax - tymin + 1) * tilesize))
+        found = False
+        tiles = [(x, y, mz) for y in range(tymin, tymax + 1) for x in range(txmin, txmax + 1)]
+        # The server part is picked by tile position, so that cached source tiles are found again
+        urls = self.layer.source_template.render_many(tiles, self.layer.serverpart_list)
+        remaining = len(tiles)
+        for (x, y, _), url in zip(tiles, urls):
+            try:
+                self.check('fetching')
+                im = self.fetch_image(url)
+            except Abandoned:
+                # Source tiles fetched so far stay in the cache for the next view
+                source_fetch.work.add(remaining, 'source_tiles_skipped')
+                raise
+            remaining -= 1
+            if im is None:
+                continue
+            if im.size != (tilesize, tilesize):
+                im = im.resize((tilesize, tilesize))
+            # TMS rows count up from the bottom, image rows from the top
+            mosaic.paste(im, ((x - txmin) * tilesize, (tymax - y) * tilesize))
+            found = True
+
+        if not found:
+            return None
+
+        minx, miny, _, _ = mercator.TileBounds(txmin, tymin, mz)
+        _, _, maxx, maxy = mercator.TileBounds(txmax, tymax, mz)
+        return mosaic, (minx, miny, maxx, maxy)
 
-    def geo_query(self, ds, ulx, uly, lrx, lry, querysize = 0):
-        """For given dataset and query in cartographic coordinates
-        returns parameters for ReadRaster() in raster coordinates and
-        x/y shifts (for border tiles). If the querysize is not given, the
-        extent is returned in the native resolution of dataset ds."""
+    # -------------------------------------------------------------------------
+    def warp_mosaic(self, mosaic, bounds, south, west, north, east, s_srs, t_srs):
+        """Warp a Mercator mosaic into an output tile covering the given lat/lon box"""
 
-        geotran = ds.GetGeoTransform()
-        rx= int((ulx - geotran[0]) / geotran[1] + 0.001)
-        ry= int((uly - geotran[3]) / geotran[5] + 0.001)
-        rxsize= int((lrx - ulx) / geotran[1] + 0.5)
-        rysize= int((lry - uly) / geotran[5] + 0.5)
+        minx, miny, maxx, maxy = bounds
 
-        if not querysize:
-            wxsize, wysize = rxsize, rysize
-        else:
-            wxsize, wysize = querysize, querysize
-
-        # Coordinates should not go out of the bounds of the raster
-        wx = 0
-        if rx < 0:
-            rxshift = abs(rx)
-            wx = int( wxsize * (float(rxshift) / rxsize) )
-            wxsize = wxsize - wx
-            rxsize = rxsize - int( rxsize * (float(rxshift) / rxsize) )
-            rx = 0
-        if rx+rxsize > ds.RasterXSize:
-            wxsize = int( wxsize * (float(ds.RasterXSize - rx) / rxsize) )
-            rxsize = ds.RasterXSize - rx
-
-        wy = 0
-        if ry < 0:
-            ryshift = abs(ry)
-            wy = int( wysize * (float(ryshift) / rysize) )
-            wysize = wysize - wy
-            rysize = rysize - int( rysize * (float(ryshift) / rysize) )
-            ry = 0
-        if ry+rysize > ds.RasterYSize:
-            wysize = int( wysize * (float(ds.RasterYSize - ry) / rysize) )
-            rysize = ds.RasterYSize - ry
-
-        return (rx, ry, rxsize, rysize), (wx, wy, wxsize, wysize)
+        if major == 2:
+            f = StringIO()
+        elif major == 3:
+            f = BytesIO()
+        mosaic.save(f, "PNG")
+        memname = '/vsimem/mosaic_%d_%s_%s_%s.png' % (id(self), self.tz, self.tx, self.ty)
+        gdal.FileFromMemBuffer(memname, f.getvalue())
+        src_ds = gdal.Open(memname)
 
-    # -------------------------------------------------------------------------
-    def scale_query_to_tile(self, dsquery, dstile, tilefilename=''):
-        """Scales down query dataset to the tile dataset"""
-
-        querysize = dsquery.RasterXSize
-        tilesize = dstile.RasterXSize
-        tilebands = dstile.RasterCount
-
-        if self.resample == 'average':
-
-            # Function: gdal.RegenerateOverview()
-            for i in range(1,tilebands+1):
-                # Black border around NODATA
-                #if i != 4:
-                #   dsquery.GetRasterBand(i).SetNoDataValue(0)
-                res = gdal.RegenerateOverview( dsquery.GetRasterBand(i),
-                    dstile.GetRasterBand(i), 'average' )
-                if res != 0:
-                    self.error("RegenerateOverview() failed on %s, error %d" % (tilefilename, res))
-
-        elif self.resample == 'antialias':
-
-            # Scaling by PIL (Python Imaging Library) - improved Lanczos
-            array = numpy.zeros((querysize, querysize, tilebands), numpy.uint8)
-            for i in range(tilebands):
-                array[:,:,i] = gdalarray.BandReadAsArray(dsquery.GetRasterBand(i+1), 0, 0, querysize, querysize)
-            im = Image.fromarray(array, 'RGBA') # Always four bands
-            im1 = im.resize((tilesize,tilesize), Image.ANTIALIAS)
-            if os.path.exists(tilefilename):
-                im0 = Image.open(tilefilename)
-                im1 = Image.composite(im1, im0, im1) 
-            im1.save(tilefilename,self.tiledriver)
+        src_srs = osr.SpatialReference()
+        src_srs.ImportFromProj4(s_srs)
+        src_wkt = src_srs.ExportToWkt()
+        dst_srs = osr.SpatialReference()
+        dst_srs.ImportFromProj4(t_srs)
+        dst_wkt = dst_srs.ExportToWkt()
 
-        else:
+        src_ds.SetGeoTransform([minx, (maxx-minx)/src_ds.RasterXSize, 0, maxy, 0, (miny-maxy)/src_ds.RasterYSize])
+        src_ds.SetProjection(src_wkt)
 
-            # Other algorithms are implemented by gdal.ReprojectImage().
-            dsquery.SetGeoTransform( (0.0, tilesize / float(querysize), 0.0, 0.0, 0.0, tilesize / float(querysize)) )
-            dstile.SetGeoTransform( (0.0, 1.0, 0.0, 0.0, 0.0, 1.0) )
+        dst_ds = gdal.GetDriverByName('MEM').Create('', self.tilesize, self.tilesize, 4, gdal.GDT_Byte)
+        dst_ds.SetGeoTransform([west, (east-west)/self.tilesize, 0, north, 0, (south-north)/self.tilesize])
+        dst_ds.SetProjection(dst_wkt)
+        gdal.ReprojectImage(src_ds, dst_ds, src_wkt, dst_wkt, self.ResampleAlg)
 
-            res = gdal.ReprojectImage(dsquery, dstile, None, None, self.ResampleAlg)
-            if res != 0:
-                self.error("ReprojectImage() failed on %s, error %d" % (tilefilename, res))
-                
-    # -------------------------------------------------------------------------
-    def error(self, msg, details = "" ):
-        """Print an error message and stop the processing"""
+        im = self.dataset_to_image(dst_ds)
 
-        if details:
-            self.parser.error(msg + "\n\n" + details)
-        else:
-            self.parser.error(msg)
-      
+        del(src_ds)
+        del(dst_ds)
+        gdal.Unlink(memname)
+        return im
 
     # -------------------------------------------------------------------------
-    def arrayToImage(self,a):
+    def warp_local(self, paths, south, west, north, east, t_srs):
         """
-        Converts a gdalnumeric array to a 
-        Python Imaging Library Image.
+        Warp the local datasets covering a lat/lon box into an output tile (GDAL picks
+        the overview level that matches the tile's resolution)
         """
-        #i=Image.frombytes('L',(a.shape[1],a.shape[0]),
-        #    (a.astype('b')).tostring())
-        i = Image.fromarray(a)
-        return i
-
-    def __init__(self,querystring,fs):
-        """Constructor function - initialization"""
 
-        self.tilesize = 256
-        self.tileext = 'png'
-        
-        # Get the arguments from the query string
-        if major == 2:
-            self.url = urllib.unquote(fs.get('url', [''])[0]).decode('utf8')
-        elif major == 3:
-            self.url = urllib.parse.unquote(fs.get('url', [''])[0])
+        ds = gdal.Warp('', paths, format='MEM', outputBounds=(west, south, east, north),
+                       width=self.tilesize, height=self.tilesize, dstSRS=t_srs,
+                       dstAlpha=True, resampleAlg=self.ResampleAlg)
+        if ds is None:
+            return None
+        im = self.dataset_to_image(ds)
+        del(ds)
+        return im
 
-        if 'zxy=' in querystring:
-            self.zxy = escape(fs.get('zxy', [''])[0])
-        else:
-            self.zxy = '0/0/0'
-            
-        self.tz, self.tx, self.ty = self.zxy.strip('/').split('/')
-         
-        if 'cachedir' in querystring:
-            self.cachedir = escape(fs.get('cachedir', [''])[0])
-        else:
-            self.cachedir = ''
-            
-        if 'resample' in querystring:
-            self.resample = escape(fs.get('resample', [''])[0])
-        else:
-            self.resample = 'near'
-            
-        if self.url.find('invY') > -1:
-            self.invert_y = True
-        else:
-            self.invert_y = False
-            
-        self.profile = 'mercator'
-        self.proj = 'geo'
-        
     # -------------------------------------------------------------------------
     def generate_tiles(self):
         """
@@ -544,148 +322,194 @@ class GenerateDynamicTiles(object):
         """ 
 
         # print('Content-Type: text/html\n')
-        start = time.time()
         
         tz = int(self.tz)
         tx = int(self.tx)
         ty = int(self.ty)
         
-        # In case of inverted y coordinate
-        if self.invert_y:
-            ty2 = ty
+        if self.tilesize != 256:
+            cachedir = os.path.join(self.cachedir, str(self.tilesize))
         else:
-            if type(ty) is int:
-                ty2 = (2**tz)-ty-1
-            else:
-                ty2 = ty
-        
-        tilefilename = os.path.join(self.cachedir, str(tz), str(tx), "%s.%s" % (ty, self.tileext))
+            cachedir = self.cachedir
+        tilefilename = os.path.join(cachedir, str(tz), str(tx), "%s.%s" % (ty, self.tileext))
         
         # Tile name used if tile is cached
         if self.cachedir != '':
-            if os.path.exists(tilefilename):
-                im = Image.open(tilefilename)
+            with metrics.stage_seconds.time('cache_lookup'):
+                if os.path.exists(tilefilename):
+                    metrics.cache_requests.inc('disk', 'hit')
+                    im = Image.open(tilefilename)
+                    if major == 2:
+                        f = StringIO()
+                    elif major == 3:
+                        f = BytesIO()
+                    im.save(f, "PNG")
+                    f.seek(0)
+                    return f.read()
+            metrics.cache_requests.inc('disk', 'miss')
+
+        self.check('before_render')
+        
+        if self.proj == 'geo':
+            s_srs = "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs"
+            t_srs = "+proj=latlong +datum=wgs84 +no_defs"
+        
+        self.ResampleAlg = RESAMPLE_ALGS[self.resample]
+
+        if not self.layer.webTiles:
+            # Local datasets (a file, a .pyr file or a scanned directory) are found through the raster catalog
+            if self.profile == 'geodetic':
+                south, west, north, east = GlobalGeodetic().TileLatLonBounds(tx, ty, tz)
+            else:
+                south, west, north, east = GlobalMercator().TileLatLonBounds(tx, ty, tz)
+            paths = raster_catalog.catalog.covering(self.layer.source_url, south, west, north, east, tz)
+            im = None
+            if paths:
+                self.check('before_warp')
+                with metrics.stage_seconds.time('warp'):
+                    im = self.warp_local(paths, south, west, north, east, t_srs)
+                if im is None:
+                    self.cacheable = False
+            if im is None:
+                im = Image.new('RGBA',(self.tilesize, self.tilesize))
+        else:
+            # Source tiles are composited from self.levels zoom levels below the output tile
+            # (2x2 source tiles for 512 pixel output tiles, 4x4 for 1024 pixel tiles, ...)
+            if self.profile == 'geodetic':
+                # A geodetic tile at zoom z has the equatorial resolution of a Mercator tile at z+1
+                south, west, north, east = GlobalGeodetic().TileLatLonBounds(tx, ty, tz)
+                tiles = self.covering_tiles(south, west, north, east, min(tz + 1 + self.levels, self.maxzoom))
+            else:
+                south, west, north, east = GlobalMercator().TileLatLonBounds(tx, ty, tz)
+                n = 2**self.levels
+                tiles = (tz + self.levels, tx*n, ty*n, (tx+1)*n - 1, (ty+1)*n - 1)
+
+            if tiles is not None:
+                result = self.mercator_mosaic(*tiles)
+                ntiles = (tiles[3] - tiles[1] + 1) * (tiles[4] - tiles[2] + 1)
+            else:
+                result = None
+                ntiles = 0
+            if result is None:
+                if self.index is not None and self.missing == ntiles:
+                    self.index.mark_empty(tx, ty, tz)
+                im = Image.new('RGBA',(self.tilesize, self.tilesize))
                 if major == 2:
-                    f = StringIO()
+                    f =StringIO()
                 elif major == 3:
-                    f = BytesIO()
+                    f =BytesIO()
                 im.save(f, "PNG")
                 f.seek(0)
                 return f.read()
+            mosaic, bounds = result
 
-        print('Getting Raster ' + str(time.time() - start) + ' s')
-        
-        if self.proj == 'geo':
-            s_srs = "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs"
-            t_srs = "+proj=latlong +datum=wgs84 +no_defs"
-        
-        if self.resample == 'near':
-            self.ResampleAlg = gdal.GRA_NearestNeighbour
-        elif self.resample == 'bilinear':
-            self.ResampleAlg = gdal.GRA_Bilinear
-            
-        if self.profile == 'mercator':
-            self.mercator = GlobalMercator()
-            self.tileswne = self.mercator.TileLatLonBounds
-            self.tilewsen_merc = self.mercator.TileBounds
-            south, west, north, east = self.tileswne(tx, ty, tz)
-            w, s, e, n = self.tilewsen_merc(tx, ty, tz)
+            # Once warped, the tile is finished and cached even if its client has gone
+            self.check('before_warp')
+            with metrics.stage_seconds.time('warp'):
+                im = self.warp_mosaic(mosaic, bounds, south, west, north, east, s_srs, t_srs)
             
-        raster_url = self.url
-        raster_url = raster_url.replace('{$x}', str(tx))
-        raster_url = raster_url.replace('{$y}', str(ty2))
-        raster_url = raster_url.replace('{$invY}', str(ty2))
-        raster_url = raster_url.replace('{$z}', str(tz))
-        
-        try:
-            if major == 2:
-                f = StringIO(urllib.urlopen(raster_url).read())
-            elif major == 3:
-                f = BytesIO(urlopen(raster_url).read())
-            im = Image.open(f).convert('RGBA') 
+        with metrics.stage_seconds.time('encode'):
             if major == 2:
                 f = StringIO()
             elif major == 3:
                 f = BytesIO()
-            
             im.save(f, "PNG")
-            f.seek(0)
-        except:
-            im = Image.new('RGBA',(100, 100))
-            if major == 2:
-                f =StringIO()
-            elif major == 3:
-                f =BytesIO()
-            im.save(f, "PNG")
-            f.seek(0)
-            return f.read()
-             
-        content = f.read()
-        gdal.FileFromMemBuffer('/vsimem/inmem', content)
-        src_ds = gdal.Open('/vsimem/inmem')
-        src_srs = osr.SpatialReference()
-        src_srs.ImportFromProj4(s_srs)
-        src_wkt = src_srs.ExportToWkt()  
-        dst_srs = osr.SpatialReference()
-        dst_srs.ImportFromProj4(t_srs)
-        dst_wkt = dst_srs.ExportToWkt()   
-
-        nx = src_ds.RasterXSize
-        ny = src_ds.RasterYSize
-        nb = src_ds.RasterCount
-       
-        gt = [w, (e-w)/nx, 0, n, 0, (s-n)/ny]
-        src_ds.SetGeoTransform(gt)
-        reproj_ds = gdal.AutoCreateWarpedVRT(src_ds, src_wkt, dst_wkt,self.ResampleAlg,0)
-        
-        if nb == 1:
-            im = self.arrayToImage(reproj_ds.GetRasterBand(1).ReadAsArray())
-        elif nb == 3:
-            r = self.arrayToImage(reproj_ds.GetRasterBand(1).ReadAsArray())
-            g = self.arrayToImage(reproj_ds.GetRasterBand(2).ReadAsArray())
-            b = self.arrayToImage(reproj_ds.GetRasterBand(3).ReadAsArray())
-            im = Image.merge("RGB", (r,g,b))
-        elif nb == 4:
-            r = self.arrayToImage(reproj_ds.GetRasterBand(1).ReadAsArray())
-            g = self.arrayToImage(reproj_ds.GetRasterBand(2).ReadAsArray())
-            b = self.arrayToImage(reproj_ds.GetRasterBand(3).ReadAsArray())
-            a = self.arrayToImage(reproj_ds.GetRasterBand(4).ReadAsArray())
-            im = Image.merge("RGBA", (r,g,b,a))
-        else:
-            error('Images must have 1, 3, or 4 bands')
-            
-        if major == 2:
-            f = StringIO()
-        elif major == 3:
-            f = BytesIO()
-        im.save(f, "PNG")
-        
-        print('Saving image ' + str(time.time()-start) + ' s')
                 
         # If specified, save a copy of the cached image  
-        if self.cachedir != '':
-            print('Saving copy ' + str(time.time()-start) + ' s')
-            if not os.path.exists(os.path.dirname(tilefilename)):
-                os.makedirs(os.path.dirname(tilefilename))
-            im.save(tilefilename, "PNG")
-          
-        gdal.Unlink('/vsimem/tiffinmem')
-        del(src_ds)
-        del(reproj_ds)
+        if self.cachedir != '' and self.cacheable:
+            with metrics.stage_seconds.time('cache_write'):
+                if not os.path.exists(os.path.dirname(tilefilename)):
+                    os.makedirs(os.path.dirname(tilefilename))
+                im.save(tilefilename, "PNG")
         
         f.seek(0)
         return f.read()
             
+
 ###############################################################################
 
+def tile_rank(path, querystring):
+    """Scheduling rank of a tile request: coarse tiles before fine ones (None if unknown)"""
+
+    if path.startswith('/l/'):
+        parts = path[3:].strip('/').split('/')
+        if len(parts) == 4 and parts[1].isdigit():
+            return scheduler.TILE_RANK + int(parts[1])
+        return None
+    zxy = layer_registry.split_zxy(querystring)[1].strip('/')
+    if zxy and zxy.split('/')[0].isdigit():
+        return scheduler.TILE_RANK + int(zxy.split('/')[0])
+    return None
+
+def tile_key(layer, tz, tx, ty):
+    return '%s/%d/%d/%d' % (layer.id, tz, tx, ty)
+
+def fallback_tile(path, querystring):
+    """
+    A tile cut from the nearest cached ancestor, for requests that the server is
+    too busy to render (None if no ancestor is cached).  Returns (content type, body)
+    """
+
+    layer, zxy = layer_registry.parse_request(querystring, path)
+    if layer is None or not zxy:
+        return None
+    tz, tx, ty = [int(v) for v in zxy.strip('/').split('/')]
+    for up in range(1, min(FALLBACK_LEVELS, tz) + 1):
+        cached = tile_cache.get(tile_key(layer, tz - up, tx >> up, ty >> up))
+        if cached is None:
+            continue
+        data = cached.encoded('identity')[1]
+        if major == 2:
+            im = Image.open(StringIO(data))
+            f = StringIO()
+        elif major == 3:
+            im = Image.open(BytesIO(data))
+            f = BytesIO()
+        n = 2**up
+        size = im.size[0] // n
+        # TMS rows count up from the bottom, image rows from the top
+        left = (tx % n) * size
+        top = (n - 1 - ty % n) * size
+        im = im.crop((left, top, left + size, top + size)).resize(im.size, Image.BILINEAR)
+        im.save(f, "PNG")
+        return 'image/png', f.getvalue()
+    return None
+
 def generate_tiles(environ, start_response):
+    with metrics.request_seconds.time('tiles'):
+        return tile_response(environ, start_response)
+
+def tile_response(environ, start_response):
     querystring = environ['QUERY_STRING']
-    fs = parse_qs(environ['QUERY_STRING'])
+    layer, zxy = layer_registry.parse_request(querystring, environ.get('PATH_INFO', ''))
+    if layer is None:
+        response_body = 'Unknown layer'
+        start_response('404 Not Found', [('Content-Type', 'text/html'),
+                                         ('Content-Length', str(len(response_body)))])
+        return [response_body.encode('utf-8')]
     
-    response_body = GenerateDynamicTiles(querystring,fs).generate_tiles()
+    tz, tx, ty = [int(v) for v in (zxy or '0/0/0').strip('/').split('/')]
+    key = tile_key(layer, tz, tx, ty)
+    cached = tile_cache.get(key)
+    if cached is not None:
+        response_body = cached.encoded('identity')[1]
+    else:
+        tile = GenerateDynamicTiles(layer,zxy,environ.get(CLIENT_GONE))
+        try:
+            response_body = tile.generate_tiles()
+        except Abandoned as e:
+            # Nobody is listening any more
+            source_fetch.work.inc('tiles_abandoned_' + e.args[0])
+            start_response('503 Service Unavailable', [('Content-Length', '0')])
+            return [b'']
+        # Tiles left blank (or with holes) by upstream failures are served, but rendered again next time
+        if tile.cacheable:
+            with metrics.stage_seconds.time('cache_write'):
+                tile_cache.put(key, response_body, 'image/png', False)
     
     status = '200 OK'
-    response_headers = [('Content-Type', 'image/png')]
+    response_headers = [('Content-Type', 'image/png'),
+                        ('Content-Length', str(len(response_body)))]
     
     try: 
         start_response(status, response_headers)
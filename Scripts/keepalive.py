@@ -0,0 +1,313 @@
+# Persistent (HTTP/1.1 keep-alive) connections for the WSGI servers
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Google Earth fetches every kml document and every tile over HTTP; reusing
+# connections saves a TCP handshake per request.  A connection is only held
+# by a pool thread while a request is being served.  Between requests, idle
+# connections wait in one poller thread, which queues them with the server
+# again (through the same admission queue as new connections) when the next
+# request arrives, and closes them after KEEPALIVE_TIMEOUT seconds.
+#
+
+import sys
+import time
+import errno
+import select
+import socket
+import threading
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 3:
+    import selectors
+
+# Seconds that an idle connection is kept open, and that a request may take to arrive
+KEEPALIVE_TIMEOUT = 15.0
+
+# Requests served over one connection before it is closed
+KEEPALIVE_MAXREQUESTS = 100
+
+# Longest request line accepted (as wsgiref)
+MAXREQUESTLINE = 65536
+
+# WSGI environ key of a function telling applications whether the client has gone away
+CLIENT_GONE = 'wsgi_server.client_gone'
+
+###############################################################################
+
+def client_gone(connection):
+    """True if the client has closed (or reset) its end of the connection"""
+
+    if hasattr(select, 'POLLRDHUP'):
+        # Also noticed when the request itself has not been read yet
+        poller = select.poll()
+        poller.register(connection, select.POLLRDHUP | select.POLLHUP | select.POLLERR)
+        return len(poller.poll(0)) > 0
+    timeout = connection.gettimeout()
+    try:
+        connection.settimeout(0.0)
+        return connection.recv(1, socket.MSG_PEEK) == b''
+    except socket.error as e:
+        return e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK)
+    finally:
+        connection.settimeout(timeout)
+
+###############################################################################
+
+class KeepAliveServerHandler(ServerHandler):
+    """
+    Frames each response so that the connection can carry the next one: with
+    Content-Length where it is known, else chunked for HTTP/1.1 clients, else
+    by closing the connection
+    """
+
+    http_version = '1.1'
+    chunked = False
+
+    # -------------------------------------------------------------------------
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        handler = self.request_handler
+        if 'Content-Length' not in self.headers and self.status[:3] not in ('204', '304'):
+            if handler.request_version == 'HTTP/1.1':
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = True
+            else:
+                handler.close_connection = True
+        if handler.close_connection:
+            self.headers['Connection'] = 'close'
+        elif handler.request_version != 'HTTP/1.1':
+            self.headers['Connection'] = 'keep-alive'
+
+    # -------------------------------------------------------------------------
+    def write(self, data):
+        if not self.headers_sent and self.status:
+            # The headers (and the framing) are decided when the first block is written
+            self.bytes_sent = len(data)
+            self.send_headers()
+            self.bytes_sent = 0
+        if not self.chunked:
+            ServerHandler.write(self, data)
+        elif data:
+            self._write(('%x\r\n' % len(data)).encode('ascii'))
+            ServerHandler.write(self, data)
+            self._write(b'\r\n')
+
+    def finish_content(self):
+        ServerHandler.finish_content(self)
+        if self.chunked:
+            self._write(b'0\r\n\r\n')
+            self._flush()
+
+    # -------------------------------------------------------------------------
+    def handle_error(self):
+        # A response that was cut off leaves the connection unusable
+        self.request_handler.close_connection = True
+        ServerHandler.handle_error(self)
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    Request handler for persistent connections.  Serves the requests that have
+    arrived on a connection, then either closes it or leaves it open for the
+    server's poller (keep_alive is True)
+    """
+
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body are written separately; without this, each response after the
+    # first waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    # -------------------------------------------------------------------------
+    def handle(self):
+        self.keep_alive = False
+        self.served = self.server.requests_served(self.connection)
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.request_waiting():
+                # Nothing more has arrived: hand the idle connection to the poller
+                self.keep_alive = major == 3
+                return
+            self.handle_one_request()
+
+    # -------------------------------------------------------------------------
+    def get_environ(self):
+        environ = WSGIRequestHandler.get_environ(self)
+        environ[CLIENT_GONE] = self.client_gone
+        return environ
+
+    def client_gone(self):
+        try:
+            return client_gone(self.connection)
+        except (socket.error, ValueError):
+            return True
+
+    # -------------------------------------------------------------------------
+    def request_waiting(self):
+        """True if the next request has (at least partly) arrived already"""
+
+        if major == 2:
+            return self.rfile._rbuf.tell() > 0
+        try:
+            self.connection.settimeout(0.0)
+            try:
+                return len(self.rfile.peek(1)) > 0
+            finally:
+                self.connection.settimeout(self.timeout)
+        except (socket.error, ValueError):
+            self.close_connection = True
+            return False
+
+    # -------------------------------------------------------------------------
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(MAXREQUESTLINE + 1)
+        except (socket.timeout, socket.error):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > MAXREQUESTLINE:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            self.close_connection = True
+            return
+
+        self.served += 1
+        if self.served >= KEEPALIVE_MAXREQUESTS:
+            self.close_connection = True
+        if self.command != 'GET' or self.headers.get('Content-Length') or self.headers.get('Transfer-Encoding'):
+            # Request bodies are not read by the applications, and HEAD responses carry one anyway
+            self.close_connection = True
+
+        handler = KeepAliveServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if handler.status is not None:
+            # The response was not finished (the client went away while it was written)
+            self.close_connection = True
+
+###############################################################################
+
+class ConnectionPoller(object):
+    """
+    Waits for the next request on the idle connections of one server, in a
+    single thread, and passes them back to the server with resume(request,
+    client_address, served)
+    """
+
+    def __init__(self, resume, close, timeout=KEEPALIVE_TIMEOUT):
+        self.resume = resume
+        self.close_request = close
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.added = []
+        self.parked = {}
+        self.closed = False
+        self.thread = None
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+
+    # -------------------------------------------------------------------------
+    def park(self, request, client_address, served):
+        """Wait for the next request on a connection"""
+
+        with self.lock:
+            if self.closed:
+                self.close_request(request)
+                return
+            self.added.append((request, client_address, served))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        try:
+            self.wakeup_w.send(b'x')
+        except socket.error:
+            pass
+
+    # -------------------------------------------------------------------------
+    def run(self):
+        parked = self.parked
+        while True:
+            events = self.selector.select(1.0)
+            now = time.time()
+            with self.lock:
+                if self.closed:
+                    break
+                added, self.added = self.added, []
+            for request, client_address, served in added:
+                try:
+                    self.selector.register(request, selectors.EVENT_READ)
+                except (ValueError, KeyError, OSError):
+                    self.close_request(request)
+                    continue
+                parked[request] = (client_address, served, now + self.timeout)
+
+            for key, mask in events:
+                if key.fileobj is self.wakeup_r:
+                    try:
+                        while self.wakeup_r.recv(4096):
+                            pass
+                    except socket.error:
+                        pass
+                    continue
+                request = key.fileobj
+                self.selector.unregister(request)
+                client_address, served, deadline = parked.pop(request)
+                self.resume(request, client_address, served)
+
+            for request in [r for r, entry in parked.items() if entry[2] <= now]:
+                self.selector.unregister(request)
+                del parked[request]
+                self.close_request(request)
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """Close all idle connections, and stop the poller thread"""
+
+        with self.lock:
+            self.closed = True
+        try:
+            self.wakeup_w.send(b'x')
+        except socket.error:
+            pass
+        if self.thread is not None:
+            self.thread.join()
+        for request in list(self.parked.keys()) + [entry[0] for entry in self.added]:
+            self.close_request(request)
+        self.parked.clear()
+        self.added = []
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
@@ -23,49 +23,73 @@
 ###############################################################################
 
 import sys,os
-from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
-import multiprocessing.pool
+import argparse
+import threading
+import multiprocessing
 prefix = os.path.dirname(os.path.realpath(__file__)) + os.path.sep
 sys.path.insert(0, prefix)
+from wsgi_server import make_server, read_ports, serve_prefork, MAXQUEUE
 from generate_kml import generate_kml
+import raster_catalog
+import mapsource_catalog
+import profiling
 
-class ThreadPoolWSGIServer(WSGIServer):
-    '''WSGI-compliant HTTP server.  Dispatches requests to a pool of threads.'''
 
-    def __init__(self, thread_count=None, *args, **kwargs):
-        '''If 'thread_count' == None, we'll use multiprocessing.cpu_count() threads.'''
-        WSGIServer.__init__(self, *args, **kwargs)
-        self.thread_count = thread_count
-        self.pool = multiprocessing.pool.ThreadPool(self.thread_count)
+def add_arguments(parser):
+    '''Options of the kml server (also used by the combined server)'''
+    parser.add_argument('--scan', metavar='DIR', action='append', default=[],
+                        help='index the rasters (and .pyr files) below DIR at startup; may be repeated.  '
+                             'The index is served as /catalog.kml')
+    parser.add_argument('--background', action='store_true',
+                        help='index the directories in the background, while already serving requests '
+                             '(with --workers, in a separate process whose results the workers read from '
+                             'the catalog file)')
+    parser.add_argument('--mapsources', metavar='DIR', action='append', default=[],
+                        help='also serve the mapsource xml files in DIR as /mapsources/<name>.kml '
+                             '(those in DEMO are always served); may be repeated')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='serve from this many worker processes sharing the port (SIGHUP replaces them, '
+                             'with the code loaded at startup); default: serve from this process')
+    parser.add_argument('--queue', type=int, default=MAXQUEUE,
+                        help='connections that may wait for a thread; others are turned away with a 503 '
+                             '(default: %(default)s)')
+    profiling.add_arguments(parser)
 
-    # Inspired by SocketServer.ThreadingMixIn.
-    def process_request_thread(self, request, client_address):
-        try: 
-            self.finish_request(request, client_address)
-        except:
-            self.handle_error(request, client_address)
 
-    def process_request(self, request, client_address):
-        self.pool.apply_async(self.process_request_thread, args=(request, client_address))
-
-
-def make_server(host, port, app, thread_count=None, handler_class=WSGIRequestHandler):
-    '''Create a new WSGI server listening on `host` and `port` for `app`'''
-    httpd = ThreadPoolWSGIServer(thread_count, (host, port), handler_class)
-    httpd.set_app(app)
-    return httpd
+def start_catalogs(args):
+    '''Set up the mapsource catalogs, and index local rasters'''
+    mapsource_catalog.catalogs.directories.extend([os.path.abspath(d) for d in args.mapsources])
+    if args.scan:
+        if args.background:
+            # The directories are listed at once (also by workers forked before the scan has
+            # got to them); their datasets are picked up from the catalog file as they are found
+            raster_catalog.catalog.add_directories(args.scan)
+            if args.workers > 0:
+                # Worker processes are forked (again, on SIGHUP) from a parent without threads
+                scanner = multiprocessing.Process(target=raster_catalog.scan_directories, args=(args.scan,))
+            else:
+                scanner = threading.Thread(target=raster_catalog.catalog.scan, args=(args.scan,))
+            scanner.daemon = True
+            scanner.start()
+        else:
+            print('Indexing ' + ', '.join(args.scan))
+            raster_catalog.catalog.scan(args.scan)
 
 
 if __name__ == '__main__':
-    addr_file = os.path.abspath(__file__).replace(os.path.basename(__file__),'') + '/addr.txt'
-    with open(addr_file) as f:
-        for line in f:
-            vals = line.split(' ')
-            port = vals[1].strip()
-                
+    parser = argparse.ArgumentParser(description='Stream kml for web tiles and local rasters to Google Earth')
+    add_arguments(parser)
+    args = parser.parse_args()
+    start_catalogs(args)
+
+    port = str(read_ports()[0])
     print('KML streaming server running on port ' + port)
-    httpd = make_server('', int(port), generate_kml)
+    app = profiling.Profiler(args.profile, args.slow).wrap(generate_kml)
+    if args.workers > 0:
+        serve_prefork(lambda: [make_server('', int(port), app, reuse_port=True, max_queue=args.queue)],
+                      args.workers)
+        sys.exit(0)
+    httpd = make_server('', int(port), app, max_queue=args.queue)
     environ = dict(os.environ.items())
     environ['wsgi.errors']       = sys.stderr
     httpd.serve_forever()
-    httpd.handle_request()
@@ -0,0 +1,132 @@
+# Writer that builds kml responses from precompiled byte fragments
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import sys
+import zipfile
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from cStringIO import StringIO
+elif major == 3:
+    from io import BytesIO
+
+# Decimal places written for coordinates (8 places is about a millimetre)
+DEFAULT_PRECISION = 8
+
+KMZ_CONTENT_TYPE = 'application/vnd.google-earth.kmz'
+
+DOCUMENT_START = b'<?xml version="1.0" encoding="utf-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n<name>'
+DOCUMENT_NAME_END = b'</name>\n<description></description>\n'
+DOCUMENT_END = b'</Document>\n</kml>\n'
+
+REGION_START = b'<Region>\n<LatLonAltBox>'
+REGION_LOD = b'</LatLonAltBox>\n<Lod><minLodPixels>'
+REGION_MAXLOD = b'</minLodPixels><maxLodPixels>'
+REGION_END = b'</maxLodPixels></Lod>\n</Region>\n'
+
+OVERLAY_START = b'<GroundOverlay>\n<drawOrder>'
+OVERLAY_ICON = b'</drawOrder>\n<Icon><href>'
+OVERLAY_BOX = b'</href></Icon>\n<LatLonBox>'
+OVERLAY_END = b'</LatLonBox>\n</GroundOverlay>\n'
+
+FOLDER_START = b'<Folder>\n<name>'
+FOLDER_NAME_END = b'</name>\n'
+FOLDER_END = b'</Folder>\n'
+
+LINK_START = b'<NetworkLink>\n<name>'
+LINK_REGION = b'</name>\n'
+LINK_HREF = b'<Link>\n<href>'
+LINK_END = b'</href>\n<viewRefreshMode>onRegion</viewRefreshMode>\n<viewFormat/>\n</Link>\n</NetworkLink>\n'
+
+###############################################################################
+
+class KMLWriter(object):
+    """
+    Collects the byte fragments of one kml document, keeping track of its
+    length so that the Content-Length is known when the document is done
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.chunks = []
+        self.length = 0
+        self.coordformat = '<north>%%.%df</north><south>%%.%df</south><east>%%.%df</east><west>%%.%df</west>' % \
+            (precision, precision, precision, precision)
+
+    # -------------------------------------------------------------------------
+    def write(self, *chunks):
+        """Append byte strings to the document"""
+
+        self.chunks.extend(chunks)
+        for chunk in chunks:
+            self.length += len(chunk)
+
+    # -------------------------------------------------------------------------
+    def box(self, north, south, east, west):
+        """Formats the edges of a tile once, for use in both Regions and LatLonBoxes"""
+
+        return (self.coordformat % (north, south, east, west)).encode('ascii')
+
+    # -------------------------------------------------------------------------
+    def document_start(self, title):
+        self.write(DOCUMENT_START, title.encode('utf-8'), DOCUMENT_NAME_END)
+
+    def document_end(self):
+        self.write(DOCUMENT_END)
+
+    # -------------------------------------------------------------------------
+    def region(self, box, minlodpixels, maxlodpixels):
+        self.write(REGION_START, box, REGION_LOD, str(minlodpixels).encode('ascii'),
+                   REGION_MAXLOD, str(maxlodpixels).encode('ascii'), REGION_END)
+
+    def ground_overlay(self, box, draworder, href):
+        self.write(OVERLAY_START, str(draworder).encode('ascii'), OVERLAY_ICON, href, OVERLAY_BOX, box, OVERLAY_END)
+
+    def folder_start(self, name):
+        self.write(FOLDER_START, name.encode('utf-8'), FOLDER_NAME_END)
+
+    def folder_end(self):
+        self.write(FOLDER_END)
+
+    def network_link(self, name, box, minlodpixels, maxlodpixels, href):
+        self.write(LINK_START, name.encode('utf-8'), LINK_REGION)
+        self.region(box, minlodpixels, maxlodpixels)
+        self.write(LINK_HREF, href, LINK_END)
+
+    # -------------------------------------------------------------------------
+    def getvalue(self):
+        """The finished document as a single byte string"""
+
+        return b''.join(self.chunks)
+
+###############################################################################
+
+def kmz(data):
+    """A kml document packed as kmz (a zip file with the document as doc.kml)"""
+
+    if major == 2:
+        f = StringIO()
+    elif major == 3:
+        f = BytesIO()
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('doc.kml', data)
+    return f.getvalue()
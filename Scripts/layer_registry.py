@@ -0,0 +1,383 @@
+# Registry of layers compiled from the query strings of kml and tile requests
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Every request for a layer carries the same query string (the source url,
+# zoom range, bounds, flags, ...) plus the zxy of the requested tile.  The
+# part without zxy is compiled once into a Layer, which is then shared by
+# all requests for that layer.
+#
+# Each layer also has a short id (a hash of its canonical query string), kept
+# in a small text file ("id query" per line) shared by the kml and the tile
+# server, so that links can be written as /l/<id>/<z>/<x>/<y>.  Ids are only
+# registered by the kml server, for layers that it writes links to; links
+# written elsewhere (such as by generate_mapsource_kml.py) carry the query
+# string as well (/l/<id>?<query>), so that they work on any server.  The
+# file is rewritten with the most recent ids once it holds MAXIDS of them.
+#
+
+import os
+import sys
+import math
+import time
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from urllib import unquote, unquote_plus, quote_plus
+elif major == 3:
+    from urllib.parse import unquote, unquote_plus, quote_plus
+from xml.sax.saxutils import escape
+import kml_for_tiles
+from tile_math import GlobalMercator, GlobalGeodetic, tile_ranges
+import tile_index
+import kml_writer
+from url_template import UrlTemplate
+
+# Largest number of compiled layers kept in memory
+MAXLAYERS = 1000
+
+IDFILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'layerids.txt')
+
+# Hex digits of the hash used as layer id
+IDLENGTH = 12
+
+# Tile coordinates of a request (z/x/y)
+ZXY = re.compile(r'^\d+/\d+/\d+$')
+
+# Largest number of ids in the id file before it is compacted (to half of this)
+MAXIDS = 10000
+
+# Values of resample= (the GDAL warp algorithms of the same names)
+RESAMPLE_METHODS = ('near', 'bilinear', 'cubic', 'cubicspline', 'lanczos', 'average', 'mode')
+
+###############################################################################
+
+def parse_query(querystring):
+    """
+    Split a query string into a dictionary of (unquoted) values.  Both '&' and
+    ';' separate parameters, and the first value of a parameter is used
+    """
+
+    values = {}
+    for part in querystring.replace(';', '&').split('&'):
+        if '=' in part:
+            name, value = part.split('=', 1)
+        else:
+            name, value = part, ''
+        name = unquote_plus(name)
+        if name != '' and name not in values:
+            values[name] = unquote_plus(value)
+    return values
+
+def split_zxy(querystring):
+    """Returns the query string without its zxy parameter, and the zxy value ('' if none)"""
+
+    parts = querystring.split('&')
+    zxy = ''
+    kept = []
+    for part in parts:
+        if part.startswith('zxy=') or part.startswith('amp;zxy='):
+            zxy = unquote(part.split('=', 1)[1]).strip(';')
+        else:
+            kept.append(part)
+    return '&'.join(kept), zxy
+
+def canonical_query(querystring):
+    """The parameters of a query string, sorted and quoted in one way"""
+
+    values = parse_query(querystring)
+    return '&'.join(['%s=%s;' % (quote_plus(name), quote_plus(values[name])) for name in sorted(values)])
+
+def layer_id(canonical):
+    """Short id of a layer, from its canonical query string"""
+
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:IDLENGTH]
+
+###############################################################################
+
+class Layer(object):
+    """
+    Everything about a layer that can be worked out from its query string.
+    Layers are shared between requests (and threads), so treat them as read-only.
+    """
+
+    def __init__(self, querystring):
+
+        values = parse_query(querystring)
+        self.values = values
+        self.canonical = canonical_query(querystring)
+        self.id = layer_id(self.canonical)
+
+        self.url = escape(values.get('url', ''))
+        self.source_url = values.get('url', '')
+        self.bgurl = escape(values.get('bgurl', ''))
+        if major == 2:
+            self.icon_url = unquote(self.url).decode('utf8')
+            self.tile_url = unquote(self.source_url).decode('utf8')
+        elif major == 3:
+            self.icon_url = unquote(self.url)
+            self.tile_url = unquote(self.source_url)
+
+        # Web tiles ({$z},{$x},{$y} or a WMS bounding box are defined), or else a local gdal-supported dataset
+        self.webTiles = ('$z' in self.url) or ('WMS:BBOX' in self.url)
+
+        # The profile is always passed on to further requests for this layer
+        if 'profile' in values:
+            self.profile = escape(values['profile'])
+            if self.profile not in ('mercator', 'geodetic'):
+                raise ValueError('profile must be mercator or geodetic, not %s' % self.profile)
+        elif ('$z' in self.url) or ('$z' in self.bgurl):
+            self.profile = 'mercator'
+            querystring = querystring + '&profile=mercator;'
+        else:
+            self.profile = 'geodetic'
+            querystring = querystring + '&profile=geodetic;'
+        self.querystring = querystring
+
+        self.checkStatus = 'checkStatus' in querystring
+        self.singleLevel = 'singleLevel' in querystring
+        self.forceDynamicTile = 'forceDynamicTile' in querystring
+
+        self.zoom = escape(values.get('zoom', '')) or '0-31'
+        self.ullr = escape(values.get('ullr', '')).replace(' ','_') or '-180_90_180_-89.9'
+        self.serverparts = escape(values.get('serverparts', ''))
+        self.serverpart_list = values.get('serverparts', '').split('_')
+        self.cachedir = escape(values.get('cachedir', ''))
+        self.resample = escape(values.get('resample', '')) or 'near'
+        if self.resample not in RESAMPLE_METHODS:
+            raise ValueError('resample must be one of %s, not %s' % (', '.join(RESAMPLE_METHODS), self.resample))
+        self.precision = int(values.get('precision', '') or kml_writer.DEFAULT_PRECISION)
+        # Send kml packed as kmz (for clients that do not accept gzip encoded responses)
+        self.kmz = values.get('kmz', '0') not in ('', '0')
+
+        # Larger output tiles are composited by the tile server from 2x2 (4x4, ...) source
+        # tiles, so the kml quadtree starts (and ends) that many levels coarser
+        self.tilesize = int(values.get('tilesize', '') or 256)
+        if self.tilesize < 256 or self.tilesize & (self.tilesize - 1):
+            raise ValueError('tilesize must be 256 times a power of two, not %d' % self.tilesize)
+        self.levels = int(round(math.log(self.tilesize / 256.0, 2)))
+
+        # Depth mode: the tiles of this many further levels are inlined into each kml
+        # response (within the limits below), and only the frontier is linked to
+        self.depth = int(values.get('depth', '') or 0)
+        self.maxinline = int(values.get('maxInline', '') or kml_for_tiles.MAXINLINETILES)
+        self.maxbytes = int(values.get('maxBytes', '') or kml_for_tiles.MAXINLINEBYTES)
+
+        minzoom, maxzoom = self.zoom.split('-')
+        self.source_minzoom, self.source_maxzoom = int(minzoom), int(maxzoom)
+        self.minzoom = max(self.source_minzoom - self.levels, 0)
+        self.maxzoom = max(self.source_maxzoom - self.levels, 0)
+
+        # Map bounds and the tiles that they cover at each zoom level
+        ulx, uly, lrx, lry = self.ullr.split('_')
+        self.bounds = (float(ulx), float(uly), float(lrx), float(lry))
+        self.tminmax = tile_ranges(self.profile, *self.bounds)
+
+        # Functions which generate SWNE in LatLong (and WSEN in meters) for a given tile
+        if self.profile == 'mercator':
+            self.mercator = GlobalMercator()
+            self.tileswne = self.mercator.TileLatLonBounds
+            self.tilewsen_merc = self.mercator.TileBounds
+        elif self.profile == 'geodetic':
+            self.geodetic = GlobalGeodetic()
+            self.tileswne = self.geodetic.TileLatLonBounds
+
+        # Source url compiled for direct links on the layer's grid, and for fetching the
+        # (always Spherical Mercator, 256 pixel) source tiles in the tile server
+        self.template = UrlTemplate(self.tile_url, self.profile)
+        self.source_template = UrlTemplate(self.tile_url, 'mercator')
+
+        # Web layers keep an index of subtrees without data (filled by probes, and by the
+        # tile server when every source tile of a tile is missing), so that they are not linked to
+        if self.webTiles:
+            self.index = tile_index.get_index(self.source_url, self.profile, self.tilesize)
+        else:
+            self.index = None
+
+###############################################################################
+
+class LayerIds(object):
+    """Persistent mapping of layer ids to canonical query strings"""
+
+    def __init__(self, path=IDFILE, maxids=MAXIDS):
+        self.path = path
+        self.maxids = maxids
+        self.queries = OrderedDict()
+        self.offset = 0
+        self.inode = None
+        self.lines = 0
+        self.lock = threading.Lock()
+        self.refresh()
+
+    # -------------------------------------------------------------------------
+    def refresh(self):
+        """Read ids appended to the file since it was last read (or all of it, once it has been compacted)"""
+
+        try:
+            st = os.stat(self.path)
+            if st.st_ino != self.inode:
+                # Compacted by another process: read the new file from the start
+                with self.lock:
+                    self.inode = st.st_ino
+                    self.offset = 0
+                    self.lines = 0
+                    self.queries = OrderedDict()
+            if st.st_size <= self.offset:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except (IOError, OSError):
+            return
+
+        # Ignore a trailing line that is still being written
+        end = data.rfind(b'\n') + 1
+        with self.lock:
+            for line in data[:end].decode('ascii').splitlines():
+                vals = line.split(' ')
+                if len(vals) == 2:
+                    self.queries[vals[0]] = vals[1]
+                    self.lines += 1
+            self.offset = self.offset + end
+
+    # -------------------------------------------------------------------------
+    def lookup(self, id):
+        """Canonical query string of a layer id (None if unknown)"""
+
+        query = self.queries.get(id)
+        if query is None:
+            # Possibly registered by the other server (only reads the file if it has grown)
+            self.refresh()
+            query = self.queries.get(id)
+        return query
+
+    # -------------------------------------------------------------------------
+    def register(self, id, canonical, keep=None):
+        """Add an id to the file, or compact the file if it is full (keeping the ids that keep() returns)"""
+
+        if self.queries.get(id) == canonical:
+            return
+        self.refresh()
+        with self.lock:
+            self.queries[id] = canonical
+            if self.lines >= self.maxids:
+                self.compact(keep() if keep is not None else ())
+                return
+            try:
+                # Counted (in self.lines) when the file is next read
+                with open(self.path, 'a') as f:
+                    f.write('%s %s\n' % (id, canonical))
+            except (IOError, OSError):
+                pass
+
+    # -------------------------------------------------------------------------
+    def compact(self, keep):
+        """Rewrite the file with the most recent half of the ids, and those in `keep` (call with the lock held)"""
+
+        items = list(self.queries.items())
+        recent = items[-(self.maxids // 2):]
+        kept = [(id, query) for id, query in items[:-(self.maxids // 2)] if id in keep] + recent
+        self.queries = OrderedDict(kept)
+        tmpname = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmpname, 'w') as f:
+                for id, query in kept:
+                    f.write('%s %s\n' % (id, query))
+            if hasattr(os, 'replace'):
+                os.replace(tmpname, self.path)
+            else:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tmpname, self.path)
+            st = os.stat(self.path)
+            self.inode = st.st_ino
+            self.offset = st.st_size
+            self.lines = len(kept)
+        except (IOError, OSError):
+            pass
+
+###############################################################################
+
+ids = LayerIds()
+
+_layers = {}
+_lock = threading.Lock()
+
+def get_layer(querystring):
+    """Returns the compiled layer for a query string (without its zxy parameter)"""
+
+    layer = _layers.get(querystring)
+    if layer is None:
+        layer = Layer(querystring)
+        with _lock:
+            if len(_layers) >= MAXLAYERS:
+                _layers.clear()
+            _layers[querystring] = layer
+    return layer
+
+def register_layer(layer):
+    """Registers the id of a layer that links are written to (by the kml server)"""
+
+    ids.register(layer.id, layer.canonical, lambda: set(l.id for l in list(_layers.values())))
+
+def query_link(querystring):
+    """Path of a link to a layer that works without its id being registered: /l/<id>?<query>"""
+
+    return '/l/' + layer_id(canonical_query(querystring)) + '?' + querystring
+
+def parse_request(querystring, path=''):
+    """
+    Returns the compiled layer and the requested zxy ('' for a root request), from
+    either a query string or a /l/<id>[/<z>/<x>/<y>] path.  The layer is None for unknown
+    ids, and for malformed requests
+    """
+
+    if path.startswith('/l/'):
+        parts = path[3:].strip('/').split('/')
+        canonical = ids.lookup(parts[0])
+        if canonical is None and querystring:
+            # Links from kml written elsewhere carry the query string of the layer as well
+            canonical = canonical_query(split_zxy(querystring)[0])
+            if layer_id(canonical) != parts[0]:
+                return None, ''
+        if canonical is None:
+            return None, ''
+        if len(parts) == 1:
+            querystring, zxy = canonical, ''
+        elif len(parts) == 4 and parts[1].isdigit() and parts[2].isdigit() and parts[3].isdigit():
+            querystring, zxy = canonical, '/'.join(parts[1:4])
+        else:
+            return None, ''
+    else:
+        querystring, zxy = split_zxy(querystring)
+        if zxy and not ZXY.match(zxy.strip('/')):
+            return None, ''
+
+    try:
+        return get_layer(querystring), zxy
+    except (ValueError, IndexError):
+        # Malformed settings (zoom, ullr, tilesize, precision, ...) are treated as an unknown layer
+        return None, ''
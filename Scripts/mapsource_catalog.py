@@ -0,0 +1,210 @@
+# Kml catalogs of map sources, built from mapsource xml files
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# A mapsource xml file (such as DEMO/mapsources.xml) lists map sources, possibly
+# grouped in folders.  The kml server serves each such file found in its
+# mapsource directories as /mapsources/<name>.kml, rebuilt only when the xml
+# file changes; generate_mapsource_kml.py writes the same kml to a file.
+#
+
+import os
+import sys
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from urllib import quote
+elif major == 3:
+    from urllib.parse import quote
+from xml.sax.saxutils import escape
+import layer_registry
+import response_cache
+
+MAPSOURCEDIRS = [os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'DEMO')]
+
+###############################################################################
+
+def mapsource_query(mapSource):
+    """Query string (with plain '&' separators) of a customMapSource element"""
+
+    url = mapSource.find('url').text
+    if major == 2 and isinstance(url, unicode):
+        url = url.encode('utf-8')
+    QueryString = 'url=' + quote(url, '') + ';'
+    if mapSource.find('minZoom') is not None:
+        QueryString = QueryString + '&zoom=' + mapSource.find('minZoom').text + '-' + mapSource.find('maxZoom').text + ';'
+    if mapSource.find('minX') is not None:
+        QueryString = QueryString + '&ullr=' + mapSource.find('minX').text + '_' + mapSource.find('maxY').text + '_' + mapSource.find('maxX').text + '_' + mapSource.find('minY').text + ';'
+    if mapSource.find('serverparts') is not None:
+        QueryString = QueryString + '&serverparts=' + mapSource.find('serverparts').text.replace(' ','_') + ';'
+    if mapSource.find('profile') is not None:
+        QueryString = QueryString + '&profile=' + mapSource.find('profile').text + ';'
+    if mapSource.find('tileSize') is not None:
+        QueryString = QueryString + '&tilesize=' + mapSource.find('tileSize').text + ';'
+    if mapSource.find('checkStatus') is not None:
+        QueryString = QueryString + '&checkStatus=1;'
+    return QueryString
+
+def generate_network_link(href_url,Name,visibility,LegendURL):
+    # Get legend code from add_screen_overlay_dynamic in Mapping Scripts
+    kml_str = """\n<Folder>
+    	<name>%s</name>""" % (Name)
+    kml_str += """\n<NetworkLink>
+	<name>%s</name>
+	<visibility>%d</visibility>
+	<Link>
+		<href>%s</href>
+	</Link>
+</NetworkLink>""" % (Name, visibility,href_url)
+
+    if not LegendURL == "":
+        kml_str += """\n<ScreenOverlay>
+        <visibility>%d</visibility>
+        <Icon>
+            <href>%s</href>
+        </Icon>
+        <overlayXY x="0" y="0.98" xunits="fraction" yunits="fraction"/>
+        <screenXY x="0" y="0.98" xunits="fraction" yunits="fraction"/>
+        <rotationXY x="0" y="0" xunits="fraction" yunits="fraction"/>
+        <size x="0" y="0" xunits="fraction" yunits="fraction"/>
+    </ScreenOverlay>""" % (visibility,LegendURL)
+
+    kml_str += """\n</Folder>"""
+    return kml_str
+
+def mapsource_link(mapSource, mapping_script_url):
+    """Folder with a link to one map source (by its layer id), and its legend if any"""
+
+    mapSourceName = escape(mapSource.find('name').text)
+    # Layers are linked to by their short id, with the query string for servers that do not know the id yet
+    href = mapping_script_url + escape(layer_registry.query_link(mapsource_query(mapSource)))
+    if mapSource.find('legend') is not None:
+        LegendURL = escape(mapSource.find('legend').text)
+    else:
+        LegendURL = ""
+    return generate_network_link(href, mapSourceName, 0, LegendURL)
+
+def catalog_kml(MapSourceXMLFile, title, mapping_script_url):
+    """Kml (as text) with a folder per folder of the mapsource xml file, and a link per map source"""
+
+    kml_str = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
+<Folder>
+	<name>%s</name>
+        <Style>
+		<ListStyle>
+			<listItemType>radioFolder</listItemType>
+			<bgColor>00ffffff</bgColor>
+			<maxSnippetLines>2</maxSnippetLines>
+		</ListStyle>
+	</Style>""" % (escape(title))
+
+    tree = ET.parse(MapSourceXMLFile)
+    root = tree.getroot()
+
+    for folder in root.findall('folder'):
+        name = folder.attrib['name']
+        type = folder.attrib['type']
+        kml_str += """<Folder>
+	<name>%s</name>""" % (escape(name))
+        if type == 'radio':
+            kml_str += """        <Style>
+		<ListStyle>
+			<listItemType>radioFolder</listItemType>
+		</ListStyle>
+	</Style>"""
+
+        for mapSource in folder.findall('customMapSource'):
+            kml_str = kml_str + mapsource_link(mapSource, mapping_script_url)
+
+        kml_str = kml_str + '\n</Folder>'
+
+    for mapSource in root.findall('customMapSource'):
+        kml_str = kml_str + mapsource_link(mapSource, mapping_script_url)
+
+    kml_str = kml_str + '\n</Folder></kml>'
+    return kml_str
+
+###############################################################################
+
+class MapsourceCatalogs(object):
+    """
+    Kml catalogs of the mapsource xml files in a list of directories, each kept
+    (with its gzip encoding and ETag) until its xml file changes
+    """
+
+    def __init__(self, directories=MAPSOURCEDIRS):
+        self.directories = list(directories)
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def find(self, name):
+        """Path of the mapsource xml file for a catalog name (None if there is none)"""
+
+        if name == '' or '/' in name or '\\' in name or name.startswith('.'):
+            return None
+        for directory in self.directories:
+            path = os.path.join(directory, name + '.xml')
+            if os.path.isfile(path):
+                return path
+        return None
+
+    # -------------------------------------------------------------------------
+    def get(self, name, mapping_script_url):
+        """
+        Returns the response (a response_cache.CachedResponse) and ETag of a catalog,
+        or None, None if there is no such catalog
+        """
+
+        path = self.find(name)
+        if path is None:
+            return None, None
+        try:
+            st = os.stat(path)
+        except (IOError, OSError):
+            return None, None
+        version = (st.st_mtime, st.st_size, mapping_script_url)
+
+        with self.lock:
+            entry = self.cache.get(path)
+        if entry is not None and entry[0] == version:
+            return entry[1], entry[2]
+
+        try:
+            kml_str = catalog_kml(path, name, mapping_script_url)
+        except (IOError, OSError, ET.ParseError):
+            return None, None
+        body = kml_str.encode('utf-8')
+        response = response_cache.CachedResponse(body, 'text/xml')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        with self.lock:
+            self.cache[path] = (version, response, etag)
+        return response, etag
+
+###############################################################################
+
+# Shared by every request handled by this process
+catalogs = MapsourceCatalogs()
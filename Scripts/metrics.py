@@ -0,0 +1,245 @@
+# Counters and timing histograms, served in the Prometheus text format
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Every server answers /metrics with the metrics of its process (the
+# counters of the caches, upstream probes and errors, and histograms of the
+# time taken by each stage of building a response), for example:
+#
+#   getileserver_stage_seconds_bucket{stage="warp",le="0.05"} 1183
+#
+# Recording a value takes a lock and a bisect, and costs about a
+# microsecond.  In pre-fork mode, each worker process has its own metrics.
+#
+
+import sys
+import time
+import bisect
+import threading
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    clock = time.time
+elif major == 3:
+    clock = time.perf_counter
+
+# Path answered by every server with the metrics of its process
+METRICS_PATH = '/metrics'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Per-thread list of the stages timed during the current request, while it is traced
+local = threading.local()
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+###############################################################################
+
+def label_text(names, values, extra=()):
+    """Prometheus label set, such as {stage="warp",le="0.05"}"""
+
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in pairs) + '}'
+
+def number_text(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+    """A named metric with a fixed set of label names"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+
+
+class Counter(Metric):
+    """Counts, by label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self.values = {}
+
+    # -------------------------------------------------------------------------
+    def inc(self, *labelvalues):
+        self.add(1, *labelvalues)
+
+    def add(self, n, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + n
+
+    # -------------------------------------------------------------------------
+    def collect(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + ['%s%s %s' % (self.name, label_text(self.labelnames, labelvalues), number_text(value))
+                                for labelvalues, value in values]
+
+
+class Timer(object):
+    """Context manager recording the time spent in a block in a histogram"""
+
+    __slots__ = ('histogram', 'labelvalues', 'start')
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(clock() - self.start, *self.labelvalues)
+
+
+class Histogram(Metric):
+    """Distribution of values (usually seconds), by label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, traced=False):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        # Values of traced histograms are also added to the trace of the current request
+        self.traced = traced
+
+    # -------------------------------------------------------------------------
+    def observe(self, value, *labelvalues):
+        if self.traced:
+            stages = getattr(local, 'stages', None)
+            if stages is not None:
+                stages.append(labelvalues + (value,))
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                # Count per bucket (the last one is +Inf), then the sum of the values
+                series = [0] * (len(self.buckets) + 1) + [0.0]
+                self.series[labelvalues] = series
+            series[i] += 1
+            series[-1] += value
+
+    def time(self, *labelvalues):
+        """with histogram.time(labels): ... records the time the block took"""
+        return Timer(self, labelvalues)
+
+    # -------------------------------------------------------------------------
+    def collect(self):
+        with self.lock:
+            series = sorted((labelvalues, list(values)) for labelvalues, values in self.series.items())
+        lines = self.header()
+        for labelvalues, values in series:
+            count = 0
+            for bound, n in zip(self.buckets + ('+Inf',), values[:-1]):
+                count += n
+                lines.append('%s_bucket%s %d' % (self.name, label_text(self.labelnames, labelvalues,
+                                                                       [('le', bound)]), count))
+            lines.append('%s_sum%s %r' % (self.name, label_text(self.labelnames, labelvalues), values[-1]))
+            lines.append('%s_count%s %d' % (self.name, label_text(self.labelnames, labelvalues), count))
+        return lines
+
+
+class FunctionMetric(Metric):
+    """Values read from elsewhere when the metrics are collected: func() returns {labelvalues: value}"""
+
+    def __init__(self, name, help, kind, labelnames, func):
+        Metric.__init__(self, name, help, labelnames)
+        self.kind = kind
+        self.func = func
+
+    def collect(self):
+        return self.header() + ['%s%s %s' % (self.name, label_text(self.labelnames, labelvalues), number_text(value))
+                                for labelvalues, value in sorted(self.func().items())]
+
+###############################################################################
+
+class Registry(object):
+    """The metrics of a process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def text(self):
+        """All metrics in the Prometheus text format"""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+# Shared by every request handled by this process
+registry = Registry()
+
+def counter(name, help, labelnames=()):
+    return registry.register(Counter(name, help, labelnames))
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS, traced=False):
+    return registry.register(Histogram(name, help, labelnames, buckets, traced))
+
+def function_metric(name, help, kind, labelnames, func):
+    return registry.register(FunctionMetric(name, help, kind, labelnames, func))
+
+# Metrics recorded by more than one module
+stage_seconds = histogram('getileserver_stage_seconds', 'Time spent in each stage of building a response',
+                          ('stage',), traced=True)
+request_seconds = histogram('getileserver_request_seconds', 'Time taken to build a response, by application',
+                            ('app',))
+cache_requests = counter('getileserver_cache_requests_total', 'Cache lookups, by cache and result',
+                         ('cache', 'result'))
+probe_results = counter('getileserver_probe_total', 'Checks of upstream tiles, by result', ('result',))
+errors = counter('getileserver_errors_total', 'Errors, by where they happened', ('source',))
+
+###############################################################################
+
+def start_trace():
+    """Start collecting the stages timed by this thread"""
+    local.stages = []
+
+def end_trace():
+    """Stop collecting, and return [(stage, seconds), ...] timed since start_trace()"""
+    stages = getattr(local, 'stages', None)
+    local.stages = None
+    return stages or []
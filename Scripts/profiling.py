@@ -0,0 +1,210 @@
+# Opt-in request profiling: sampled cProfile runs and slow request traces
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Started with --profile <n>, one request in n (handled by the kml or the
+# tile server) runs under cProfile, and the profiles are added together.
+# With --slow <seconds>, every request that takes longer is written to
+# SLOWLOG (one json object per line) with its query string and the time
+# taken by each stage (see metrics.py).  While profiling is on, the servers
+# also answer:
+#
+#   /profile/stats         the aggregated profile as text (top functions)
+#   /profile/stats.prof    the aggregated profile for pstats or snakeviz
+#   /profile/slow          the most recent slow requests (json lines)
+#
+
+import os
+import sys
+import json
+import time
+import marshal
+import cProfile
+import pstats
+import threading
+from collections import deque
+import metrics
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from cStringIO import StringIO
+elif major == 3:
+    from io import StringIO
+
+SLOWLOG = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'slowrequests.txt')
+
+# Slow requests kept in memory for /profile/slow
+MAXSLOW = 100
+
+# Functions listed by /profile/stats, and in the traces of slow requests that were profiled
+TOPFUNCTIONS = 40
+TOPFUNCTIONS_SLOW = 15
+
+PROFILE_PATH = '/profile/'
+
+###############################################################################
+
+def add_arguments(parser):
+    """Profiling options of the server scripts"""
+
+    parser.add_argument('--profile', metavar='N', type=int, default=0,
+                        help='profile one request in N; the profiles are served as /profile/stats')
+    parser.add_argument('--slow', metavar='SECONDS', type=float, default=0.0,
+                        help='log requests taking SECONDS or longer (with the time of each stage) to '
+                             'slowrequests.txt and /profile/slow')
+
+def top_functions(stats, n):
+    """The n functions of a pstats.Stats with the most cumulative time, as text"""
+
+    f = StringIO()
+    stats.stream = f
+    stats.sort_stats('cumulative').print_stats(n)
+    return f.getvalue()
+
+
+class Profiler(object):
+    """
+    Wraps WSGI applications to profile one request in `every` (0 for none), and to
+    trace requests taking `slow` seconds or longer (0 for none)
+    """
+
+    def __init__(self, every=0, slow=0.0, slowlog=SLOWLOG):
+        self.every = every
+        self.slow = slow
+        self.slowlog = slowlog
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.profiled = 0
+        self.stats = None
+        self.recent = deque(maxlen=MAXSLOW)
+        # Only one request is profiled at a time (cProfile follows a single thread)
+        self.busy = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def wrap(self, app):
+        """A WSGI application profiling `app`, and answering the /profile/ paths (`app` if profiling is off)"""
+
+        if self.every <= 0 and self.slow <= 0:
+            return app
+
+        def profiled_app(environ, start_response):
+            path = environ.get('PATH_INFO', '')
+            if path.startswith(PROFILE_PATH):
+                return self.report(path[len(PROFILE_PATH):], start_response)
+            return self.run(app, environ, start_response)
+        return profiled_app
+
+    # -------------------------------------------------------------------------
+    def run(self, app, environ, start_response):
+        sample = False
+        if self.every > 0:
+            with self.lock:
+                self.requests += 1
+                sample = self.requests % self.every == 0
+        profile = None
+        if sample and self.busy.acquire(False):
+            profile = cProfile.Profile()
+        if self.slow > 0:
+            metrics.start_trace()
+
+        start = metrics.clock()
+        try:
+            if profile is not None:
+                profile.enable()
+            try:
+                return app(environ, start_response)
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            seconds = metrics.clock() - start
+            if profile is not None:
+                self.busy.release()
+                self.add_profile(profile)
+            if self.slow > 0:
+                stages = metrics.end_trace()
+                if seconds >= self.slow:
+                    self.trace(environ, seconds, stages, profile)
+
+    # -------------------------------------------------------------------------
+    def add_profile(self, profile):
+        """Add the profile of one request to the aggregated profile"""
+
+        stats = pstats.Stats(profile)
+        with self.lock:
+            self.profiled += 1
+            if self.stats is None:
+                self.stats = stats
+            else:
+                self.stats.add(stats)
+
+    # -------------------------------------------------------------------------
+    def trace(self, environ, seconds, stages, profile):
+        """Record a slow request"""
+
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'pid': os.getpid(),
+                  'path': environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                  'query': environ.get('QUERY_STRING', ''),
+                  'seconds': round(seconds, 6),
+                  'stages': [[stage, round(value, 6)] for stage, value in stages]}
+        if profile is not None:
+            record['profile'] = top_functions(pstats.Stats(profile), TOPFUNCTIONS_SLOW)
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            self.recent.append(line)
+            try:
+                with open(self.slowlog, 'a') as f:
+                    f.write(line + '\n')
+            except (IOError, OSError):
+                pass
+
+    # -------------------------------------------------------------------------
+    def report(self, name, start_response):
+        """Answer /profile/stats, /profile/stats.prof and /profile/slow"""
+
+        with self.lock:
+            if name == 'stats':
+                header = 'Requests: %d, profiled: %d\n\n' % (self.requests, self.profiled)
+                if self.stats is None:
+                    text = header + 'No requests have been profiled (start the server with --profile <n>)\n'
+                else:
+                    text = header + top_functions(self.stats, TOPFUNCTIONS)
+                body = text.encode('utf-8')
+                content_type = 'text/plain'
+            elif name == 'stats.prof':
+                # The format written by pstats.Stats.dump_stats()
+                body = marshal.dumps(self.stats.stats if self.stats is not None else {})
+                content_type = 'application/octet-stream'
+            elif name == 'slow':
+                body = ''.join(line + '\n' for line in self.recent).encode('utf-8')
+                content_type = 'text/plain'
+            else:
+                body = None
+        if body is None:
+            body = b'Not found'
+            start_response('404 Not Found', [('Content-Type', 'text/plain'),
+                                             ('Content-Length', str(len(body)))])
+            return [body]
+        start_response('200 OK', [('Content-Type', content_type),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
@@ -0,0 +1,396 @@
+# Persistent catalog of the extents and resolutions of local raster datasets
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Root kml files for a local raster need its extent in geographic coordinates
+# and its resolution.  These are worked out in process, by transforming points
+# along the edges of the dataset with OSR, and kept in a small json file keyed
+# by the path, modification time and size of the dataset, so that they are
+# only computed again when the file changes.
+#
+# Directories of rasters can be scanned ahead of time (see kml_server_multi.py).
+# A layer whose url is such a directory shows all datasets in it, and the tile
+# server asks the catalog which of them cover each tile.
+#
+
+import os
+import json
+import math
+import time
+import threading
+from osgeo import gdal, osr
+from tile_math import GlobalMercator, GlobalGeodetic
+
+CATALOGFILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'rastercatalog.json')
+
+# Points sampled along each edge of a dataset when transforming its bounds
+EDGEPOINTS = 21
+
+# Seconds between checks of the catalog file for entries written by other processes
+REFRESH_INTERVAL = 1.0
+
+# Files picked up when scanning directories
+RASTEREXTENSIONS = ('.tif', '.tiff', '.vrt', '.img', '.jp2', '.ecw', '.sid', '.nc', '.hdf', '.pyr')
+
+###############################################################################
+
+def read_pyr(url):
+    """
+    Rasters listed in a .pyr file, one "zoom,path" per line, as [zoom, path] pairs.
+    Each raster is used from its zoom level on; the first one for the largest zoom levels
+    """
+
+    members = []
+    with open(url, 'r') as f:
+        for line in f:
+            if ',' in line:
+                zoom, raster_url = line.split(',', 1)
+                members.append([int(zoom), raster_url.strip()])
+    return members
+
+def pyr_member(members, tz):
+    """The raster of a .pyr file that is used at zoom level tz"""
+
+    for zoom, raster_url in sorted(members, reverse=True):
+        if tz is None or zoom <= tz:
+            return raster_url
+    return sorted(members)[0][1]
+
+def clamp_extent(extent):
+    """Extent limited to the area that the tile profiles cover"""
+
+    ulx, uly, lrx, lry = extent
+    return max(ulx, -180), min(uly, 89.9), min(lrx, 180), max(lry, -89.9)
+
+def overlaps(extent, south, west, north, east):
+    ulx, uly, lrx, lry = extent
+    return ulx < east and lrx > west and lry < north and uly > south
+
+def geographic_srs():
+    srs = osr.SpatialReference()
+    srs.SetWellKnownGeogCS('WGS84')
+    # GDAL 3 would otherwise use latitude, longitude order
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+def dataset_info(raster_url):
+    """
+    Geographic extent of a dataset, and the size (and pixel size) that it has
+    when warped to geographic coordinates.  None if it can not be opened
+    """
+
+    ds = gdal.Open(raster_url, gdal.GA_ReadOnly)
+    if ds is None:
+        return None
+    cols = ds.RasterXSize
+    rows = ds.RasterYSize
+    bands = ds.RasterCount
+    transform = ds.GetGeoTransform()
+    wkt = ds.GetProjectionRef()
+    overviews = []
+    if bands > 0:
+        band = ds.GetRasterBand(1)
+        for i in range(band.GetOverviewCount()):
+            overview = band.GetOverview(i)
+            overviews.append([overview.XSize, overview.YSize])
+    del ds
+
+    # Points along the edges of the dataset, in its own coordinates
+    points = []
+    for i in range(EDGEPOINTS):
+        f = i / float(EDGEPOINTS - 1)
+        for px, py in ((f * cols, 0), (f * cols, rows), (0, f * rows), (cols, f * rows)):
+            points.append((transform[0] + px * transform[1] + py * transform[2],
+                           transform[3] + px * transform[4] + py * transform[5]))
+
+    # Datasets without a projection are taken to be in geographic coordinates already
+    if wkt:
+        src_srs = osr.SpatialReference()
+        src_srs.ImportFromWkt(wkt)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        ct = osr.CoordinateTransformation(src_srs, geographic_srs())
+        points = [ct.TransformPoint(x, y)[:2] for x, y in points]
+
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    ulx, uly, lrx, lry = min(xs), max(ys), max(xs), min(ys)
+
+    # Like gdalwarp, keep the number of pixels along the diagonal of the dataset
+    resolution = math.hypot(lrx - ulx, uly - lry) / math.hypot(cols, rows)
+    return {
+        'extent': [ulx, uly, lrx, lry],
+        'cols': max(int((lrx - ulx) / resolution + 0.5), 1),
+        'rows': max(int((uly - lry) / resolution + 0.5), 1),
+        'resolution': resolution,
+        'bands': bands,
+        'overviews': overviews,
+        'tminz': {},
+    }
+
+###############################################################################
+
+class RasterCatalog(object):
+    """Extents, resolutions and top zoom levels of local datasets, shared by all requests"""
+
+    def __init__(self, path=CATALOGFILE):
+        self.path = path
+        self.entries = {}
+        # Paths dropped by a scan, which are not to be merged back in from the file
+        self.removed = set()
+        # Directories listed in catalog.kml (scanned by this process, or by a background scan)
+        self.directories = []
+        self.mtime = None
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.refresh(force=True)
+
+    # -------------------------------------------------------------------------
+    def refresh(self, force=False):
+        """Pick up entries that other processes (or a scan) have written to the catalog file"""
+
+        now = time.time()
+        if not force and now - self.checked < REFRESH_INTERVAL:
+            return
+        self.checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except (IOError, OSError):
+            return
+        if mtime != self.mtime:
+            with self.lock:
+                self.merge()
+                self.mtime = mtime
+
+    # -------------------------------------------------------------------------
+    def merge(self):
+        """Add the entries of the catalog file for files not known here (call with the lock held)"""
+
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        paths = set(entry.get('path') for entry in self.entries.values())
+        for key, entry in entries.items():
+            if key not in self.entries and entry.get('path') not in paths and entry.get('path') not in self.removed:
+                self.entries[key] = entry
+
+    # -------------------------------------------------------------------------
+    def save(self):
+        """Write the catalog (call with the lock held)"""
+
+        self.merge()
+        tempname = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tempname, 'w') as f:
+                json.dump(self.entries, f)
+            if hasattr(os, 'replace'):
+                os.replace(tempname, self.path)
+            else:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tempname, self.path)
+            self.mtime = os.path.getmtime(self.path)
+        except (IOError, OSError):
+            pass
+
+    # -------------------------------------------------------------------------
+    def key(self, url):
+        """Key of the current version of a file: its path, modification time and size"""
+
+        path = os.path.abspath(url)
+        st = os.stat(path)
+        return '%s|%d|%d' % (path, int(st.st_mtime), st.st_size)
+
+    # -------------------------------------------------------------------------
+    def lookup(self, url, save=True):
+        """
+        Catalog entry for a layer's url (a dataset, a .pyr file or a scanned directory),
+        or None if it can not be read
+        """
+
+        if os.path.isdir(url):
+            return self.directory_entry(url)
+
+        try:
+            key = self.key(url)
+        except (IOError, OSError):
+            return None
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry
+
+        try:
+            if url.find('.pyr') >= 0:
+                # Extent and resolution of a .pyr file are those of the raster for the largest zoom levels
+                members = read_pyr(url)
+                entry = dataset_info(members[0][1])
+                if entry is not None:
+                    entry['pyr'] = [[zoom, os.path.abspath(raster_url)] for zoom, raster_url in members]
+            else:
+                entry = dataset_info(url)
+        except (IOError, OSError, ValueError, IndexError):
+            entry = None
+        if entry is None:
+            return None
+        entry['path'] = os.path.abspath(url)
+
+        with self.lock:
+            self.removed.discard(entry['path'])
+            # Drop entries for older versions of the same file
+            for old in [k for k, e in self.entries.items() if e.get('path') == entry['path']]:
+                del self.entries[old]
+            self.entries[key] = entry
+            if save:
+                self.save()
+        return entry
+
+    # -------------------------------------------------------------------------
+    def top_zoom(self, entry, profile, tilesize):
+        """Zoom level at which the whole dataset fits in about one tile"""
+
+        name = '%s/%d' % (profile, tilesize)
+        tminz = entry['tminz'].get(name)
+        if tminz is not None:
+            return tminz
+
+        ulx, uly, lrx, lry = clamp_extent(entry['extent'])
+        cols, rows = entry['cols'], entry['rows']
+        if profile == 'mercator':
+            tile_math = GlobalMercator()
+            ominx, omaxy = tile_math.LatLonToMeters(uly, ulx)
+            omaxx, ominy = tile_math.LatLonToMeters(lry, lrx)
+            pixelWidth = (omaxx - ominx) / cols
+        else:
+            tile_math = GlobalGeodetic()
+            pixelWidth = entry['resolution']
+        tminz = tile_math.ZoomForPixelSize( pixelWidth * max( cols, rows) / float(tilesize) )
+
+        with self.lock:
+            entry['tminz'][name] = tminz
+            if 'directory' not in entry:
+                self.save()
+        return tminz
+
+    # -------------------------------------------------------------------------
+    def datasets(self, directory):
+        """Entries of the datasets below a directory, leaving out those that are part of a .pyr file"""
+
+        prefix = os.path.join(os.path.abspath(directory), '')
+        entries = [e for e in list(self.entries.values()) if e.get('path', '').startswith(prefix)]
+        members = set()
+        for entry in entries:
+            for zoom, raster_url in entry.get('pyr', []):
+                members.add(raster_url)
+        return sorted([e for e in entries if e['path'] not in members], key=lambda e: e['path'])
+
+    # -------------------------------------------------------------------------
+    def directory_entry(self, directory):
+        """Combined extent (and finest resolution) of the datasets in a scanned directory"""
+
+        self.refresh()
+        entries = self.datasets(directory)
+        if not entries:
+            return None
+        ulx = min(e['extent'][0] for e in entries)
+        uly = max(e['extent'][1] for e in entries)
+        lrx = max(e['extent'][2] for e in entries)
+        lry = min(e['extent'][3] for e in entries)
+        resolution = min(e['resolution'] for e in entries)
+        return {
+            'extent': [ulx, uly, lrx, lry],
+            'cols': max(int((lrx - ulx) / resolution + 0.5), 1),
+            'rows': max(int((uly - lry) / resolution + 0.5), 1),
+            'resolution': resolution,
+            'tminz': {},
+            'path': os.path.abspath(directory),
+            'directory': True,
+        }
+
+    # -------------------------------------------------------------------------
+    def covering(self, url, south, west, north, east, tz=None):
+        """
+        Paths of the datasets of a layer that overlap a lat/lon box.  For a .pyr file,
+        this is the raster used at zoom level tz
+        """
+
+        self.refresh()
+        if os.path.isdir(url):
+            entries = self.datasets(url)
+        else:
+            entry = self.lookup(url)
+            if entry is None:
+                return []
+            if 'pyr' in entry:
+                entry = self.lookup(pyr_member(entry['pyr'], tz))
+                if entry is None:
+                    return []
+            entries = [entry]
+
+        paths = []
+        for entry in entries:
+            if 'pyr' in entry:
+                entry = self.lookup(pyr_member(entry['pyr'], tz))
+                if entry is None:
+                    continue
+            if overlaps(entry['extent'], south, west, north, east):
+                paths.append(entry['path'])
+        return paths
+
+    # -------------------------------------------------------------------------
+    def add_directories(self, directories):
+        """List directories in catalog.kml; their datasets show up as they are scanned (here or elsewhere)"""
+
+        directories = [os.path.abspath(directory) for directory in directories]
+        for directory in directories:
+            if directory not in self.directories:
+                self.directories.append(directory)
+        return directories
+
+    def scan(self, directories):
+        """Add the rasters below the given directories, and drop entries of files that are gone"""
+
+        directories = self.add_directories(directories)
+        for directory in directories:
+            for root, dirs, files in os.walk(directory):
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in RASTEREXTENSIONS:
+                        self.lookup(os.path.join(root, name), save=False)
+            with self.lock:
+                for key in [k for k, e in self.entries.items() if e.get('path', '').startswith(os.path.join(directory, ''))
+                            and not os.path.exists(e['path'])]:
+                    self.removed.add(self.entries[key]['path'])
+                    del self.entries[key]
+                self.save()
+
+###############################################################################
+
+# Shared by every request handled by this process
+catalog = RasterCatalog()
+
+def scan_directories(directories):
+    """Scan directories into the catalog file (the target of a separate scanning process)"""
+
+    catalog.scan(directories)
@@ -0,0 +1,155 @@
+# In-memory cache of kml responses, with their compressed encodings
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Kml compresses very well (10-20 times), which matters to clients on slow
+# links.  Responses are cached for a short time together with their gzip
+# encodings, so each document is generated and compressed at most once per
+# time-to-live.  Compression runs outside the lock; two threads may compress
+# the same body at the same time, in which case one result is kept.
+#
+
+import time
+import zlib
+import threading
+import metrics
+
+# Seconds that a response is reused for (children change as tiles are probed)
+CACHE_TTL = 60.0
+
+# Largest number of responses kept in memory, and their total (uncompressed) size in bytes
+CACHESIZE = 10000
+CACHEBYTES = 64 * 1024 * 1024
+
+# 1 (fastest) to 9 (smallest)
+GZIP_LEVEL = 6
+
+###############################################################################
+
+def accepted_encoding(environ):
+    """'gzip' if the client accepts gzip encoded responses, else 'identity'
+
+    A coding named explicitly takes precedence over "*", so that "gzip;q=0, *" refuses gzip."""
+
+    qvalues = {}
+    for part in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        vals = part.strip().split(';')
+        coding = vals[0].strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        q = 1.0
+        for param in vals[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = max(q, qvalues.get(coding, 0.0))
+    if qvalues.get('gzip', qvalues.get('*', 0.0)) > 0:
+        return 'gzip'
+    return 'identity'
+
+def gzip_bytes(data, level=GZIP_LEVEL):
+    """Data in gzip format"""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+###############################################################################
+
+class CachedResponse(object):
+    """A response body in its encodings ('identity' and, once asked for, 'gzip')"""
+
+    def __init__(self, body, content_type, compressible=True):
+        self.bodies = {'identity': body}
+        self.content_type = content_type
+        self.compressible = compressible
+        self.size = len(body)
+
+    # -------------------------------------------------------------------------
+    def encoded(self, encoding):
+        """Returns the encoding actually used, and the body in that encoding"""
+
+        if encoding == 'identity' or not self.compressible:
+            return 'identity', self.bodies['identity']
+        body = self.bodies.get(encoding)
+        if body is None:
+            body = gzip_bytes(self.bodies['identity'])
+            self.bodies[encoding] = body
+        return encoding, body
+
+###############################################################################
+
+class ResponseCache(object):
+    """Responses by request key, shared by all requests handled by a server process"""
+
+    def __init__(self, ttl=CACHE_TTL, cachesize=CACHESIZE, cachebytes=CACHEBYTES, name=None):
+        self.name = name
+        self.ttl = ttl
+        self.cachesize = cachesize
+        self.cachebytes = cachebytes
+        self.cache = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def get(self, key):
+        """The cached response for a key, or None"""
+
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is not None and entry[1] > time.time():
+            if self.name is not None:
+                metrics.cache_requests.inc(self.name, 'hit')
+            return entry[0]
+        if self.name is not None:
+            metrics.cache_requests.inc(self.name, 'miss')
+        return None
+
+    # -------------------------------------------------------------------------
+    def put(self, key, body, content_type, compressible=True):
+        """Cache a new response, and return it"""
+
+        response = CachedResponse(body, content_type, compressible)
+        now = time.time()
+        with self.lock:
+            if len(self.cache) >= self.cachesize or self.size + response.size > self.cachebytes:
+                self.purge(now)
+            old = self.cache.get(key)
+            if old is not None:
+                self.size -= old[0].size
+            self.cache[key] = (response, now + self.ttl)
+            self.size += response.size
+        return response
+
+    # -------------------------------------------------------------------------
+    def purge(self, now):
+        """Drop expired responses, or everything if the cache is still full (call with the lock held)"""
+
+        for key in [key for key, entry in self.cache.items() if entry[1] <= now]:
+            self.size -= self.cache[key][0].size
+            del self.cache[key]
+        if len(self.cache) >= self.cachesize or self.size >= self.cachebytes:
+            self.cache.clear()
+            self.size = 0
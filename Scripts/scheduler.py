@@ -0,0 +1,100 @@
+# Priority scheduling of queued requests onto a thread pool
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Google Earth needs the small kml documents before it can ask for anything
+# else, coarse tiles cover more of the view than fine ones, and the newest
+# requests belong to the current view.  Queued requests are therefore run
+# by rank (kml first, then tiles by zoom level), newest first within a
+# rank.  A request that has waited STARVATION_WAIT seconds is run before
+# anything else (oldest first), so that no request waits forever.
+#
+
+import time
+import threading
+from collections import deque
+
+# Rank of kml requests, and of tiles at zoom level 0 (tiles at zoom z have rank TILE_RANK + z)
+KML_RANK = 0
+TILE_RANK = 1
+
+# Lowest rank (ranks beyond this are run with it)
+MAXRANK = 32
+
+# Seconds after which a queued request is run before all others
+STARVATION_WAIT = 2.0
+
+###############################################################################
+
+class PriorityScheduler(object):
+    """
+    Runs queued work on a thread pool, lowest rank and newest first.  Servers that
+    share a pool share its scheduler.
+    """
+
+    def __init__(self, pool, starvation_wait=STARVATION_WAIT):
+        self.pool = pool
+        self.starvation_wait = starvation_wait
+        self.lock = threading.Lock()
+        self.ranks = [deque() for rank in range(MAXRANK + 1)]
+
+    # -------------------------------------------------------------------------
+    def submit(self, rank, func, args):
+        """Queue func(*args) with the given rank"""
+
+        rank = min(max(rank, 0), MAXRANK)
+        with self.lock:
+            self.ranks[rank].append((time.time(), func, args))
+        # Each submission lets one pool thread run the most urgent work queued at that time
+        self.pool.apply_async(self.run_next)
+
+    # -------------------------------------------------------------------------
+    def next(self):
+        """Remove and return the most urgent (func, args)"""
+
+        with self.lock:
+            oldest = None
+            first = None
+            for queue in self.ranks:
+                if not queue:
+                    continue
+                if first is None:
+                    first = queue
+                if oldest is None or queue[0][0] < oldest[0][0]:
+                    oldest = queue
+            if oldest is not None and time.time() - oldest[0][0] >= self.starvation_wait:
+                queued, func, args = oldest.popleft()
+            else:
+                queued, func, args = first.pop()
+        return func, args
+
+    def run_next(self):
+        func, args = self.next()
+        func(*args)
+
+    # -------------------------------------------------------------------------
+    def depths(self):
+        """Number of queued requests of each rank"""
+
+        with self.lock:
+            return [len(queue) for queue in self.ranks]
@@ -0,0 +1,98 @@
+# Start one multithreaded WSGI server process for both the kml and the map tiles
+
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+# 
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+# 
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+# 
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Serves kml on the kml port and tiles on the tile port of addr.txt, as the
+# two separate servers do, but from one process: GDAL, PIL and numpy are
+# loaded once, and the compiled layers, tile probes, availability indexes,
+# raster catalog and cached source tiles are shared by both sides.  Both
+# ports also accept either kind of request by path: /tiles/... goes to the
+# tile server, anything else to the kml server.
+#
+
+import sys,os
+import argparse
+import threading
+import multiprocessing.pool
+prefix = os.path.dirname(os.path.realpath(__file__)) + os.path.sep
+sys.path.insert(0, prefix)
+from wsgi_server import make_server, read_ports, serve_prefork
+from generate_kml import generate_kml
+from generate_tiles import generate_tiles, fallback_tile, tile_rank
+from scheduler import PriorityScheduler, TILE_RANK
+import kml_server_multi
+import profiling
+
+
+def combined_app(default_app, tiles_app=generate_tiles):
+    '''WSGI app routing /tiles/... to the tile server, and everything else to default_app'''
+    def app(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/tiles' or path.startswith('/tiles/'):
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + '/tiles'
+            environ['PATH_INFO'] = path[len('/tiles'):]
+            return tiles_app(environ, start_response)
+        return default_app(environ, start_response)
+    return app
+
+
+def combined_rank(path, querystring):
+    '''Scheduling rank of a request to the kml port: tiles by zoom level, anything else as kml'''
+    if path.startswith('/tiles/'):
+        return tile_rank(path[len('/tiles'):], querystring)
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve kml and map tiles to Google Earth from one process')
+    kml_server_multi.add_arguments(parser)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='number of threads shared by both ports (default: number of CPUs, per worker)')
+    args = parser.parse_args()
+    kml_server_multi.start_catalogs(args)
+
+    kmlport, tileport = read_ports()
+    print('KML streaming server running on port ' + str(kmlport))
+    print('Tile reprojection server running on port ' + str(tileport))
+
+    # Requests on both ports are profiled together
+    profiler = profiling.Profiler(args.profile, args.slow)
+    kml_app = profiler.wrap(generate_kml)
+    tiles_app = profiler.wrap(generate_tiles)
+
+    def make_servers(reuse_port=False):
+        # Kml and tile requests on both ports are run by one scheduler, kml first
+        scheduler = PriorityScheduler(multiprocessing.pool.ThreadPool(args.threads))
+        return [make_server('', kmlport, combined_app(kml_app, tiles_app), scheduler=scheduler,
+                            reuse_port=reuse_port, max_queue=args.queue, classify=combined_rank),
+                make_server('', tileport, tiles_app, scheduler=scheduler, reuse_port=reuse_port,
+                            max_queue=args.queue, fallback=fallback_tile, rank=TILE_RANK, classify=tile_rank)]
+
+    if args.workers > 0:
+        serve_prefork(lambda: make_servers(True), args.workers)
+        sys.exit(0)
+    kml_httpd, tile_httpd = make_servers()
+    tile_thread = threading.Thread(target=tile_httpd.serve_forever)
+    tile_thread.daemon = True
+    tile_thread.start()
+    kml_httpd.serve_forever()
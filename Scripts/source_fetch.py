@@ -0,0 +1,159 @@
+# Shared, cancellable fetches of upstream source tiles
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Neighbouring output tiles (and the geodetic tiles, which are mosaicked from
+# several Mercator tiles) often need the same source tile at the same time.
+# A source tile is fetched once, and every request that needs it while the
+# fetch is in progress waits for that one fetch.  When Google Earth gives up
+# on a tile (the view has moved on), its request stops waiting, and a fetch
+# that no request is waiting for any more is cancelled.  A fetch whose own
+# request has gone away is finished for the others, and cached.
+#
+
+import sys
+import threading
+import metrics
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from urllib2 import urlopen
+elif major == 3:
+    from urllib.request import urlopen
+
+# Bytes read from an upstream server at a time (abandoned fetches are cancelled between reads)
+FETCH_CHUNK = 16384
+
+# Seconds between checks of the client while waiting for a fetch made by another request
+WAIT_INTERVAL = 0.1
+
+# Seconds that connecting to an upstream server, or any one read from it, may take
+FETCH_TIMEOUT = 10.0
+
+###############################################################################
+
+class Abandoned(Exception):
+    """The client of a request went away; raised with the stage at which this was noticed"""
+
+
+# Work done (and saved) by this process, shared by every request it handles
+work = metrics.counter('getileserver_work_total', 'Upstream fetches, and work saved by sharing and abandoning it',
+                       ('kind',))
+for kind in ('source_fetches', 'source_fetches_shared', 'source_fetches_cancelled', 'source_tiles_skipped',
+             'tiles_abandoned_before_render', 'tiles_abandoned_fetching', 'tiles_abandoned_before_warp'):
+    work.add(0, kind)
+
+###############################################################################
+
+class SourceFetch(object):
+    """One fetch in progress, and the number of requests waiting for it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+        self.waiters = 1
+
+
+class SourceFetches(object):
+    """Upstream fetches in progress, shared by the requests that need the same url"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.fetches = {}
+
+    # -------------------------------------------------------------------------
+    def get(self, url, client_gone):
+        """
+        The body of an upstream url, fetched once for all requests that ask for it
+        at the same time.  Raises Abandoned if client_gone() becomes True first
+        """
+
+        with self.lock:
+            fetch = self.fetches.get(url)
+            owner = fetch is None
+            if owner:
+                fetch = SourceFetch()
+                self.fetches[url] = fetch
+            else:
+                fetch.waiters += 1
+        if owner:
+            return self.run(url, fetch, client_gone)
+
+        work.inc('source_fetches_shared')
+        while not fetch.done.wait(WAIT_INTERVAL):
+            if client_gone():
+                with self.lock:
+                    fetch.waiters -= 1
+                raise Abandoned('fetching')
+        if fetch.error is not None:
+            raise fetch.error
+        return fetch.data
+
+    # -------------------------------------------------------------------------
+    def run(self, url, fetch, client_gone):
+        """Fetch a url for all waiting requests, cancelling it when none is left"""
+
+        work.inc('source_fetches')
+        gone = False
+        start = metrics.clock()
+        try:
+            response = urlopen(url, timeout=FETCH_TIMEOUT)
+            try:
+                chunks = []
+                while True:
+                    if not gone and client_gone():
+                        gone = True
+                        with self.lock:
+                            fetch.waiters -= 1
+                    if gone:
+                        with self.lock:
+                            if fetch.waiters == 0:
+                                del self.fetches[url]
+                                work.inc('source_fetches_cancelled')
+                                raise Abandoned('fetching')
+                    chunk = response.read(FETCH_CHUNK)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                response.close()
+            fetch.data = b''.join(chunks)
+            metrics.stage_seconds.observe(metrics.clock() - start, 'fetch')
+            self.cache.put(url, fetch.data, 'image', False)
+        except Abandoned:
+            raise
+        except Exception as e:
+            metrics.errors.inc('upstream')
+            fetch.error = e
+        finally:
+            with self.lock:
+                if self.fetches.get(url) is fetch:
+                    del self.fetches[url]
+            fetch.done.set()
+
+        if gone:
+            raise Abandoned('fetching')
+        if fetch.error is not None:
+            raise fetch.error
+        return fetch.data
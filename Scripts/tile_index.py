@@ -0,0 +1,240 @@
+# Persistent index of web tile subtrees that are known to have no data
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# A tile that upstream does not have is taken to mean that nothing below it
+# exists either (as for regional sources such as NZTopo over the ocean).  Each
+# layer keeps one "all empty below" marker per such tile, keyed by its
+# quadkey, so that a tile is known to be empty when a prefix of its own key
+# is marked.  The key of tile (z, x, y) is the quadkey of (z + 1, x, y), which
+# gives the two columns of level 0 of the geodetic grid a digit of their own
+# (and the Mercator root a key that is not empty).  Markers are appended to a
+# small text file ("quadkey time" per line) so that they survive restarts and
+# are picked up by both the kml and the tile server processes.
+# Markers expire after MARKER_TTL, so that tiles that upstream publishes later
+# (or that were missing only for a while) are found again.  Expired markers
+# are dropped from memory as they are met, and once the file has grown past
+# MAXINDEXBYTES it is rewritten with only the markers that are still live.
+#
+
+import os
+import time
+import hashlib
+import threading
+import tile_math
+from tile_math import GlobalMercator
+
+INDEXDIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tileindex')
+
+# Seconds between checks of the index file for markers written by other processes
+REFRESH_INTERVAL = 1.0
+
+# Seconds that a marker is trusted for
+MARKER_TTL = 24 * 3600.0
+
+# Size of an index file at which it is rewritten without its expired markers
+MAXINDEXBYTES = 262144
+
+# Seconds between sweeps of the expired markers held in memory
+PURGE_INTERVAL = 60.0
+
+# Quadkeys of single tiles
+MERCATOR = GlobalMercator()
+
+###############################################################################
+
+class TileIndex(object):
+    """Known-empty subtrees of one layer, in the layer's own tile coordinates"""
+
+    def __init__(self, path, ttl=MARKER_TTL, maxbytes=MAXINDEXBYTES):
+        self.path = path
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        # Size of the file at which it is next compacted
+        self.compact_at = maxbytes
+        # Time at which each marker was written, by quadkey
+        self.empty = {}
+        self.inode = None
+        self.offset = 0
+        self.checked = 0
+        self.purged = time.time()
+        self.lock = threading.Lock()
+        self.refresh(force=True)
+
+    # -------------------------------------------------------------------------
+    def refresh(self, force=False):
+        """Read markers appended to the index file since it was last read (or all of it, once it has been compacted)"""
+
+        now = time.time()
+        if not force and now - self.checked < REFRESH_INTERVAL:
+            return
+        self.checked = now
+        if now - self.purged >= PURGE_INTERVAL:
+            self.purge(now)
+        try:
+            st = os.stat(self.path)
+            if st.st_ino != self.inode:
+                # Compacted by another process: read the new file from the start
+                with self.lock:
+                    self.inode = st.st_ino
+                    self.offset = 0
+                    self.empty = {}
+            if st.st_size <= self.offset:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except (IOError, OSError):
+            return
+
+        with self.lock:
+            end = self.read_markers(data, now - self.ttl, self.empty)
+            self.offset = self.offset + end
+
+    def read_markers(self, data, oldest, markers):
+        """Add the live markers of a part of the file to `markers`; returns the length of its complete lines"""
+
+        # Ignore a trailing line that is still being written (and markers without a time,
+        # or that have expired)
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('ascii').splitlines():
+            vals = line.split()
+            if len(vals) == 2 and float(vals[1]) > oldest:
+                markers[vals[0]] = float(vals[1])
+        return end
+
+    def purge(self, now):
+        """Drop the expired markers held in memory"""
+
+        oldest = now - self.ttl
+        with self.lock:
+            self.purged = now
+            self.empty = dict((key, written) for key, written in self.empty.items() if written > oldest)
+
+    # -------------------------------------------------------------------------
+    def is_empty(self, tx, ty, tz):
+        """True if the tile or one of its ancestors is known to have no data"""
+
+        self.refresh()
+        return self.key_empty(tile_key(tx, ty, tz), time.time() - self.ttl)
+
+    def without_empty(self, tiles):
+        """The [x, y, z] tiles that are not known to have no data (with their keys worked out at once)"""
+
+        self.refresh()
+        if not self.empty:
+            return tiles
+        keys = tile_math.quadkeys([t[2] + 1 for t in tiles], [t[0] for t in tiles], [t[1] for t in tiles])
+        oldest = time.time() - self.ttl
+        return [tile for tile, key in zip(tiles, keys) if not self.key_empty(key, oldest)]
+
+    def key_empty(self, key, oldest):
+        """True if a prefix of the key (the tile or one of its ancestors) was marked after `oldest`"""
+
+        empty = self.empty
+        if not empty:
+            return False
+        for n in range(1, len(key) + 1):
+            written = empty.get(key[:n])
+            if written is not None:
+                if written > oldest:
+                    return True
+                empty.pop(key[:n], None)
+        return False
+
+    # -------------------------------------------------------------------------
+    def mark_empty(self, tx, ty, tz):
+        """Record that upstream has no data for this tile (or anywhere below it)"""
+
+        if self.is_empty(tx, ty, tz):
+            return
+        key = tile_key(tx, ty, tz)
+        now = time.time()
+        with self.lock:
+            self.empty[key] = now
+            try:
+                if not os.path.exists(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                with open(self.path, 'a') as f:
+                    f.write('%s %d\n' % (key, now))
+                    size = f.tell()
+                if size >= self.compact_at:
+                    self.compact(now)
+            except (IOError, OSError):
+                pass
+
+    # -------------------------------------------------------------------------
+    def compact(self, now):
+        """Rewrite the file with only its live markers (call with the lock held)"""
+
+        oldest = now - self.ttl
+        # Markers written by every process, and those of this one that are not in the file
+        markers = {}
+        with open(self.path, 'rb') as f:
+            self.read_markers(f.read(), oldest, markers)
+        for key, written in self.empty.items():
+            if written > oldest and written > markers.get(key, 0):
+                markers[key] = written
+        self.empty = markers
+        tmpname = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmpname, 'w') as f:
+            for key, written in markers.items():
+                f.write('%s %d\n' % (key, written))
+        if hasattr(os, 'replace'):
+            os.replace(tmpname, self.path)
+        else:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmpname, self.path)
+        st = os.stat(self.path)
+        self.inode = st.st_ino
+        self.offset = st.st_size
+        # Live markers alone may fill much of the file, so it is only compacted again once it has doubled
+        self.compact_at = max(self.maxbytes, 2 * st.st_size)
+
+###############################################################################
+
+_indexes = {}
+_lock = threading.Lock()
+
+def tile_key(tx, ty, tz):
+    """Key of a tile in the index: the quadkey of (tx, ty) read as a tile of level tz + 1"""
+
+    return MERCATOR.QuadTree(tx, ty, tz + 1)
+
+def layer_key(url, profile, tilesize):
+    """Stable key for a layer's tile grid (source url template, profile and tile size)"""
+
+    key = '%s|%s|%s' % (url, profile, tilesize)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+def get_index(url, profile, tilesize):
+    """Returns the (shared) availability index for a layer"""
+
+    key = layer_key(url, profile, tilesize)
+    with _lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = TileIndex(os.path.join(INDEXDIR, key + '.txt'))
+            _indexes[key] = index
+    return index
@@ -0,0 +1,145 @@
+# Cached, timeout-bounded existence checks for upstream web tiles
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import sys
+import time
+import threading
+import multiprocessing.pool
+import metrics
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from urllib2 import urlopen, Request, HTTPError
+elif major == 3:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+
+# Seconds to wait for an upstream server before giving up on a probe
+PROBE_TIMEOUT = 2.0
+
+# Seconds that a probe result is reused for
+PROBE_TTL = 3600.0
+
+# Largest number of probe results kept in memory
+PROBE_CACHESIZE = 100000
+
+# Probes of one kml response that are made at the same time
+PROBE_THREADS = 8
+
+# HTTP status codes meaning that the upstream server has no tile
+MISSING_STATUS = (204, 404, 410)
+
+###############################################################################
+
+class TileProbe(object):
+    """
+    Checks whether web tiles exist using HEAD (or single byte range) requests,
+    and remembers the answers for a limited time.  One instance is shared by
+    all requests handled by a server process.
+    """
+
+    def __init__(self, timeout=PROBE_TIMEOUT, ttl=PROBE_TTL, cachesize=PROBE_CACHESIZE):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.cachesize = cachesize
+        self.cache = {}
+        self.lock = threading.Lock()
+        # Started on first use (after the worker processes have been forked)
+        self.pool = None
+
+    # -------------------------------------------------------------------------
+    def exists(self, url):
+        """Returns False only if the upstream server says that the tile is missing"""
+
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(url)
+        if entry is not None and entry[1] > now:
+            metrics.probe_results.inc('cached')
+            return entry[0]
+
+        exists = self.probe(url)
+        if exists is None:
+            # Timeouts and server errors are not cached, and the tile is assumed to exist
+            metrics.probe_results.inc('unknown')
+            return True
+        metrics.probe_results.inc(exists and 'exists' or 'missing')
+
+        with self.lock:
+            if len(self.cache) >= self.cachesize:
+                self.purge(now)
+            self.cache[url] = (exists, now + self.ttl)
+        return exists
+
+    def exists_many(self, urls):
+        """exists() of each url, asking the upstream server about several at the same time"""
+
+        if len(urls) <= 1:
+            return [self.exists(url) for url in urls]
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.pool.ThreadPool(PROBE_THREADS)
+        return self.pool.map(self.exists, urls)
+
+    # -------------------------------------------------------------------------
+    def purge(self, now):
+        """Drop expired results, or everything if the cache is still full (call with the lock held)"""
+
+        for url in [url for url, entry in self.cache.items() if entry[1] <= now]:
+            del self.cache[url]
+        if len(self.cache) >= self.cachesize:
+            self.cache.clear()
+
+    # -------------------------------------------------------------------------
+    def probe(self, url):
+        """Ask the upstream server about a tile.  Returns True, False, or None if unknown"""
+
+        for method in ('HEAD', 'GET'):
+            request = Request(url)
+            request.get_method = lambda method=method: method
+            if method == 'GET':
+                # Some tile servers do not implement HEAD; only ask for the first byte
+                request.add_header('Range', 'bytes=0-0')
+            response = None
+            try:
+                response = urlopen(request, timeout=self.timeout)
+                status = response.getcode()
+                if status in MISSING_STATUS:
+                    return False
+                return True
+            except HTTPError as e:
+                if e.code in MISSING_STATUS:
+                    return False
+                if e.code not in (405, 501):
+                    return None
+            except Exception:
+                return None
+            finally:
+                if response is not None:
+                    response.close()
+        return None
+
+###############################################################################
+
+# Shared by every request handled by this process
+probe = TileProbe()
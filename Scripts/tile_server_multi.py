@@ -23,48 +23,36 @@
 ###############################################################################
 
 import sys,os
-from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
-import multiprocessing.pool
+import argparse
 prefix = os.path.dirname(os.path.realpath(__file__)) + os.path.sep
 sys.path.insert(0, prefix)
-from generate_tiles import generate_tiles
-    
-class ThreadPoolWSGIServer(WSGIServer):
-    '''WSGI-compliant HTTP server.  Dispatches requests to a pool of threads.'''
-
-    def __init__(self, thread_count=None, *args, **kwargs):
-        '''If 'thread_count' == None, we'll use multiprocessing.cpu_count() threads.'''
-        WSGIServer.__init__(self, *args, **kwargs)
-        self.thread_count = thread_count
-        self.pool = multiprocessing.pool.ThreadPool(self.thread_count)
-
-    # Inspired by SocketServer.ThreadingMixIn.
-    def process_request_thread(self, request, client_address):
-        try:
-            self.finish_request(request, client_address)
-        except:
-            self.handle_error(request, client_address)
-
-    def process_request(self, request, client_address):
-        self.pool.apply_async(self.process_request_thread, args=(request, client_address))
-
-
-def make_server(host, port, app, thread_count=None, handler_class=WSGIRequestHandler):
-    '''Create a new WSGI server listening on `host` and `port` for `app`'''
-    httpd = ThreadPoolWSGIServer(thread_count, (host, port), handler_class)
-    httpd.set_app(app)
-    return httpd
+from wsgi_server import make_server, read_ports, serve_prefork, MAXQUEUE
+from generate_tiles import generate_tiles, fallback_tile, tile_rank
+from scheduler import TILE_RANK
+import profiling
 
     
 if __name__ == '__main__':
-    addr_file = os.path.abspath(__file__).replace(os.path.basename(__file__),'') + '/addr.txt'
-    with open(addr_file) as f:
-        for line in f:
-            vals = line.split(' ')
-            port = vals[2].strip()
+    parser = argparse.ArgumentParser(description='Reproject map tiles for Google Earth')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='serve from this many worker processes sharing the port (SIGHUP replaces them, '
+                             'with the code loaded at startup); default: serve from this process')
+    parser.add_argument('--queue', type=int, default=MAXQUEUE,
+                        help='connections that may wait for a thread; others get a tile cut from a cached '
+                             'coarser tile, or a 503 (default: %(default)s)')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    port = str(read_ports()[1])
                 
     print('Tile reprojection server running on port ' + port)
-    httpd = make_server('', int(port), generate_tiles)
+    app = profiling.Profiler(args.profile, args.slow).wrap(generate_tiles)
+    if args.workers > 0:
+        serve_prefork(lambda: [make_server('', int(port), app, reuse_port=True, max_queue=args.queue,
+                                            fallback=fallback_tile, rank=TILE_RANK, classify=tile_rank)],
+                      args.workers)
+        sys.exit(0)
+    httpd = make_server('', int(port), app, max_queue=args.queue, fallback=fallback_tile,
+                        rank=TILE_RANK, classify=tile_rank)
     environ = dict(os.environ.items())
     environ['wsgi.errors']       = sys.stderr
     httpd.serve_forever()
@@ -0,0 +1,206 @@
+# Compiled source url templates shared by the kml and tile servers
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Placeholders understood in source urls (tile coordinates are TMS, with the
+# origin in the bottom-left corner):
+#
+#   {$x}                  tile column
+#   {$y}                  tile row counted from the top (Google/XYZ)
+#   {$invY}, {$inv_y}     tile row counted from the bottom (TMS)
+#   {$z}                  zoom level
+#   {$s}                  server part (one of the layer's serverparts)
+#   {$q}, {$quadkey}      Microsoft QuadTree key (GlobalMercator.QuadTree)
+#   WMS:BBOX              BBOX=west,south,east,north of the tile
+#   WMS:SRS               srs=EPSG:3857 (mercator) or srs=EPSG:4326 (geodetic)
+#   WMS:WIDTH             WIDTH=256
+#   WMS:HEIGHT            HEIGHT=<tile height in pixels, for a width of 256>
+#
+# Urls are only rendered for 256 pixel tiles: larger output tiles are always
+# composited by the tile server from 256 pixel source tiles.
+#
+
+import re
+import tile_math
+from tile_math import GlobalMercator, GlobalGeodetic
+
+PLACEHOLDERS = re.compile(r'(\{\$(?:x|y|invY|inv_y|z|s|q|quadkey)\}|WMS:(?:BBOX|SRS|WIDTH|HEIGHT))')
+
+# Placeholders that need the tile bounds
+WMS_PLACEHOLDERS = ('WMS:BBOX', 'WMS:WIDTH', 'WMS:HEIGHT')
+
+# Placeholders whose value only depends on the zoom level
+LEVEL_PLACEHOLDERS = ('{$z}', 'WMS:SRS', 'WMS:WIDTH')
+
+# Width in pixels of the tiles that urls are rendered for
+TILESIZE = 256
+
+###############################################################################
+
+class UrlTemplate(object):
+    """
+    A source url split once into literal text and placeholders, so that a tile
+    url is rendered with a single join
+    """
+
+    def __init__(self, template, profile='mercator'):
+        self.template = template
+        self.profile = profile
+
+        self.segments = PLACEHOLDERS.split(template)
+        # Odd segments are placeholders, even segments literal text
+        self.slots = [(i, self.segments[i]) for i in range(1, len(self.segments), 2)]
+        self.names = set(name for i, name in self.slots)
+        self.wms = len(self.names.intersection(WMS_PLACEHOLDERS)) > 0
+
+        if profile == 'geodetic':
+            self.geodetic = GlobalGeodetic(TILESIZE)
+        self.mercator = GlobalMercator(TILESIZE)
+
+    # -------------------------------------------------------------------------
+    def values(self, tx, ty, tz, serverpart=''):
+        """Values of the placeholders used by this template for one tile"""
+
+        names = self.names
+        values = {}
+        if '{$x}' in names:
+            values['{$x}'] = str(tx)
+        if '{$y}' in names:
+            values['{$y}'] = str((2**tz) - ty - 1)
+        if '{$invY}' in names or '{$inv_y}' in names:
+            values['{$invY}'] = values['{$inv_y}'] = str(ty)
+        if '{$z}' in names:
+            values['{$z}'] = str(tz)
+        if '{$s}' in names:
+            values['{$s}'] = serverpart
+        if '{$q}' in names or '{$quadkey}' in names:
+            values['{$q}'] = values['{$quadkey}'] = self.mercator.QuadTree(tx, ty, tz)
+        if 'WMS:SRS' in names:
+            if self.profile == 'geodetic':
+                values['WMS:SRS'] = 'srs=EPSG:4326'
+            else:
+                values['WMS:SRS'] = 'srs=EPSG:3857'
+        if self.wms:
+            if self.profile == 'geodetic':
+                s, w, n, e = self.geodetic.TileLatLonBounds(tx, ty, tz)
+            else:
+                w, s, e, n = self.mercator.TileBounds(tx, ty, tz)
+            width = TILESIZE
+            height = int(width/(e-w)*(n-s))
+            values['WMS:BBOX'] = 'BBOX=' + str(w) + ',' + str(s) + ',' + str(e) + ',' + str(n)
+            values['WMS:WIDTH'] = 'WIDTH=' + str(width)
+            values['WMS:HEIGHT'] = 'HEIGHT=' + str(height)
+        return values
+
+    # -------------------------------------------------------------------------
+    def render(self, tx, ty, tz, serverpart=''):
+        """Url of a single tile"""
+
+        if not self.slots:
+            return self.template
+        values = self.values(tx, ty, tz, serverpart)
+        parts = list(self.segments)
+        for i, name in self.slots:
+            parts[i] = values[name]
+        return ''.join(parts)
+
+    # -------------------------------------------------------------------------
+    def level_parts(self, tz):
+        """
+        The template at one zoom level: its literal text, with the placeholders that only
+        depend on the zoom level filled in, around the names of the remaining placeholders
+        """
+
+        values = {'{$z}': str(tz), 'WMS:WIDTH': 'WIDTH=' + str(TILESIZE)}
+        if self.profile == 'geodetic':
+            values['WMS:SRS'] = 'srs=EPSG:4326'
+        else:
+            values['WMS:SRS'] = 'srs=EPSG:3857'
+        texts = [self.segments[0]]
+        names = []
+        for i, name in self.slots:
+            if name in LEVEL_PLACEHOLDERS:
+                texts[-1] = texts[-1] + values[name] + self.segments[i + 1]
+            else:
+                names.append(name)
+                texts.append(self.segments[i + 1])
+        return texts, names
+
+    def tile_values(self, tiles, serverparts):
+        """Values of the per-tile placeholders used by this template, as one list per placeholder"""
+
+        names = self.names
+        tx = [t[0] for t in tiles]
+        ty = [t[1] for t in tiles]
+        tz = [t[2] for t in tiles]
+        columns = {}
+        if '{$x}' in names:
+            columns['{$x}'] = [str(x) for x in tx]
+        if '{$y}' in names:
+            columns['{$y}'] = [str((2**z) - y - 1) for y, z in zip(ty, tz)]
+        if '{$invY}' in names or '{$inv_y}' in names:
+            columns['{$invY}'] = columns['{$inv_y}'] = [str(y) for y in ty]
+        if '{$s}' in names:
+            columns['{$s}'] = [serverparts[(x + y) % len(serverparts)] for x, y in zip(tx, ty)]
+        if '{$q}' in names or '{$quadkey}' in names:
+            columns['{$q}'] = columns['{$quadkey}'] = tile_math.quadkeys(tz, tx, ty)
+        if self.wms:
+            if self.profile == 'geodetic':
+                bounds = tile_math.geodetic_latlon_bounds(tz, tx, ty, TILESIZE)
+                south, west, north, east = [column.tolist() for column in bounds]
+            else:
+                bounds = tile_math.mercator_bounds(tz, tx, ty, TILESIZE)
+                west, south, east, north = [column.tolist() for column in bounds]
+            columns['WMS:BBOX'] = ['BBOX=' + str(w) + ',' + str(s) + ',' + str(e) + ',' + str(n)
+                                   for w, s, e, n in zip(west, south, east, north)]
+            columns['WMS:HEIGHT'] = ['HEIGHT=' + str(int(TILESIZE/(e-w)*(n-s)))
+                                     for w, s, e, n in zip(west, south, east, north)]
+        return columns
+
+    # -------------------------------------------------------------------------
+    def render_many(self, tiles, serverparts=None):
+        """
+        Urls of many (tx, ty, tz) tiles, the same as render() gives.  The template is filled
+        in once per zoom level, and the per-tile values (quadkeys and WMS bounds with the
+        batch tile math) are worked out for all tiles at once.  Server parts are picked by
+        tile position, so that a tile is always fetched from the same server
+        """
+
+        if not self.slots:
+            return [self.template] * len(tiles)
+        if not serverparts:
+            serverparts = ['']
+        columns = self.tile_values(tiles, serverparts)
+        levels = {}
+        urls = []
+        for i, (tx, ty, tz) in enumerate(tiles):
+            level = levels.get(tz)
+            if level is None:
+                level = levels[tz] = self.level_parts(tz)
+            texts, names = level
+            parts = [texts[0]]
+            for name, text in zip(names, texts[1:]):
+                parts.append(columns[name][i])
+                parts.append(text)
+            urls.append(''.join(parts))
+        return urls
@@ -0,0 +1,481 @@
+# Multithreaded WSGI server shared by the kml and tile servers
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import threading
+import traceback
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+import multiprocessing.pool
+from keepalive import KeepAliveRequestHandler, ConnectionPoller, client_gone
+from scheduler import PriorityScheduler, KML_RANK
+import metrics
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from urllib import unquote
+elif major == 3:
+    from urllib.parse import unquote
+
+ADDRFILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'addr.txt')
+
+# Seconds between checks of the worker processes in pre-fork mode
+SUPERVISE_INTERVAL = 0.2
+
+# Workers that exit sooner than this after being started are restarted after this delay
+RESPAWN_DELAY = 1.0
+
+# Accepted connections that may wait for a thread.  Connections beyond this are
+# answered at once with a 503 (or a fallback tile) instead of queueing
+MAXQUEUE = 64
+
+# Seconds that clients are asked to wait before retrying a request that was turned away
+RETRY_AFTER = 1
+
+# Seconds allowed for reading the request line of a connection that is turned away
+SHED_TIMEOUT = 0.5
+
+# Bytes of a new request looked at to rank it
+PEEKBYTES = 2048
+
+###############################################################################
+
+def read_ports(addr_file=ADDRFILE):
+    """Ports of the kml and the tile server, from addr.txt ("http://localhost 8081 8082")"""
+
+    with open(addr_file) as f:
+        for line in f:
+            vals = line.split(' ')
+            kmlport = vals[1].strip()
+            tileport = vals[2].strip()
+    return int(kmlport), int(tileport)
+
+class QueueStats(object):
+    '''Admission counters of one server: queue depth, wait times and requests turned away'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.max_depth = 0
+        self.admitted = 0
+        self.shed = 0
+        self.fallbacks = 0
+        self.dropped = 0
+        self.abandoned = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def admit(self, limit):
+        '''Count a connection into the queue, unless the queue is full (returns False)'''
+        with self.lock:
+            if self.depth >= limit:
+                self.shed += 1
+                return False
+            self.depth += 1
+            self.admitted += 1
+            if self.depth > self.max_depth:
+                self.max_depth = self.depth
+            return True
+
+    def started(self, wait):
+        '''A queued connection was picked up by a thread after waiting `wait` seconds'''
+        with self.lock:
+            self.depth -= 1
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+
+
+# Servers of this process, for the metrics
+servers = []
+
+def queue_depths():
+    return dict(((str(httpd.server_address[1]),), httpd.stats.depth) for httpd in list(servers))
+
+def queue_waits():
+    return dict(((str(httpd.server_address[1]),), httpd.stats.wait_total) for httpd in list(servers))
+
+def queue_max_depths():
+    return dict(((str(httpd.server_address[1]),), httpd.stats.max_depth) for httpd in list(servers))
+
+def queue_max_waits():
+    return dict(((str(httpd.server_address[1]),), httpd.stats.wait_max) for httpd in list(servers))
+
+def connection_counts():
+    counts = {}
+    for httpd in list(servers):
+        port = str(httpd.server_address[1])
+        stats = httpd.stats
+        for outcome, value in (('admitted', stats.admitted), ('shed', stats.shed), ('fallback', stats.fallbacks),
+                               ('dropped', stats.dropped), ('abandoned', stats.abandoned)):
+            counts[(port, outcome)] = value
+    return counts
+
+metrics.function_metric('getileserver_queue_depth', 'Connections waiting for a thread', 'gauge', ('port',),
+                        queue_depths)
+metrics.function_metric('getileserver_queue_max_depth', 'Most connections that have waited for a thread at once',
+                        'gauge', ('port',), queue_max_depths)
+metrics.function_metric('getileserver_queue_wait_max_seconds', 'Longest time a connection has waited for a thread',
+                        'gauge', ('port',), queue_max_waits)
+metrics.function_metric('getileserver_queue_wait_seconds_total', 'Time connections have waited for a thread',
+                        'counter', ('port',), queue_waits)
+metrics.function_metric('getileserver_connections_total', 'Connections by what became of them', 'counter',
+                        ('port', 'outcome'), connection_counts)
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    '''WSGI-compliant HTTP server.  Dispatches requests to a pool of threads.'''
+
+    def __init__(self, thread_count=None, *args, **kwargs):
+        '''If 'thread_count' == None, we'll use multiprocessing.cpu_count() threads.
+        Servers can share one pool by passing it as 'pool'.  With 'reuse_port', several
+        processes can listen on the same port, and the kernel spreads the connections.
+        At most 'max_queue' connections wait for a thread; the others are answered by
+        'fallback(path, querystring)' if it returns a (content type, body) pair, or else
+        with a 503.  Queued requests are run by their 'classify(path, querystring)' rank,
+        or by the server's 'rank' if that returns None; servers sharing a pool should
+        share its 'scheduler' too.'''
+        pool = kwargs.pop('pool', None)
+        scheduler = kwargs.pop('scheduler', None)
+        self.reuse_port = kwargs.pop('reuse_port', False)
+        self.max_queue = kwargs.pop('max_queue', MAXQUEUE)
+        self.fallback = kwargs.pop('fallback', None)
+        self.rank = kwargs.pop('rank', KML_RANK)
+        self.classify = kwargs.pop('classify', None)
+        WSGIServer.__init__(self, *args, **kwargs)
+        self.thread_count = thread_count
+        if scheduler is not None:
+            pool = scheduler.pool
+        if pool is None:
+            pool = multiprocessing.pool.ThreadPool(self.thread_count)
+        if scheduler is None:
+            scheduler = PriorityScheduler(pool)
+        self.pool = pool
+        self.scheduler = scheduler
+        servers.append(self)
+        self.stats = QueueStats()
+        # Turned away connections are answered by one separate thread, so that a slow
+        # client can not hold up accepting connections
+        self.shed_pool = multiprocessing.pool.ThreadPool(1)
+        self.shed_pending = 0
+        self.shed_lock = threading.Lock()
+        # Idle persistent connections wait in the poller (Python 3 only), which queues them again
+        # when their next request arrives.  served counts the requests of each resumed connection
+        self.served = {}
+        self.poller = None
+        if major == 3:
+            self.poller = ConnectionPoller(self.resume_request, self.shutdown_request)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        WSGIServer.server_bind(self)
+
+    def get_app(self):
+        return self.status_app
+
+    def status_app(self, environ, start_response):
+        '''Answers METRICS_PATH, and passes everything else on to the application'''
+        path = environ.get('PATH_INFO', '')
+        if path == metrics.METRICS_PATH:
+            body = metrics.registry.text().encode('utf-8')
+            content_type = metrics.CONTENT_TYPE
+        else:
+            try:
+                return self.application(environ, start_response)
+            except:
+                metrics.errors.inc('application')
+                raise
+        start_response('200 OK', [('Content-Type', content_type),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    # Inspired by SocketServer.ThreadingMixIn.
+    def process_request_thread(self, request, client_address, accepted):
+        self.stats.started(time.time() - accepted)
+        handler = None
+        try:
+            if client_gone(request):
+                # The client gave up while the request was queued
+                with self.stats.lock:
+                    self.stats.abandoned += 1
+                return
+            handler = self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        finally:
+            if self.poller is not None and getattr(handler, 'keep_alive', False):
+                self.poller.park(request, client_address, handler.served)
+            else:
+                self.shutdown_request(request)
+
+    def resume_request(self, request, client_address, served):
+        '''Queue a persistent connection again, once its next request has arrived'''
+        self.served[request] = served
+        try:
+            self.process_request(request, client_address)
+        except ValueError:
+            # The server is shutting down, and its pool no longer takes requests
+            self.shutdown_request(request)
+
+    def requests_served(self, request):
+        '''Number of requests that were already served over a connection'''
+        return self.served.pop(request, 0)
+
+    def shutdown_request(self, request):
+        self.served.pop(request, None)
+        WSGIServer.shutdown_request(self, request)
+
+    def server_close(self):
+        if self in servers:
+            servers.remove(self)
+        WSGIServer.server_close(self)
+        if self.poller is not None:
+            self.poller.close()
+
+    def request_rank(self, request, client_address):
+        '''
+        Scheduling rank of the request on a connection, from its request line.  Returns None
+        (and hands the connection to the poller, or closes it) if no request has arrived
+        '''
+        timeout = request.gettimeout()
+        try:
+            request.settimeout(0.0)
+            data = request.recv(PEEKBYTES, socket.MSG_PEEK)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.shutdown_request(request)
+                return None
+            if self.poller is not None:
+                # Wait for the request without taking a place in the queue
+                self.poller.park(request, client_address, self.served.pop(request, 0))
+                return None
+            return self.rank
+        finally:
+            try:
+                request.settimeout(timeout)
+            except socket.error:
+                pass
+        if not data:
+            # Closed by the client
+            self.shutdown_request(request)
+            return None
+
+        requestline = data.split(b'\r\n', 1)[0].decode('latin-1').split()
+        if len(requestline) >= 2 and self.classify is not None:
+            path, _, querystring = requestline[1].partition('?')
+            try:
+                rank = self.classify(unquote(path), querystring)
+            except Exception:
+                rank = None
+            if rank is not None:
+                return rank
+        return self.rank
+
+    def process_request(self, request, client_address):
+        rank = self.request_rank(request, client_address)
+        if rank is None:
+            return
+        if not self.stats.admit(self.max_queue):
+            with self.shed_lock:
+                if self.shed_pending >= self.max_queue:
+                    # Even the answers to turned away connections are backed up
+                    with self.stats.lock:
+                        self.stats.dropped += 1
+                    self.shutdown_request(request)
+                    return
+                self.shed_pending += 1
+            self.shed_pool.apply_async(self.shed_request, args=(request, client_address))
+            return
+        self.scheduler.submit(rank, self.process_request_thread, (request, client_address, time.time()))
+
+    def shed_request(self, request, client_address):
+        '''Answer a connection that did not fit in the queue, without running the application'''
+        try:
+            request.settimeout(SHED_TIMEOUT)
+            data = b''
+            while b'\r\n\r\n' not in data and len(data) < 65536:
+                chunk = request.recv(8192)
+                if not chunk:
+                    break
+                data += chunk
+            requestline = data.split(b'\r\n', 1)[0].decode('latin-1').split()
+
+            fallback = None
+            if len(requestline) >= 2 and self.fallback is not None:
+                path, _, querystring = requestline[1].partition('?')
+                try:
+                    fallback = self.fallback(unquote(path), querystring)
+                except Exception:
+                    fallback = None
+            if fallback is not None:
+                content_type, body = fallback
+                status = '200 OK'
+                headers = [('Content-Type', content_type), ('Cache-Control', 'no-store')]
+                with self.stats.lock:
+                    self.stats.fallbacks += 1
+            else:
+                body = b'Server busy, please retry\n'
+                status = '503 Service Unavailable'
+                headers = [('Content-Type', 'text/plain'), ('Retry-After', str(RETRY_AFTER))]
+            headers.append(('Content-Length', str(len(body))))
+            headers.append(('Connection', 'close'))
+            head = 'HTTP/1.0 %s\r\n%s\r\n' % (status, ''.join('%s: %s\r\n' % h for h in headers))
+            request.sendall(head.encode('latin-1') + body)
+        except (socket.error, socket.timeout):
+            pass
+        finally:
+            with self.shed_lock:
+                self.shed_pending -= 1
+            self.shutdown_request(request)
+
+
+def make_server(host, port, app, thread_count=None, handler_class=KeepAliveRequestHandler, pool=None, reuse_port=False,
+                max_queue=MAXQUEUE, fallback=None, rank=KML_RANK, classify=None, scheduler=None):
+    '''Create a new WSGI server listening on `host` and `port` for `app`'''
+    httpd = ThreadPoolWSGIServer(thread_count, (host, port), handler_class, pool=pool, reuse_port=reuse_port,
+                                 max_queue=max_queue, fallback=fallback, rank=rank, classify=classify,
+                                 scheduler=scheduler)
+    httpd.set_app(app)
+    return httpd
+
+###############################################################################
+#
+# Pre-fork mode: a supervising process starts a number of worker processes,
+# each with its own listening socket (SO_REUSEPORT) and thread pool, so that
+# Python work is spread over several cores.  Workers that die are restarted.
+# On SIGHUP, a new set of workers is started and the old workers finish the
+# requests they have already accepted before exiting (graceful reload).  The
+# new workers are forked from the supervisor, so they start with empty caches
+# but run the code that it loaded at startup: changes to the scripts need a
+# restart.  On SIGTERM or SIGINT, all workers finish their requests and the
+# server stops.
+#
+
+def run_worker(make_servers):
+    '''Serve until SIGTERM (in a freshly forked worker process), then finish the requests in progress'''
+
+    servers = make_servers()
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can not be called from the serving thread
+        stopper = threading.Thread(target=lambda: [httpd.shutdown() for httpd in servers])
+        stopper.daemon = True
+        stopper.start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    threads = [threading.Thread(target=httpd.serve_forever) for httpd in servers[1:]]
+    for thread in threads:
+        thread.start()
+    servers[0].serve_forever()
+    for thread in threads:
+        thread.join()
+
+    # No new connections are accepted any more; let the threads finish the ones that were
+    for httpd in servers:
+        httpd.server_close()
+    pools = []
+    for httpd in servers:
+        if httpd.pool not in pools:
+            pools.append(httpd.pool)
+    for pool in pools + [httpd.shed_pool for httpd in servers]:
+        pool.close()
+        pool.join()
+
+def serve_prefork(make_servers, workers):
+    '''
+    Run `workers` worker processes, each serving the servers returned by make_servers()
+    (which must create them with reuse_port=True), until SIGTERM or SIGINT
+    '''
+
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        sys.exit('Worker processes need fork() and SO_REUSEPORT, which this system does not have')
+
+    state = {'reload': False, 'stop': False}
+    def reload(signum, frame):
+        state['reload'] = True
+    def stop(signum, frame):
+        state['stop'] = True
+    signal.signal(signal.SIGHUP, reload)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    children = {}
+    generation = [0]
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                run_worker(make_servers)
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        children[pid] = (generation[0], time.time())
+
+    for i in range(workers):
+        spawn()
+
+    stopping = False
+    while children:
+        if state['stop'] and not stopping:
+            stopping = True
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+        if state['reload'] and not stopping:
+            state['reload'] = False
+            # New workers accept connections before the old ones stop
+            generation[0] += 1
+            old = list(children.keys())
+            for i in range(workers):
+                spawn()
+            for pid in old:
+                os.kill(pid, signal.SIGTERM)
+            print('Reloaded %d workers' % workers)
+
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            break
+        if pid == 0:
+            time.sleep(SUPERVISE_INTERVAL)
+            continue
+
+        gen, started = children.pop(pid, (None, 0))
+        if gen == generation[0] and not stopping:
+            print('Worker %d exited with status %d, restarting it' % (pid, status))
+            if time.time() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            spawn()
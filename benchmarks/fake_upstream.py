@@ -0,0 +1,168 @@
+# Stand-in upstream tile server for benchmarks
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Serves synthetic XYZ tiles (/<z>/<x>/<y>.png or .jpg) after a configurable
+# delay, and fails a configurable share of requests, so that the tile and
+# kml servers can be measured without depending on (or loading) a real map
+# server.  Run on its own with:
+#
+#   python benchmarks/fake_upstream.py --port 9000 --latency 0.05 --error-rate 0.01
+#
+# or use FakeUpstream from another script (see load_test.py).
+#
+
+import sys
+import time
+import random
+import argparse
+import threading
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from cStringIO import StringIO as BytesIO
+elif major == 3:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from io import BytesIO
+from PIL import Image, ImageDraw
+
+# Different tile images served (picked by tile position)
+VARIANTS = 16
+
+CONTENT_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg'}
+
+###############################################################################
+
+def synthetic_tiles(fmt, tilesize=256, variants=VARIANTS):
+    """Encoded tile images with some structure (so that they compress like map tiles)"""
+
+    tiles = []
+    for i in range(variants):
+        im = Image.new('RGB', (tilesize, tilesize), (230, 225 - 4 * i, 200 + 3 * i))
+        draw = ImageDraw.Draw(im)
+        for j in range(0, tilesize, 16):
+            draw.line([(0, j), (tilesize, (j * (i + 3)) % tilesize)], fill=(90, 110, 60 + 10 * i), width=2)
+        draw.rectangle([tilesize // 4, tilesize // 4, tilesize // 2, tilesize // 2], outline=(0, 0, 0))
+        f = BytesIO()
+        if fmt == 'jpg':
+            im.save(f, 'JPEG', quality=85)
+        else:
+            im.save(f, 'PNG')
+        tiles.append(f.getvalue())
+    return tiles
+
+
+class TileHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        upstream = self.server.upstream
+        upstream.count()
+        parts = self.path.strip('/').split('?')[0].split('/')
+        if len(parts) != 3 or '.' not in parts[2]:
+            return self.reply(404, b'Not found', 'text/plain')
+        y, ext = parts[2].split('.', 1)
+        try:
+            z, x, y = int(parts[0]), int(parts[1]), int(y)
+        except ValueError:
+            return self.reply(404, b'Not found', 'text/plain')
+
+        delay = upstream.latency + random.uniform(-upstream.jitter, upstream.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < upstream.error_rate:
+            upstream.count_error()
+            return self.reply(500, b'Synthetic error', 'text/plain')
+        tiles = upstream.tiles.get(ext)
+        if tiles is None:
+            return self.reply(404, b'Not found', 'text/plain')
+        self.reply(200, tiles[(x * 7 + y * 13 + z) % len(tiles)], CONTENT_TYPES[ext])
+
+    def reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeUpstream(object):
+    """A fake tile server running in a background thread"""
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, tilesize=256):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tiles = {'png': synthetic_tiles('png', tilesize), 'jpg': synthetic_tiles('jpg', tilesize)}
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), TileHandler)
+        self.httpd.upstream = self
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def url(self, fmt='png'):
+        """Url template of the fake tiles, in the form used by mapsource files"""
+        return 'http://127.0.0.1:%d/{$z}/{$x}/{$y}.%s' % (self.port, fmt)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic map tiles for benchmarks')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each tile is sent')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random variation of the latency, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 500')
+    args = parser.parse_args()
+    upstream = FakeUpstream(args.port, args.latency, args.jitter, args.error_rate)
+    print('Fake tiles served as ' + upstream.url('png') + ' (or .jpg)')
+    upstream.httpd.serve_forever()
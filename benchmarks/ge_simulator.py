@@ -0,0 +1,417 @@
+# Simulates Google Earth loading the kml of a layer along a camera path
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Google Earth only fetches a NetworkLink (and the icon of a GroundOverlay)
+# once its Region is in view and large enough on screen (its Lod), and only
+# finds the next links in the documents that it has fetched.  This script
+# does the same for a camera looking straight down from a series of
+# positions, so that changes to the structure of the kml (depth, tile size,
+# pruning of empty tiles) can be measured without Google Earth.  For each
+# view it reports the kml documents and images fetched, their bytes, the
+# number of serial round trips (the depth of the chain of documents that had
+# to be fetched one after the other) and the time until the view was loaded.
+#
+# Without --root, a fake upstream server and the kml and tile servers are
+# started as in load_test.py (on the ports of Scripts/addr.txt, which must be
+# free).  Camera paths are text files with one "latitude longitude altitude"
+# (altitude in metres) per line; the default path descends from 10000 km to
+# 3 km, then pans east.  For example:
+#
+#   python benchmarks/ge_simulator.py --layer-options "depth=2;"
+#   python benchmarks/ge_simulator.py --root "http://localhost:8081/?url=...;" --path flight.txt
+#
+
+import os
+import sys
+import math
+import gzip
+import json
+import time
+import zipfile
+import argparse
+import threading
+import xml.etree.ElementTree as ElementTree
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from httplib import HTTPConnection
+    from urlparse import urlsplit
+    from Queue import Queue
+    from cStringIO import StringIO as BytesIO
+elif major == 3:
+    from http.client import HTTPConnection
+    from urllib.parse import urlsplit
+    from queue import Queue
+    from io import BytesIO
+
+from load_test import BENCHDIR, REQUEST_TIMEOUT, Servers, layer_query, layer_id
+from fake_upstream import FakeUpstream
+
+KML = '{http://www.opengis.net/kml/2.2}'
+
+# Metres per degree of latitude
+METRES_PER_DEGREE = 111320.0
+
+# Concurrent connections used by Google Earth for fetching network links and images
+CONNECTIONS = 6
+
+# Screen size in pixels, and horizontal field of view in degrees
+VIEWPORT = (1280, 800)
+FIELD_OF_VIEW = 60.0
+
+DEFAULT_PATH = [(40.0, -105.0, altitude) for altitude in
+                (10000e3, 3000e3, 1000e3, 300e3, 100e3, 30e3, 10e3, 3e3)] + \
+               [(40.0, -105.0 + 0.02 * i, 3e3) for i in range(1, 4)]
+
+###############################################################################
+
+class Camera(object):
+    """A camera looking straight down, with the area it sees and the size of a metre on screen"""
+
+    def __init__(self, lat, lon, altitude, viewport=VIEWPORT, fov=FIELD_OF_VIEW):
+        self.lat, self.lon, self.altitude = lat, lon, altitude
+        halfwidth = altitude * math.tan(math.radians(fov / 2.0))
+        halfheight = halfwidth * viewport[1] / viewport[0]
+        self.pixels_per_metre = viewport[0] / (2.0 * halfwidth)
+        coslat = max(math.cos(math.radians(lat)), 0.01)
+        self.north = min(lat + halfheight / METRES_PER_DEGREE, 90.0)
+        self.south = max(lat - halfheight / METRES_PER_DEGREE, -90.0)
+        halflon = min(halfwidth / (METRES_PER_DEGREE * coslat), 180.0)
+        self.east = lon + halflon
+        self.west = lon - halflon
+
+    # -------------------------------------------------------------------------
+    def sees(self, north, south, east, west):
+        if north < self.south or south > self.north:
+            return False
+        # Compare longitudes in both directions around the date line
+        for shift in (0.0, 360.0, -360.0):
+            if east + shift >= self.west and west + shift <= self.east:
+                return True
+        return False
+
+    # -------------------------------------------------------------------------
+    def pixels(self, north, south, east, west):
+        """Size of a box on screen (the square root of its area in pixels), as used for Lod"""
+
+        coslat = math.cos(math.radians((north + south) / 2.0))
+        height = (north - south) * METRES_PER_DEGREE
+        width = (east - west) * METRES_PER_DEGREE * coslat
+        return math.sqrt(max(width * height, 0.0)) * self.pixels_per_metre
+
+    # -------------------------------------------------------------------------
+    def active(self, region):
+        """True if a Region element is in view and within its Lod limits"""
+
+        box = region.find(KML + 'LatLonAltBox')
+        edges = [float(box.findtext(KML + name)) for name in ('north', 'south', 'east', 'west')]
+        if not self.sees(*edges):
+            return False
+        lod = region.find(KML + 'Lod')
+        if lod is None:
+            return True
+        minlod = float(lod.findtext(KML + 'minLodPixels', '0'))
+        maxlod = float(lod.findtext(KML + 'maxLodPixels', '-1'))
+        pixels = self.pixels(*edges)
+        return pixels >= minlod and (maxlod < 0 or pixels <= maxlod)
+
+###############################################################################
+
+class Fetcher(object):
+    """
+    Threads that fetch urls over keep-alive connections (one per server and
+    thread, as Google Earth does), a batch of urls at a time
+    """
+
+    def __init__(self, connections=CONNECTIONS):
+        self.jobs = Queue()
+        self.threads = [threading.Thread(target=self.run) for i in range(connections)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    # -------------------------------------------------------------------------
+    def run(self):
+        conns = {}
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            url, results, done = job
+            results[url] = self.get(conns, url)
+            done()
+        for conn in conns.values():
+            conn.close()
+
+    # -------------------------------------------------------------------------
+    def get(self, conns, url):
+        """Returns (status, bytes on the wire, body)"""
+
+        parts = urlsplit(url)
+        host = (parts.hostname, parts.port or 80)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        for attempt in range(2):
+            conn = conns.get(host)
+            if conn is None:
+                conn = conns[host] = HTTPConnection(host[0], host[1], timeout=REQUEST_TIMEOUT)
+            try:
+                conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+                response = conn.getresponse()
+                body = response.read()
+            except Exception:
+                # The server may have closed an idle connection; try once more on a new one
+                conn.close()
+                del conns[host]
+                continue
+            size = len(body)
+            if response.getheader('Content-Encoding', '') == 'gzip':
+                body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+                del conns[host]
+            return response.status, size, body
+        return None, 0, b''
+
+    # -------------------------------------------------------------------------
+    def fetch_all(self, urls):
+        """Fetch urls concurrently; returns {url: (status, bytes, body)}"""
+
+        results = {}
+        if not urls:
+            return results
+        remaining = [len(urls)]
+        finished = threading.Event()
+        lock = threading.Lock()
+
+        def done():
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    finished.set()
+
+        for url in urls:
+            self.jobs.put((url, results, done))
+        finished.wait()
+        return results
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+
+###############################################################################
+
+def parse_kml(body):
+    """The Document element of a kml (or kmz) response, or None"""
+
+    if body[:2] == b'PK':
+        body = zipfile.ZipFile(BytesIO(body)).read('doc.kml')
+    try:
+        root = ElementTree.fromstring(body)
+    except Exception:
+        return None
+    document = root.find(KML + 'Document')
+    if document is None:
+        document = root.find(KML + 'Folder')
+    return document
+
+def active_features(camera, container, links, icons):
+    """
+    Collect the hrefs of the active NetworkLinks and GroundOverlays in a container
+    (Document or Folder), skipping everything below an inactive Region
+    """
+
+    region = container.find(KML + 'Region')
+    if region is not None and not camera.active(region):
+        return
+    for element in container:
+        tag = element.tag
+        if tag in (KML + 'Folder', KML + 'Document'):
+            active_features(camera, element, links, icons)
+        elif tag in (KML + 'NetworkLink', KML + 'GroundOverlay'):
+            region = element.find(KML + 'Region')
+            if region is not None and not camera.active(region):
+                continue
+            if tag == KML + 'NetworkLink':
+                href = element.findtext(KML + 'Link/' + KML + 'href') or element.findtext(KML + 'Url/' + KML + 'href')
+                if href:
+                    links.append(href.strip())
+            else:
+                href = element.findtext(KML + 'Icon/' + KML + 'href')
+                if href:
+                    icons.append(href.strip())
+
+def unique(values):
+    """Values in their first order, without repeats"""
+
+    seen = set()
+    return [v for v in values if not (v in seen or seen.add(v))]
+
+def load_view(camera, root, fetcher, documents, images):
+    """
+    Load everything that is active in one view, round trip by round trip: each round
+    fetches the documents linked from the previous round together with the images
+    found in it.  `documents` (url: parsed kml, or None) and `images` (fetched icon
+    urls) are what is already loaded, and are updated.  Returns the view's statistics
+    """
+
+    stats = {'kml_requests': 0, 'kml_bytes': 0, 'image_requests': 0, 'image_bytes': 0,
+             'errors': 0, 'round_trips': 0, 'images_by_host': {}}
+    start = time.time()
+    walk = [root]
+    icons = []
+    walked = set()
+    while walk or icons:
+        # Documents that are already loaded are walked without a request
+        fetch = [url for url in walk if url not in documents]
+        results = fetcher.fetch_all(fetch + icons)
+        if results:
+            stats['round_trips'] += 1
+
+        for url in fetch:
+            status, size, body = results[url]
+            stats['kml_requests'] += 1
+            stats['kml_bytes'] += size
+            if status != 200:
+                stats['errors'] += 1
+                documents[url] = None
+            else:
+                documents[url] = parse_kml(body)
+        for icon in icons:
+            status, size, body = results[icon]
+            stats['image_requests'] += 1
+            stats['image_bytes'] += size
+            host = urlsplit(icon).netloc
+            stats['images_by_host'][host] = stats['images_by_host'].get(host, 0) + 1
+            if status != 200:
+                stats['errors'] += 1
+            images.add(icon)
+
+        links = []
+        found = []
+        for url in walk:
+            walked.add(url)
+            if documents.get(url) is not None:
+                active_features(camera, documents[url], links, found)
+        walk = unique([url for url in links if url not in walked])
+        icons = unique([icon for icon in found if icon not in images])
+    stats['seconds'] = round(time.time() - start, 3)
+    return stats
+
+def read_path(filename):
+    """Camera positions (latitude, longitude, altitude) from a text file"""
+
+    path = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                lat, lon, altitude = [float(v) for v in line.replace(',', ' ').split()]
+                path.append((lat, lon, altitude))
+    return path
+
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate Google Earth loading a kml layer along a camera path')
+    parser.add_argument('--root', help='url of the root kml of a layer on running servers (otherwise servers and a '
+                                       'fake upstream are started)')
+    parser.add_argument('--path', help='camera path file, with "latitude longitude altitude" per line')
+    parser.add_argument('--cold', action='store_true', help='forget what was loaded before each view')
+    parser.add_argument('--connections', type=int, default=CONNECTIONS, help='concurrent connections')
+    parser.add_argument('--viewport', default='%dx%d' % VIEWPORT, help='screen size in pixels, as WIDTHxHEIGHT')
+    parser.add_argument('--fov', type=float, default=FIELD_OF_VIEW, help='horizontal field of view in degrees')
+    parser.add_argument('--layer-options', default='', help='extra layer options for the started servers, such as '
+                                                            '"depth=2;&maxInline=64;" or "tilesize=512;"')
+    parser.add_argument('--format', choices=('png', 'jpg'), default='png', help='format of the upstream tiles')
+    parser.add_argument('--profile', choices=('geodetic', 'mercator'), default='geodetic', help='profile of the layer')
+    parser.add_argument('--dynamic', action='store_true', help='force tiles through the tile server (forceDynamicTile)')
+    parser.add_argument('--latency', type=float, default=0.02, help='upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='random variation of the upstream latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of upstream requests that fail')
+    parser.add_argument('--combined', action='store_true', help='run server_multi.py instead of the two servers')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='extra option for the servers, such as --server-arg=--workers=4; may be repeated')
+    parser.add_argument('--server-log', help='append the output of the servers to this file')
+    parser.add_argument('--output', default=os.path.join(BENCHDIR, 'ge_results.json'), help='json results file')
+    args = parser.parse_args()
+
+    viewport = tuple(int(v) for v in args.viewport.lower().split('x'))
+    path = read_path(args.path) if args.path else DEFAULT_PATH
+
+    upstream = servers = None
+    fetcher = Fetcher(args.connections)
+    try:
+        if args.root:
+            root = args.root
+        else:
+            upstream = FakeUpstream(0, args.latency, args.jitter, args.error_rate).start()
+            query = layer_query(upstream, args.format, args.profile, args.dynamic) + args.layer_options
+            servers = Servers(args.combined, args.server_arg, args.server_log).start()
+            # Register the layer (so that its /l/<id>/ links can be followed)
+            layer_id(servers, query)
+            root = 'http://localhost:%d/?%s' % (servers.kmlport, query)
+
+        documents = {}
+        images = set()
+        views = []
+        print('%-26s %6s %8s %6s %9s %6s %6s %8s' % ('view (lat lon altitude)', 'kml', 'kB', 'images', 'kB',
+                                                     'errors', 'trips', 'seconds'))
+        for lat, lon, altitude in path:
+            if args.cold:
+                documents = {}
+                images = set()
+            camera = Camera(lat, lon, altitude, viewport, args.fov)
+            stats = load_view(camera, root, fetcher, documents, images)
+            stats['camera'] = [lat, lon, altitude]
+            views.append(stats)
+            print('%8.3f %8.3f %8dm %6d %8.1f %6d %9.1f %6d %6d %8.3f' % (
+                lat, lon, altitude, stats['kml_requests'], stats['kml_bytes'] / 1000.0, stats['image_requests'],
+                stats['image_bytes'] / 1000.0, stats['errors'], stats['round_trips'], stats['seconds']))
+    finally:
+        fetcher.close()
+        if servers is not None:
+            servers.stop()
+        if upstream is not None:
+            upstream.stop()
+
+    totals = dict((name, sum(view[name] for view in views))
+                  for name in ('kml_requests', 'kml_bytes', 'image_requests', 'image_bytes', 'errors',
+                               'round_trips', 'seconds'))
+    totals['max_round_trips'] = max([view['round_trips'] for view in views] or [0])
+    print('total: %(kml_requests)d kml (%(kml_bytes)d bytes), %(image_requests)d images (%(image_bytes)d bytes), '
+          '%(errors)d errors, %(round_trips)d round trips (at most %(max_round_trips)d per view), '
+          '%(seconds).2f seconds' % totals)
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'root': root,
+              'config': dict((name, value) for name, value in vars(args).items() if name != 'output'),
+              'views': views, 'totals': totals}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+# End-to-end load benchmark of the kml and tile servers
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# Starts a fake upstream tile server (fake_upstream.py) and the kml and tile
+# servers (on the ports of Scripts/addr.txt, which must be free), then
+# drives them with concurrent keep-alive clients the way Google Earth does:
+# tiles are requested as /l/<id>/<z>/<x>/<y> after the layer's root kml.
+# Workloads:
+#
+#   cold    freshly started servers, each tile requested once
+#   warm    the same tiles again, from the same servers
+#   mixed   freshly started servers, kml documents and tiles, half of the
+#           tiles requested again shortly after
+#
+# For each workload, the throughput, latency percentiles, bytes per response
+# and the cpu time the servers used per tile are printed, and written as
+# json (--output) for comparing runs.  For example:
+#
+#   python benchmarks/load_test.py --tiles 400 --clients 16 --latency 0.05
+#   python benchmarks/load_test.py --combined --server-arg=--workers=4
+#
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+(major,minor,micro,releaselevel,serial) = sys.version_info
+if major == 2:
+    from httplib import HTTPConnection
+    from urllib import quote
+elif major == 3:
+    from http.client import HTTPConnection
+    from urllib.parse import quote
+
+BENCHDIR = os.path.dirname(os.path.realpath(__file__))
+SCRIPTDIR = os.path.join(os.path.dirname(BENCHDIR), 'Scripts')
+sys.path.insert(0, SCRIPTDIR)
+from wsgi_server import read_ports
+from fake_upstream import FakeUpstream
+
+# Seconds allowed for the servers to start (loading GDAL can take a while)
+STARTUP_TIMEOUT = 60.0
+
+# Seconds allowed for a single request
+REQUEST_TIMEOUT = 60.0
+
+WORKLOADS = ('cold', 'warm', 'mixed')
+
+###############################################################################
+
+def process_cpu(pid):
+    """User plus system cpu seconds of a process and its child processes (None without /proc)"""
+
+    ticks = float(os.sysconf('SC_CLK_TCK')) if hasattr(os, 'sysconf') else 100.0
+    total = None
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # The process name (in parentheses) may contain spaces
+        fields = stat[stat.rfind(')') + 2:].split()
+        if int(name) == pid or int(fields[1]) == pid:
+            total = (total or 0.0) + (int(fields[11]) + int(fields[12])) / ticks
+    return total
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list"""
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(math.ceil(p / 100.0 * len(values))) - 1))]
+
+
+class Servers(object):
+    """The kml and tile servers (or the combined server), run as separate processes"""
+
+    def __init__(self, combined=False, server_args=(), log=None):
+        self.combined = combined
+        self.server_args = list(server_args)
+        self.log = log
+        self.kmlport, self.tileport = read_ports()
+        self.processes = []
+
+    def start(self):
+        if self.log:
+            out = open(self.log, 'a')
+        else:
+            out = open(os.devnull, 'w')
+        if self.combined:
+            scripts = ['server_multi.py']
+        else:
+            scripts = ['kml_server_multi.py', 'tile_server_multi.py']
+        for script in scripts:
+            self.processes.append(subprocess.Popen([sys.executable, os.path.join(SCRIPTDIR, script)] + self.server_args,
+                                                   stdout=out, stderr=subprocess.STDOUT))
+        out.close()
+        deadline = time.time() + STARTUP_TIMEOUT
+        for port in (self.kmlport, self.tileport):
+            while True:
+                try:
+                    conn = HTTPConnection('127.0.0.1', port, timeout=5)
+                    conn.request('GET', '/metrics')
+                    conn.getresponse().read()
+                    conn.close()
+                    break
+                except Exception:
+                    if time.time() > deadline or any(p.poll() is not None for p in self.processes):
+                        self.stop()
+                        sys.exit('The servers did not start (is port %d free?)' % port)
+                    time.sleep(0.2)
+        return self
+
+    def cpu(self):
+        values = [process_cpu(p.pid) for p in self.processes]
+        if None in values:
+            return None
+        return sum(values)
+
+    def stop(self):
+        for p in self.processes:
+            if p.poll() is None:
+                p.terminate()
+        for p in self.processes:
+            try:
+                p.wait(timeout=10) if major == 3 else p.wait()
+            except Exception:
+                p.kill()
+        self.processes = []
+
+###############################################################################
+
+def layer_query(upstream, fmt, profile, dynamic):
+    """Query string of a layer of fake tiles, as in a mapsource kml link"""
+
+    query = 'url=' + quote(upstream.url(fmt), '') + ';&zoom=0-18;&profile=' + profile + ';'
+    if dynamic:
+        query = query + '&forceDynamicTile=1;'
+    return query
+
+def layer_id(servers, query):
+    """Fetch the root kml of a layer (as Google Earth does first), and return the layer id it links to"""
+
+    conn = HTTPConnection('127.0.0.1', servers.kmlport, timeout=REQUEST_TIMEOUT)
+    conn.request('GET', '/?' + query)
+    body = conn.getresponse().read().decode('utf-8', 'replace')
+    conn.close()
+    match = re.search(r'/l/([0-9a-f]+)', body)
+    if match is None:
+        sys.exit('The root kml of the benchmark layer has no /l/<id> links')
+    return match.group(1)
+
+def tile_block(zoom, count, profile, offset=0):
+    """About `count` neighbouring tiles (z, x, y) at a zoom level"""
+
+    side = int(math.ceil(math.sqrt(count)))
+    width = 2**(zoom + 1) if profile == 'geodetic' else 2**zoom
+    x0 = min(int(width * 0.55) + offset * side, width - side)
+    y0 = min(int(2**zoom * 0.6), 2**zoom - side)
+    tiles = [(zoom, x0 + i % side, y0 + i // side) for i in range(count)]
+    return tiles
+
+def mixed_requests(tiles, seed):
+    """Kml and tile requests: every tile, half of them again shortly after, and one kml document per four tiles"""
+
+    rnd = random.Random(seed)
+    requests = []
+    for i, tile in enumerate(tiles):
+        if i % 4 == 0:
+            requests.append(('kml', tile))
+        requests.append(('tile', tile))
+        if i % 2 == 1:
+            requests.append(('tile', tiles[max(0, i - rnd.randint(1, 8))]))
+    return requests
+
+###############################################################################
+
+def run_requests(servers, lid, requests, clients):
+    """Send the requests from `clients` threads over keep-alive connections; returns one result per request"""
+
+    results = []
+    lock = threading.Lock()
+    position = [0]
+
+    def client():
+        conns = {}
+        while True:
+            with lock:
+                i = position[0]
+                position[0] += 1
+            if i >= len(requests):
+                break
+            kind, (z, x, y) = requests[i]
+            port = servers.kmlport if kind == 'kml' else servers.tileport
+            path = '/l/%s/%d/%d/%d' % (lid, z, x, y)
+            start = time.time()
+            status, size = None, 0
+            try:
+                conn = conns.get(port)
+                if conn is None:
+                    conn = conns[port] = HTTPConnection('127.0.0.1', port, timeout=REQUEST_TIMEOUT)
+                conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+                response = conn.getresponse()
+                size = len(response.read())
+                status = response.status
+                if response.getheader('Connection', '').lower() == 'close':
+                    conn.close()
+                    del conns[port]
+            except Exception:
+                conns.pop(port, None)
+            with lock:
+                results.append((kind, time.time() - start, status, size))
+        for conn in conns.values():
+            conn.close()
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def summarize(results, seconds, cpu, upstream_requests):
+    """Throughput, latency percentiles, bytes and cpu per tile of one workload"""
+
+    summary = {'requests': len(results), 'seconds': round(seconds, 3),
+               'throughput': round(len(results) / seconds, 2) if seconds > 0 else None,
+               'upstream_requests': upstream_requests}
+    for kind in ('tile', 'kml'):
+        kind_results = [r for r in results if r[0] == kind]
+        if not kind_results:
+            continue
+        latencies = sorted(r[1] for r in kind_results)
+        ok = [r for r in kind_results if r[2] == 200]
+        summary[kind] = {
+            'requests': len(kind_results),
+            'errors': len(kind_results) - len(ok),
+            'latency_ms': dict((name, round(percentile(latencies, p) * 1000, 2))
+                               for name, p in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))),
+            'mean_latency_ms': round(sum(latencies) * 1000 / len(latencies), 2),
+            'bytes_per_response': int(sum(r[3] for r in ok) / len(ok)) if ok else None}
+    tiles = len([r for r in results if r[0] == 'tile'])
+    summary['cpu_seconds'] = round(cpu, 3) if cpu is not None else None
+    summary['cpu_ms_per_tile'] = round(cpu * 1000 / tiles, 3) if cpu is not None and tiles else None
+    return summary
+
+def run_workload(name, servers, upstream, lid, requests, clients):
+    upstream_before = upstream.requests
+    cpu_before = servers.cpu()
+    start = time.time()
+    results = run_requests(servers, lid, requests, clients)
+    seconds = time.time() - start
+    cpu_after = servers.cpu()
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    summary = summarize(results, seconds, cpu, upstream.requests - upstream_before)
+    line = '%-6s %6d requests %8.1f/s' % (name, summary['requests'], summary['throughput'] or 0)
+    for kind in ('tile', 'kml'):
+        if kind in summary:
+            s = summary[kind]
+            line += '   %s p50 %.1f p95 %.1f p99 %.1f ms, %d errors' % (kind, s['latency_ms']['p50'],
+                                                                       s['latency_ms']['p95'],
+                                                                       s['latency_ms']['p99'], s['errors'])
+    if summary['cpu_ms_per_tile'] is not None:
+        line += '   %.2f cpu ms/tile' % summary['cpu_ms_per_tile']
+    print(line)
+    return summary
+
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Load benchmark of the kml and tile servers')
+    parser.add_argument('--tiles', type=int, default=256, help='distinct tiles per workload')
+    parser.add_argument('--zoom', type=int, default=10, help='zoom level of the tiles')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help='comma separated, of ' + ', '.join(WORKLOADS))
+    parser.add_argument('--format', choices=('png', 'jpg'), default='png', help='format of the upstream tiles')
+    parser.add_argument('--profile', choices=('geodetic', 'mercator'), default='geodetic',
+                        help='tile profile of the layer (mercator tiles are only served by the tile server with '
+                             '--dynamic)')
+    parser.add_argument('--dynamic', action='store_true', help='force tiles through the tile server (forceDynamicTile)')
+    parser.add_argument('--latency', type=float, default=0.02, help='upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='random variation of the upstream latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of upstream requests that fail')
+    parser.add_argument('--combined', action='store_true', help='run server_multi.py instead of the two servers')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='extra option for the servers, such as --server-arg=--workers=4; may be repeated')
+    parser.add_argument('--server-log', help='append the output of the servers to this file')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=os.path.join(BENCHDIR, 'results.json'), help='json results file')
+    args = parser.parse_args()
+
+    workloads = [w.strip() for w in args.workloads.split(',') if w.strip()]
+    for w in workloads:
+        if w not in WORKLOADS:
+            parser.error('unknown workload ' + w)
+
+    upstream = FakeUpstream(0, args.latency, args.jitter, args.error_rate).start()
+    query = layer_query(upstream, args.format, args.profile, args.dynamic)
+    rnd = random.Random(args.seed)
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': {'python': platform.python_version(), 'platform': platform.platform(),
+                       'cpus': os.cpu_count() if major == 3 else None},
+              'config': dict((name, value) for name, value in vars(args).items() if name != 'output'),
+              'workloads': {}}
+
+    servers = None
+    try:
+        tiles = tile_block(args.zoom, args.tiles, args.profile)
+        if 'cold' in workloads or 'warm' in workloads:
+            servers = Servers(args.combined, args.server_arg, args.server_log).start()
+            lid = layer_id(servers, query)
+            requests = [('tile', tile) for tile in tiles]
+            rnd.shuffle(requests)
+            if 'cold' in workloads:
+                report['workloads']['cold'] = run_workload('cold', servers, upstream, lid, requests, args.clients)
+            elif 'warm' in workloads:
+                # Warm the caches first
+                run_requests(servers, lid, requests, args.clients)
+            if 'warm' in workloads:
+                rnd.shuffle(requests)
+                report['workloads']['warm'] = run_workload('warm', servers, upstream, lid, requests, args.clients)
+            servers.stop()
+            servers = None
+
+        if 'mixed' in workloads:
+            servers = Servers(args.combined, args.server_arg, args.server_log).start()
+            lid = layer_id(servers, query)
+            requests = mixed_requests(tile_block(args.zoom, args.tiles, args.profile, offset=1), args.seed)
+            report['workloads']['mixed'] = run_workload('mixed', servers, upstream, lid, requests, args.clients)
+    finally:
+        if servers is not None:
+            servers.stop()
+        upstream.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Exact-agreement tests of the batch tile math against the scalar methods
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# The batch functions of Scripts/tile_math.py must give exactly (bit for bit)
+# what the scalar GlobalMercator and GlobalGeodetic methods give, since both
+# end up in kml coordinates, cache keys and the availability index.  Run with
+#
+#   python benchmarks/test_tile_math.py
+#
+# (benchmarks/tile_math_bench.py times the same functions on larger inputs).
+#
+
+import os
+import sys
+import random
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'Scripts'))
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from tile_math import GlobalMercator, GlobalGeodetic
+import tile_math
+from tile_math_bench import scalar_tile_ranges, random_tiles, block_tiles
+
+# Random tiles per comparison
+TILES = 5000
+
+###############################################################################
+
+def columns(tiles):
+    return (numpy.array([t[0] for t in tiles], dtype=numpy.int64),
+            numpy.array([t[1] for t in tiles], dtype=numpy.int64),
+            numpy.array([t[2] for t in tiles], dtype=numpy.int64))
+
+def rows(result):
+    return list(zip(*[column.tolist() for column in result]))
+
+
+class TileMathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rnd = random.Random(1)
+
+    # -------------------------------------------------------------------------
+    def check_bounds(self, tiles, scalar, batch):
+        expected = [scalar(x, y, z) for z, x, y in tiles]
+        self.assertEqual(rows(batch(*columns(tiles))), expected)
+
+    def test_mercator_bounds(self):
+        for tilesize in (256, 512):
+            mercator = GlobalMercator(tilesize)
+            tiles = random_tiles(self.rnd, TILES, 'mercator')
+            self.check_bounds(tiles, mercator.TileBounds,
+                              lambda z, x, y: tile_math.mercator_bounds(z, x, y, tilesize))
+            self.check_bounds(tiles, mercator.TileLatLonBounds,
+                              lambda z, x, y: tile_math.mercator_latlon_bounds(z, x, y, tilesize))
+            self.check_bounds(block_tiles(TILES), mercator.TileLatLonBounds,
+                              lambda z, x, y: tile_math.latlon_bounds('mercator', z, x, y, tilesize))
+
+    def test_geodetic_bounds(self):
+        for tilesize in (256, 512):
+            geodetic = GlobalGeodetic(tilesize)
+            tiles = random_tiles(self.rnd, TILES, 'geodetic')
+            self.check_bounds(tiles, geodetic.TileBounds,
+                              lambda z, x, y: tile_math.geodetic_bounds(z, x, y, tilesize))
+            self.check_bounds(tiles, geodetic.TileLatLonBounds,
+                              lambda z, x, y: tile_math.latlon_bounds('geodetic', z, x, y, tilesize))
+
+    def test_quadkeys(self):
+        tiles = random_tiles(self.rnd, TILES, 'mercator') + [(0, 0, 0), (1, 1, 0)]
+        expected = [GlobalMercator().QuadTree(x, y, z) for z, x, y in tiles]
+        self.assertEqual(tile_math.quadkeys(*columns(tiles)), expected)
+        self.assertEqual(tile_math.quadkeys([], [], []), [])
+
+    # -------------------------------------------------------------------------
+    def test_tile_ranges(self):
+        bounds = [(-180.0, 90.0, 180.0, -89.9)]
+        for i in range(200):
+            west, east = sorted(self.rnd.uniform(-180, 180) for j in range(2))
+            south, north = sorted(self.rnd.uniform(-89.9, 90) for j in range(2))
+            bounds.append((west, north, east, south))
+        for profile in ('mercator', 'geodetic'):
+            for b in bounds:
+                self.assertEqual(tile_math.tile_ranges(profile, *b), scalar_tile_ranges(profile, *b))
+
+    def test_level_tiles(self):
+        tminmax = tile_math.tile_ranges('geodetic', -125.0, 50.0, -65.0, 24.0)
+        tx, ty = tile_math.level_tiles(tminmax, 6)
+        xmin, ymin, xmax, ymax = tminmax[6]
+        expected = [(x, y) for x in range(xmin, xmax+1) for y in range(ymin, ymax+1)]
+        self.assertEqual(list(zip(tx.tolist(), ty.tolist())), expected)
+        tx, ty = tile_math.level_tiles([(3, 3, 2, 2)], 0)
+        self.assertEqual(len(tx), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
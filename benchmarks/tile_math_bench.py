@@ -0,0 +1,177 @@
+# Microbenchmark and agreement check of the batch tile math against the scalar methods
+#
+###############################################################################
+# Copyright (c) 2018, Patrick Broxton
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+#
+# The batch functions of Scripts/tile_math.py must give exactly (bit for bit)
+# what the scalar GlobalMercator and GlobalGeodetic methods give, since both
+# end up in kml coordinates and cache keys.  This script compares them for
+# random tiles at all zoom levels, for a block of neighbouring tiles and for
+# the range tables of random bounds, times both, and exits with status 1 if
+# any value differs.  For example:
+#
+#   python benchmarks/tile_math_bench.py --tiles 100000
+#
+
+import os
+import sys
+import time
+import random
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'Scripts'))
+from tile_math import GlobalMercator, GlobalGeodetic, MAXZOOMLEVEL
+import tile_math
+
+# Deepest zoom level of the random tiles
+MAXZOOM = 24
+
+# Times each measurement is repeated (the fastest counts)
+REPEAT = 3
+
+###############################################################################
+
+def scalar_tile_ranges(profile, ulx, uly, lrx, lry):
+    """The range table as worked out one zoom level at a time with the scalar methods"""
+
+    tminmax = list(range(0, MAXZOOMLEVEL))
+    if profile == 'mercator':
+        mercator = GlobalMercator()
+        ominx, omaxy = mercator.LatLonToMeters(uly, ulx)
+        omaxx, ominy = mercator.LatLonToMeters(lry, lrx)
+        for tz in range(0, MAXZOOMLEVEL):
+            tminx, tminy = mercator.MetersToTile( ominx, ominy, tz )
+            tmaxx, tmaxy = mercator.MetersToTile( omaxx, omaxy, tz )
+            tminx, tminy = max(0, tminx), max(0, tminy)
+            tmaxx, tmaxy = min(2**tz-1, tmaxx), min(2**tz-1, tmaxy)
+            tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
+    elif profile == 'geodetic':
+        geodetic = GlobalGeodetic()
+        for tz in range(0, MAXZOOMLEVEL):
+            tminx, tminy = geodetic.LatLonToTile( ulx, lry, tz )
+            tmaxx, tmaxy = geodetic.LatLonToTile( lrx, uly, tz )
+            tminx, tminy = max(0, tminx), max(0, tminy)
+            tmaxx, tmaxy = min(2**(tz+1)-1, tmaxx), min(2**tz-1, tmaxy)
+            tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
+    return tminmax
+
+def random_tiles(rnd, count, profile):
+    tiles = []
+    for i in range(count):
+        tz = rnd.randint(0, MAXZOOM)
+        width = 2**(tz + 1) if profile == 'geodetic' else 2**tz
+        tiles.append((tz, rnd.randrange(width), rnd.randrange(2**tz)))
+    return tiles
+
+def block_tiles(count, tz=16):
+    side = int(count ** 0.5)
+    x0, y0 = 2**tz // 3, 2**tz // 5
+    return [(tz, x0 + i % side, y0 + i // side) for i in range(side * side)]
+
+def best_time(func):
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
+
+###############################################################################
+
+def compare(name, tiles, scalar, batch):
+    """Time a scalar function (per tile) against a batch function (on arrays), and count differences"""
+
+    tz = numpy.array([t[0] for t in tiles], dtype=numpy.int64)
+    tx = numpy.array([t[1] for t in tiles], dtype=numpy.int64)
+    ty = numpy.array([t[2] for t in tiles], dtype=numpy.int64)
+    scalar_seconds, expected = best_time(lambda: [scalar(x, y, z) for z, x, y in tiles])
+    batch_seconds, result = best_time(lambda: batch(tz, tx, ty))
+    if isinstance(result, tuple):
+        result = list(zip(*[column.tolist() for column in result]))
+    mismatches = sum(1 for a, b in zip(expected, result) if a != b) + abs(len(expected) - len(result))
+    print('%-34s %8d tiles  scalar %8.1f ms  batch %7.1f ms  %6.1fx  %s' % (
+        name, len(tiles), scalar_seconds * 1000, batch_seconds * 1000, scalar_seconds / max(batch_seconds, 1e-9),
+        mismatches and '%d DIFFERENT' % mismatches or 'identical'))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare and time the batch and scalar tile math')
+    parser.add_argument('--tiles', type=int, default=100000, help='random tiles per comparison')
+    parser.add_argument('--bounds', type=int, default=1000, help='random bounds for the range tables')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    mismatches = 0
+    for tilesize in (256, 512):
+        mercator = GlobalMercator(tilesize)
+        geodetic = GlobalGeodetic(tilesize)
+        merc_tiles = random_tiles(rnd, args.tiles, 'mercator')
+        geo_tiles = random_tiles(rnd, args.tiles, 'geodetic')
+        mismatches += compare('mercator TileBounds (%d)' % tilesize, merc_tiles, mercator.TileBounds,
+                              lambda z, x, y: tile_math.mercator_bounds(z, x, y, tilesize))
+        mismatches += compare('mercator TileLatLonBounds (%d)' % tilesize, merc_tiles, mercator.TileLatLonBounds,
+                              lambda z, x, y: tile_math.mercator_latlon_bounds(z, x, y, tilesize))
+        mismatches += compare('  same, neighbouring tiles', block_tiles(args.tiles), mercator.TileLatLonBounds,
+                              lambda z, x, y: tile_math.mercator_latlon_bounds(z, x, y, tilesize))
+        mismatches += compare('geodetic TileBounds (%d)' % tilesize, geo_tiles, geodetic.TileBounds,
+                              lambda z, x, y: tile_math.geodetic_bounds(z, x, y, tilesize))
+        mismatches += compare('geodetic TileLatLonBounds (%d)' % tilesize, geo_tiles, geodetic.TileLatLonBounds,
+                              lambda z, x, y: tile_math.geodetic_latlon_bounds(z, x, y, tilesize))
+    mismatches += compare('QuadTree', merc_tiles, GlobalMercator().QuadTree, tile_math.quadkeys)
+
+    # Range tables, for the default (whole world) bounds and random ones
+    bounds = [(-180.0, 90.0, 180.0, -89.9)]
+    for i in range(args.bounds):
+        west, east = sorted(rnd.uniform(-180, 180) for j in range(2))
+        south, north = sorted(rnd.uniform(-89.9, 90) for j in range(2))
+        bounds.append((west, north, east, south))
+    for profile in ('mercator', 'geodetic'):
+        scalar_seconds, expected = best_time(lambda: [scalar_tile_ranges(profile, *b) for b in bounds])
+        batch_seconds, result = best_time(lambda: [tile_math.tile_ranges(profile, *b) for b in bounds])
+        different = sum(1 for a, b in zip(expected, result) if a != b)
+        mismatches += different
+        print('%-34s %8d bounds scalar %8.1f ms  batch %7.1f ms  %6.1fx  %s' % (
+            'tile_ranges (%s)' % profile, len(bounds), scalar_seconds * 1000, batch_seconds * 1000,
+            scalar_seconds / max(batch_seconds, 1e-9), different and '%d DIFFERENT' % different or 'identical'))
+
+    # Whole levels, in the order that the root kml lists them
+    tminmax = tile_math.tile_ranges('geodetic', -125.0, 50.0, -65.0, 24.0)
+    tx, ty = tile_math.level_tiles(tminmax, 6)
+    xmin, ymin, xmax, ymax = tminmax[6]
+    expected = [(x, y) for x in range(xmin, xmax+1) for y in range(ymin, ymax+1)]
+    if list(zip(tx.tolist(), ty.tolist())) != expected:
+        print('level_tiles DIFFERENT')
+        mismatches += 1
+
+    if mismatches:
+        print('%d values differ from the scalar versions' % mismatches)
+        sys.exit(1)
+    print('All batch results are identical to the scalar versions')
+
+
+if __name__ == '__main__':
+    main()